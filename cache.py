@@ -0,0 +1,171 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from social_media_app.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    In-process LRU cache with a per-entry TTL. It is bounded by the number of
+    entries and, when `max_bytes` is set, by the total size of the stored
+    values (which must then be bytes). An entry set with a `tag` is only
+    returned to a `get` asking for the same tag.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Any, tuple[float, Any, Any]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, tag=None) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self.delete(key)
+            entry = None
+        if entry is None or entry[2] != tag:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: Optional[float] = None, tag=None):
+        # The previous value is stale even when the new one is not cached
+        self.delete(key)
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value, tag)
+        self._bytes += self._size(value)
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        ):
+            self.delete(next(iter(self._entries)))
+            self.evictions += 1
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= self._size(entry[1])
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _size(self, value) -> int:
+        return len(value) if self.max_bytes is not None else 0
+
+
+class RedisCache:
+    """
+    Shared cache backend so every uvicorn worker sees the same entries and
+    invalidations. Needs the optional `redis` package. Entries are hashes
+    holding the value and its tag, see LRUCache.
+    """
+
+    def __init__(self, url: str, ttl: float, prefix: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, tag: str = "") -> Optional[bytes]:
+        stored_tag, value = await self.client.hmget(
+            f"{self.prefix}{key}", "tag", "value"
+        )
+        if stored_tag is None or stored_tag.decode() != tag:
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value: bytes, tag: str = ""):
+        name = f"{self.prefix}{key}"
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(name, mapping={"tag": tag, "value": value})
+            pipe.pexpire(name, int(self.ttl * 1000))
+            await pipe.execute()
+
+    async def delete(self, key):
+        await self.client.delete(f"{self.prefix}{key}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PostCache:
+    """
+    Read-through cache of serialized `GET /post/{post_id}` responses, tagged
+    with the ETag they were built for. A body is only served under that ETag,
+    so a write bumping the post's version from another process (whose
+    invalidation never reaches this one) can not leave it served as current.
+    Writes that change a post (like, comment, generated image) still
+    invalidate its entry to free it early.
+    """
+
+    def __init__(self):
+        self.local = LRUCache(
+            max_entries=config.POST_CACHE_MAX_ENTRIES,
+            ttl=config.POST_CACHE_TTL_SECONDS,
+            max_bytes=config.POST_CACHE_MAX_BYTES,
+        )
+        self.shared = None
+        if config.POST_CACHE_REDIS_URL:
+            self.shared = RedisCache(
+                config.POST_CACHE_REDIS_URL, config.POST_CACHE_TTL_SECONDS, "post:"
+            )
+
+    async def get(self, post_id: int, etag: str) -> Optional[bytes]:
+        if self.shared:
+            return await self.shared.get(post_id, etag)
+        return self.local.get(post_id, etag)
+
+    async def set(self, post_id: int, etag: str, value: bytes):
+        if self.shared:
+            return await self.shared.set(post_id, value, etag)
+        self.local.set(post_id, value, tag=etag)
+
+    async def invalidate(self, post_id: int):
+        logger.debug(f"Invalidating cached post {post_id}")
+        if self.shared:
+            return await self.shared.delete(post_id)
+        self.local.delete(post_id)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self) -> dict:
+        return self.shared.stats() if self.shared else self.local.stats()
+
+
+post_cache = PostCache()
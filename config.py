@@ -24,6 +24,107 @@ class GlobalConfig(BaseConfig):
     DEEPAI_API_KEY: Optional[str] = None
     SECRET_KEY: Optional[str] = None
     ALGORITHM: Optional[str] = "HS256"
+    # Seconds between post counter reconciliation runs, disabled when unset
+    POST_COUNTERS_RECONCILE_SECONDS: Optional[int] = None
+    # Seconds between hot feed score updates, disabled when unset
+    HOT_SCORE_UPDATE_SECONDS: Optional[int] = 60
+    # Read-through cache for GET /post/{post_id}
+    POST_CACHE_MAX_ENTRIES: int = 10_000
+    POST_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    POST_CACHE_TTL_SECONDS: float = 60
+    # Share the post cache between workers through redis (needs `redis`)
+    POST_CACHE_REDIS_URL: Optional[str] = None
+    # Buffer likes in memory (backed by an append log) and write them in batches
+    LIKE_WRITE_BEHIND: bool = False
+    LIKE_WRITE_BEHIND_LOG_DIR: str = "like_log"
+    LIKE_WRITE_BEHIND_MAX_PENDING: int = 500
+    LIKE_WRITE_BEHIND_FLUSH_SECONDS: float = 1.0
+    LIKE_WRITE_BEHIND_FSYNC: bool = True
+    # Likes arriving within this window are made durable by a single fsync
+    LIKE_WRITE_BEHIND_GROUP_COMMIT_SECONDS: float = 0.002
+    # In-memory top-K of the most liked posts serving the first most_likes pages
+    LEADERBOARD_SIZE: int = 500
+    # Seconds between leaderboard resyncs with the database (likes handled by
+    # other workers), disabled when unset
+    LEADERBOARD_RESYNC_SECONDS: Optional[int] = 30
+    # Users resolved from access tokens, the TTL bounds how stale a cached user
+    # can be on workers that did not see the change
+    USER_CACHE_MAX_ENTRIES: int = 10_000
+    USER_CACHE_TTL_SECONDS: float = 30
+    # Already verified JWTs, each kept until its own expiry
+    TOKEN_CACHE_MAX_ENTRIES: int = 10_000
+    # Seconds between reloads of revoked token versions written by other
+    # workers, disabled when unset
+    TOKEN_DENY_LIST_SYNC_SECONDS: Optional[int] = 30
+    # Connection pool shared by outbound API calls (HTTP/2 needs `httpx[http2]`)
+    HTTP_CLIENT_MAX_CONNECTIONS: int = 100
+    HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS: float = 30
+    HTTP_CLIENT_HTTP2: bool = True
+    HTTP_CLIENT_TIMEOUT_SECONDS: float = 10
+    HTTP_CLIENT_HOST_TIMEOUTS: dict[str, float] = {
+        "api.mailgun.net": 10,
+        "api.deepai.org": 60,
+    }
+    # Durable job queue worker (python -m social_media_app.jobs)
+    JOB_WORKER_CONCURRENCY: int = 10
+    JOB_BATCH_SIZE: int = 10
+    JOB_POLL_SECONDS: float = 1.0
+    # Jobs with a batch handler (emails) claimed and run together, one Mailgun
+    # batch at most
+    JOB_BULK_BATCH_SIZE: int = 1000
+    # A claimed job not finished within this time is handed to another worker
+    JOB_VISIBILITY_TIMEOUT_SECONDS: float = 300
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_SECONDS: float = 10
+    JOB_RETRY_MAX_SECONDS: float = 3600
+    # Run a worker inside the API process too (single process deployments)
+    JOB_WORKER_IN_APP: bool = False
+    # Emails with the same template are sent together in one Mailgun request
+    MAILGUN_BATCH_WINDOW_SECONDS: float = 0.5
+    MAILGUN_BATCH_MAX_RECIPIENTS: int = 1000
+    # Generated images reused for posts with the same (normalized) prompt
+    PROMPT_CACHE_MAX_ENTRIES: int = 10_000
+    PROMPT_CACHE_TTL_SECONDS: float = 7 * 24 * 3600
+    # A hit updates the entry's last use (for eviction) at most this often
+    PROMPT_CACHE_TOUCH_SECONDS: float = 3600
+    # Circuit breaker and adaptive concurrency limit per third-party API
+    CIRCUIT_FAILURE_THRESHOLD: int = 5
+    CIRCUIT_RESET_SECONDS: float = 30
+    CONCURRENCY_LIMIT_INITIAL: int = 10
+    CONCURRENCY_LIMIT_MIN: int = 1
+    CONCURRENCY_LIMIT_MAX: int = 50
+    # Calls slower than this shrink the concurrency limit
+    CONCURRENCY_TARGET_LATENCY_SECONDS: dict[str, float] = {
+        "mailgun": 2,
+        "deepai": 20,
+    }
+    CONCURRENCY_QUEUE_TIMEOUT_SECONDS: float = 5
+    # bcrypt cost, stored hashes with another cost are rehashed on login
+    BCRYPT_ROUNDS: int = 12
+    # Threads hashing and verifying passwords, and how many more calls may wait
+    # for one before requests are rejected with 503
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_QUEUE: int = 32
+    # Uploads are streamed to B2 in parts of this size (5 MB minimum), at most
+    # UPLOAD_MAX_PARTS_IN_FLIGHT of them being sent at once
+    UPLOAD_PART_SIZE: int = 5 * 1024 * 1024
+    UPLOAD_MAX_PARTS_IN_FLIGHT: int = 4
+    # Threads running b2sdk calls, how many more calls may wait for one, and
+    # how long a call may take including the wait
+    B2_WORKERS: int = 8
+    B2_MAX_QUEUE: int = 32
+    B2_CALL_TIMEOUT_SECONDS: float = 120
+    # Seconds between B2 re-authorizations (tokens last 24 hours), disabled
+    # when unset
+    B2_AUTH_REFRESH_SECONDS: Optional[int] = 12 * 3600
+    # Resumable uploads not finalized within the TTL are dropped, checked every
+    # UPLOAD_SESSION_EXPIRE_SECONDS (disabled when unset)
+    UPLOAD_SESSION_TTL_SECONDS: float = 24 * 3600
+    UPLOAD_SESSION_EXPIRE_SECONDS: Optional[int] = 3600
+    # A chunk upload holds its chunk (and blocks finalize) for at most this
+    # long, longer than B2_CALL_TIMEOUT_SECONDS
+    UPLOAD_CHUNK_LEASE_SECONDS: float = 300
 
 
 class DevConfig(GlobalConfig):
@@ -37,6 +138,8 @@ class ProdConfig(GlobalConfig):
 class TestConfig(GlobalConfig):
     DATABASE_URL: str = "sqlite:///test.db"
     DB_FORCE_ROLL_BACK: bool = True
+    BCRYPT_ROUNDS: int = 4
+    MAILGUN_BATCH_WINDOW_SECONDS: float = 0
     model_config = SettingsConfigDict(env_prefix="TEST_")
 
 
@@ -1,3 +1,5 @@
+import datetime
+
 import databases
 import sqlalchemy
 
@@ -12,6 +14,25 @@ post_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
     sqlalchemy.Column("image_url",sqlalchemy.String),
+    # Denormalized counters, kept in sync by like_post / create_comment and
+    # recomputed from the base tables by tasks.reconcile_post_counters
+    sqlalchemy.Column(
+        "like_count", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "comment_count", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    # Set by the app on insert, NULL for posts created before it existed
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+    # Time-decayed activity score, maintained by tasks.update_hot_scores
+    sqlalchemy.Column(
+        "hot_score", sqlalchemy.Float, nullable=False, server_default="0"
+    ),
+    # Lets sorting by most likes walk an index instead of sorting the table
+    sqlalchemy.Index("ix_post_like_count_id", "like_count", "id"),
+    sqlalchemy.Index("ix_post_user_id", "user_id"),
+    sqlalchemy.Index("ix_post_hot_score_id", "hot_score", "id"),
+    sqlalchemy.Index("ix_post_created_at", "created_at"),
 )
 comment_table = sqlalchemy.Table(
     "comments",
@@ -20,6 +41,10 @@ comment_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("post.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+    # Covers "comments of a post" lookups ordered by comment id
+    sqlalchemy.Index("ix_comments_post_id_id", "post_id", "id"),
+    sqlalchemy.Index("ix_comments_created_at_post_id", "created_at", "post_id"),
 )
 
 user_table = sqlalchemy.Table(
@@ -29,6 +54,10 @@ user_table = sqlalchemy.Table(
     sqlalchemy.Column("email", sqlalchemy.String, unique=True),
     sqlalchemy.Column("password", sqlalchemy.String),
     sqlalchemy.Column("confirmed", sqlalchemy.Boolean, default=False),
+    # Bumped to revoke every access token issued to the user so far
+    sqlalchemy.Column(
+        "token_version", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
 )
 like_table = sqlalchemy.Table(
     "likes",
@@ -36,7 +65,124 @@ like_table = sqlalchemy.Table(
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("post.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+    sqlalchemy.Index("ix_likes_post_id", "post_id"),
+    sqlalchemy.Index("ix_likes_created_at_post_id", "created_at", "post_id"),
+)
+# Like log segments already written to the likes table by the write-behind
+# buffer, inserted in the same transaction as the likes so a replay after a
+# crash never applies a segment twice
+like_log_segment_table = sqlalchemy.Table(
+    "like_log_segments",
+    metadata,
+    sqlalchemy.Column("segment", sqlalchemy.String, primary_key=True),
+)
+# DeepAI results by normalized prompt, see prompt_cache.py
+prompt_result_table = sqlalchemy.Table(
+    "prompt_results",
+    metadata,
+    sqlalchemy.Column("key", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("output_url", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column("last_used_at", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Index("ix_prompt_results_last_used_at", "last_used_at"),
+)
+# Durable background jobs, see jobs.py
+job_table = sqlalchemy.Table(
+    "jobs",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("payload", sqlalchemy.Text, nullable=False),
+    # pending -> running -> deleted when done, or dead after max attempts
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("attempts", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("run_at", sqlalchemy.DateTime, nullable=False),
+    # A running job whose lock expired is claimed again (worker crashed)
+    sqlalchemy.Column("locked_until", sqlalchemy.DateTime),
+    sqlalchemy.Column("last_error", sqlalchemy.Text),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Index("ix_jobs_status_run_at", "status", "run_at"),
+)
+# Version counters used for ETags, bumped by every write that changes the
+# representation of a post ("post:<id>") or of the feed ("feed")
+resource_version_table = sqlalchemy.Table(
+    "resource_versions",
+    metadata,
+    sqlalchemy.Column("key", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("version", sqlalchemy.Integer, nullable=False),
+)
+
+# Resumable chunked uploads, see upload_sessions.py
+upload_session_table = sqlalchemy.Table(
+    "upload_sessions",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column("file_name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("size", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("chunk_size", sqlalchemy.Integer, nullable=False),
+    # open -> finishing -> finished, or expired before being dropped
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    # B2 large file receiving the chunks as parts, unset for single chunk files
+    sqlalchemy.Column("b2_file_id", sqlalchemy.String),
+    sqlalchemy.Column("file_url", sqlalchemy.String),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column("finishing_at", sqlalchemy.DateTime),
+    sqlalchemy.Index("ix_upload_sessions_status_created_at", "status", "created_at"),
 )
+upload_chunk_table = sqlalchemy.Table(
+    "upload_chunks",
+    metadata,
+    sqlalchemy.Column(
+        "session_id", sqlalchemy.ForeignKey("upload_sessions.id"), primary_key=True
+    ),
+    sqlalchemy.Column("chunk_index", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("sha1", sqlalchemy.String, nullable=False),
+)
+# Chunks being uploaded, so a chunk is sent by one request at a time and a
+# session is only finalized once no chunk upload is in flight
+upload_chunk_lease_table = sqlalchemy.Table(
+    "upload_chunk_leases",
+    metadata,
+    sqlalchemy.Column(
+        "session_id", sqlalchemy.ForeignKey("upload_sessions.id"), primary_key=True
+    ),
+    sqlalchemy.Column("chunk_index", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("token", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("leased_until", sqlalchemy.DateTime, nullable=False),
+)
+
+# Uploaded files by content hash, shared by every upload of the same bytes,
+# see file_index.py
+stored_file_table = sqlalchemy.Table(
+    "stored_files",
+    metadata,
+    sqlalchemy.Column("sha256", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("file_url", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_name", sqlalchemy.String, nullable=False),
+    # Rows in file_references, the B2 file is deleted when it drops to 0
+    sqlalchemy.Column("ref_count", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime, nullable=False),
+)
+file_reference_table = sqlalchemy.Table(
+    "file_references",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column(
+        "sha256", sqlalchemy.ForeignKey("stored_files.sha256"), nullable=False
+    ),
+    sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime, nullable=False),
+)
+
+
+def utcnow() -> datetime.datetime:
+    """
+    Naive UTC timestamp for created_at columns. The databases library does not
+    run python side column defaults, so inserts pass it explicitly.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
 
 
 # SQLAlchemy engine to connect to the database
@@ -44,8 +190,8 @@ engine = sqlalchemy.create_engine(
     config.DATABASE_URL, connect_args={"check_same_thread": False}
 )
 
-# Create database tables based on metadata
-metadata.create_all(engine)
+# Tables and indexes are created by the versioned migrations in
+# social_media_app/migrations.py, applied at startup or from the command line
 
 # Async database object for interacting with the database
 database = databases.Database(
@@ -0,0 +1,156 @@
+import logging
+from typing import Optional
+
+import sqlalchemy
+from databases import Database
+from sqlalchemy.dialects.sqlite import insert
+
+from social_media_app.database import file_reference_table, stored_file_table, utcnow
+from social_media_app.storage import StoredUpload, storage
+
+logger = logging.getLogger(__name__)
+
+# Content addressed uploads
+# Every uploaded file is stored once in B2 per distinct content: its sha256,
+# computed while streaming, keys the stored_files table. An upload whose hash
+# is there reuses that file and each upload adds a row to file_references
+# (owned by the uploader) and one to the file's ref_count. Deleting an upload
+# removes its reference, and the B2 file goes only when no reference is left.
+# Taking a reference and dropping the last one are single statements on the
+# stored_files row, each in one transaction with its file_references row, so
+# a file is never deleted under a concurrent upload and ref_count always
+# matches the references.
+
+
+class StoredFileGoneError(Exception):
+    pass
+
+
+class FileIndex:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    async def find(self, database: Database, sha256: str) -> Optional[str]:
+        """
+        Return the url of the stored file with this hash, if any.
+        """
+        query = sqlalchemy.select(stored_file_table.c.file_url).where(
+            stored_file_table.c.sha256 == sha256
+        )
+        logger.debug(query)
+        file_url = await database.fetch_val(query)
+        if file_url is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return file_url
+
+    async def add_upload(
+        self, database: Database, upload: StoredUpload, file_name: str, user_id: int
+    ) -> tuple[int, str]:
+        """
+        Record `upload` for `user_id` and return the reference id and file url.
+        Raises StoredFileGoneError when the reused file was deleted meanwhile.
+        """
+        try:
+            async with database.transaction():
+                file_url = await self._take_reference(database, upload, file_name)
+                query = file_reference_table.insert().values(
+                    sha256=upload.sha256, user_id=user_id, created_at=utcnow()
+                )
+                logger.debug(query)
+                reference_id = await database.execute(query)
+        except BaseException:
+            if not upload.reused:
+                await self._delete_file(upload.url, file_name)
+            raise
+        if file_url != upload.url and not upload.reused:
+            # The same bytes were stored by a concurrent upload meanwhile
+            await self._delete_file(upload.url, file_name)
+        return reference_id, file_url
+
+    async def release(self, database: Database, reference_id: int, user_id: int) -> bool:
+        """
+        Drop an upload of `user_id`, deleting the file once nothing refers to
+        it. Returns False when there is no such upload.
+        """
+        async with database.transaction():
+            sha256 = await database.fetch_val(
+                file_reference_table.delete()
+                .where(
+                    file_reference_table.c.id == reference_id,
+                    file_reference_table.c.user_id == user_id,
+                )
+                .returning(file_reference_table.c.sha256)
+            )
+            if sha256 is None:
+                return False
+            stored_file = await database.fetch_one(
+                stored_file_table.update()
+                .where(stored_file_table.c.sha256 == sha256)
+                .values(ref_count=stored_file_table.c.ref_count - 1)
+                .returning(
+                    stored_file_table.c.file_url,
+                    stored_file_table.c.file_name,
+                    stored_file_table.c.ref_count,
+                )
+            )
+            if stored_file.ref_count > 0:
+                return True
+            await database.execute(
+                stored_file_table.delete().where(stored_file_table.c.sha256 == sha256)
+            )
+        await self._delete_file(stored_file.file_url, stored_file.file_name)
+        return True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def _take_reference(
+        self, database: Database, upload: StoredUpload, file_name: str
+    ) -> str:
+        if upload.reused:
+            query = (
+                stored_file_table.update()
+                .where(stored_file_table.c.sha256 == upload.sha256)
+                .values(ref_count=stored_file_table.c.ref_count + 1)
+                .returning(stored_file_table.c.file_url)
+            )
+            logger.debug(query)
+            file_url = await database.fetch_val(query)
+            if file_url is None:
+                raise StoredFileGoneError(f"{upload.url} was deleted")
+            return file_url
+        query = (
+            insert(stored_file_table)
+            .values(
+                sha256=upload.sha256,
+                file_url=upload.url,
+                file_name=file_name,
+                ref_count=1,
+                created_at=utcnow(),
+            )
+            .on_conflict_do_update(
+                index_elements=[stored_file_table.c.sha256],
+                set_={"ref_count": stored_file_table.c.ref_count + 1},
+            )
+            .returning(stored_file_table.c.file_url)
+        )
+        logger.debug(query)
+        return await database.fetch_val(query)
+
+    async def _delete_file(self, file_url: str, file_name: str):
+        try:
+            await storage.delete_file(file_url, file_name)
+        except Exception:
+            # Only leaves an unreferenced file in the bucket
+            logger.exception(f"Could not delete {file_url} from B2")
+
+
+file_index = FileIndex()
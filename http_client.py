@@ -0,0 +1,86 @@
+import logging
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from social_media_app.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class SharedHTTPClient:
+    """
+    One keep-alive connection pool shared by every outbound integration
+    (Mailgun, DeepAI), opened in the app lifespan. Requests go through post()
+    so they get the timeout of their host and are counted for reuse metrics.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.connections_opened = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use outside of the lifespan (scripts, workers)
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+
+    async def start(self):
+        if self._client is None:
+            self._client = self._create_client()
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def timeout_for(self, url: str) -> float:
+        host = urlsplit(url).hostname
+        return config.HTTP_CLIENT_HOST_TIMEOUTS.get(
+            host, config.HTTP_CLIENT_TIMEOUT_SECONDS
+        )
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        self.requests += 1
+        return await self.client.post(
+            url,
+            timeout=self.timeout_for(url),
+            extensions={"trace": self._trace},
+            **kwargs,
+        )
+
+    def stats(self) -> dict:
+        reused = max(self.requests - self.connections_opened, 0)
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "reuse_rate": reused / self.requests if self.requests else 0.0,
+        }
+
+    async def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+    def _create_client(self) -> httpx.AsyncClient:
+        http2 = config.HTTP_CLIENT_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.info("h2 is not installed, outbound requests use HTTP/1.1")
+                http2 = False
+        return httpx.AsyncClient(
+            http2=http2,
+            timeout=config.HTTP_CLIENT_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=config.HTTP_CLIENT_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+        )
+
+
+http_client = SharedHTTPClient()
@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+from typing import Awaitable, Callable, Optional
+
+import sqlalchemy
+from databases import Database
+
+from social_media_app import tasks
+from social_media_app.config import config
+from social_media_app.database import database, engine, job_table, utcnow
+from social_media_app.http_client import http_client
+from social_media_app.logging_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Durable job queue
+# Request handlers enqueue() jobs into the jobs table, in the same transaction
+# as the rows they refer to, and a separate worker process runs them:
+#   python -m social_media_app.jobs [work|dead|retry-dead]
+# The worker claims due jobs in batches (status running, locked_until set),
+# runs at most JOB_WORKER_CONCURRENCY of them at once and deletes them when
+# done. Failures are retried with exponential backoff, after JOB_MAX_ATTEMPTS
+# the job is kept as dead for inspection. A running job whose lock expired
+# (crashed worker) is claimed again, so handlers must be safe to repeat.
+# Jobs with a BATCH_HANDLERS entry (emails) are claimed up to
+# JOB_BULK_BATCH_SIZE at a time and run together as one job slot, so a spike
+# of them fills whole Mailgun batches instead of JOB_WORKER_CONCURRENCY sized
+# ones.
+
+PENDING = "pending"
+RUNNING = "running"
+DEAD = "dead"
+
+
+async def _send_user_registeration_emails(
+    database: Database, payloads: list[dict]
+) -> list[Optional[BaseException]]:
+    # Submitted together, so the email dispatcher coalesces them
+    return await asyncio.gather(
+        *(
+            tasks.send_user_registeration_email(
+                payload["email"], payload["confirmation_url"]
+            )
+            for payload in payloads
+        ),
+        return_exceptions=True,
+    )
+
+
+async def _generate_and_add_to_post(
+    database: Database, email: str, post_id: int, post_url: str, prompt: str
+):
+    await tasks.generate_and_add_to_post(email, post_id, post_url, database, prompt)
+
+
+# Job name -> handler(database, **payload)
+HANDLERS: dict[str, Callable[..., Awaitable]] = {
+    "generate_and_add_to_post": _generate_and_add_to_post,
+}
+# Job name -> handler(database, payloads) running many jobs at once, it
+# returns None or the exception of each job, in order
+BATCH_HANDLERS: dict[str, Callable[..., Awaitable[list]]] = {
+    "send_user_registeration_email": _send_user_registeration_emails,
+}
+
+
+async def enqueue(name: str, **payload) -> int:
+    """
+    Add a job running HANDLERS[name] with the json serializable `payload`.
+    Call it inside the transaction writing the rows the job refers to.
+    """
+    if name not in HANDLERS and name not in BATCH_HANDLERS:
+        raise ValueError(f"Unknown job {name}")
+    now = utcnow()
+    query = job_table.insert().values(
+        name=name,
+        payload=json.dumps(payload),
+        status=PENDING,
+        attempts=0,
+        run_at=now,
+        created_at=now,
+    )
+    logger.debug(query)
+    return await database.execute(query)
+
+
+def retry_delay(attempts: int) -> float:
+    return min(
+        config.JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+        config.JOB_RETRY_MAX_SECONDS,
+    )
+
+
+async def claim_jobs(
+    database: Database,
+    limit: int,
+    names: Optional[list[str]] = None,
+    exclude: Optional[list[str]] = None,
+) -> list:
+    """
+    Mark up to `limit` due jobs as running and return them, only those named
+    in `names` / not in `exclude` when given. One UPDATE ... RETURNING
+    statement, so two workers can never claim the same job.
+    """
+    now = utcnow()
+    due = (
+        sqlalchemy.select(job_table.c.id)
+        .where(
+            sqlalchemy.or_(
+                sqlalchemy.and_(
+                    job_table.c.status == PENDING, job_table.c.run_at <= now
+                ),
+                sqlalchemy.and_(
+                    job_table.c.status == RUNNING, job_table.c.locked_until < now
+                ),
+            )
+        )
+        .order_by(job_table.c.run_at)
+        .limit(limit)
+    )
+    if names is not None:
+        due = due.where(job_table.c.name.in_(names))
+    if exclude:
+        due = due.where(job_table.c.name.not_in(exclude))
+    query = (
+        job_table.update()
+        .where(job_table.c.id.in_(due))
+        .values(
+            status=RUNNING,
+            attempts=job_table.c.attempts + 1,
+            locked_until=now
+            + datetime.timedelta(seconds=config.JOB_VISIBILITY_TIMEOUT_SECONDS),
+        )
+        .returning(*job_table.c)
+    )
+    logger.debug(query)
+    return await database.fetch_all(query)
+
+
+class JobWorker:
+    def __init__(
+        self,
+        database: Database,
+        concurrency: int = config.JOB_WORKER_CONCURRENCY,
+        batch_size: int = config.JOB_BATCH_SIZE,
+        poll_interval: float = config.JOB_POLL_SECONDS,
+        bulk_batch_size: int = config.JOB_BULK_BATCH_SIZE,
+    ):
+        self.database = database
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.bulk_batch_size = bulk_batch_size
+        self._running: set[asyncio.Task] = set()
+
+    async def run(self):
+        logger.info(f"Job worker started, concurrency {self.concurrency}")
+        while True:
+            runs, more_due = await self._claim(self.concurrency - len(self._running))
+            for run in runs:
+                task = asyncio.create_task(run)
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            if more_due and len(self._running) < self.concurrency:
+                continue  # More jobs are probably due
+            if self._running:
+                await asyncio.wait(
+                    set(self._running),
+                    timeout=self.poll_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    async def run_once(self) -> int:
+        """
+        Claim one batch of due jobs, run it to completion and return its size.
+        """
+        runs, _ = await self._claim(self.concurrency)
+        return sum(await asyncio.gather(*runs))
+
+    async def _claim(self, free: int) -> tuple[list[Awaitable[int]], bool]:
+        """
+        Claim due jobs for up to `free` slots. Returns one awaitable per slot,
+        resolving to its number of jobs, and whether more jobs may be due.
+        """
+        runs = []
+        more_due = False
+        for name in BATCH_HANDLERS:
+            if len(runs) >= free:
+                break
+            jobs = await claim_jobs(self.database, self.bulk_batch_size, names=[name])
+            if jobs:
+                runs.append(self.run_batch(name, jobs))
+                more_due = more_due or len(jobs) == self.bulk_batch_size
+        if len(runs) < free:
+            jobs = await claim_jobs(
+                self.database,
+                min(free - len(runs), self.batch_size),
+                exclude=list(BATCH_HANDLERS),
+            )
+            runs.extend(self.run_job(job) for job in jobs)
+            more_due = more_due or len(jobs) == self.batch_size
+        return runs, more_due
+
+    async def stop(self):
+        # Interrupted jobs keep their lock and are claimed again once it expires
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def run_batch(self, name: str, jobs: list) -> int:
+        logger.debug(f"Running {len(jobs)} {name} jobs")
+        try:
+            errors = await asyncio.wait_for(
+                BATCH_HANDLERS[name](
+                    self.database, [json.loads(job.payload) for job in jobs]
+                ),
+                timeout=config.JOB_VISIBILITY_TIMEOUT_SECONDS,
+            )
+        except Exception as e:
+            errors = [e] * len(jobs)
+        for job, error in zip(jobs, errors):
+            if error is not None:
+                await self._failed(job, error)
+        done = [job.id for job, error in zip(jobs, errors) if error is None]
+        if done:
+            await self.database.execute(
+                job_table.delete().where(job_table.c.id.in_(done))
+            )
+        return len(jobs)
+
+    async def run_job(self, job) -> int:
+        logger.debug(f"Running job {job.id} {job.name}, attempt {job.attempts}")
+        try:
+            handler = HANDLERS.get(job.name)
+            if handler is None:
+                raise LookupError(f"Unknown job {job.name}")
+            await asyncio.wait_for(
+                handler(self.database, **json.loads(job.payload)),
+                timeout=config.JOB_VISIBILITY_TIMEOUT_SECONDS,
+            )
+        except Exception as e:
+            await self._failed(job, e)
+            return 1
+        await self.database.execute(job_table.delete().where(job_table.c.id == job.id))
+        return 1
+
+    async def _failed(self, job, error: Exception):
+        error = f"{type(error).__name__}: {error}"
+        values = {"status": PENDING, "locked_until": None, "last_error": error}
+        if job.attempts >= config.JOB_MAX_ATTEMPTS:
+            logger.error(f"Job {job.id} {job.name} is dead after {job.attempts} attempts: {error}")
+            values["status"] = DEAD
+        else:
+            delay = retry_delay(job.attempts)
+            logger.warning(f"Job {job.id} {job.name} failed, retrying in {delay}s: {error}")
+            values["run_at"] = utcnow() + datetime.timedelta(seconds=delay)
+        await self.database.execute(
+            job_table.update().where(job_table.c.id == job.id).values(values)
+        )
+
+
+async def work():
+    configure_logging()
+    await database.connect()
+    await http_client.start()
+    worker = JobWorker(database)
+    try:
+        await worker.run()
+    finally:
+        await worker.stop()
+        await http_client.stop()
+        await database.disconnect()
+
+
+def list_dead_jobs():
+    query = job_table.select().where(job_table.c.status == DEAD).order_by(job_table.c.id)
+    with engine.connect() as connection:
+        for job in connection.execute(query):
+            print(f"{job.id}\t{job.name}\t{job.attempts}\t{job.last_error}")
+
+
+def retry_dead_jobs() -> int:
+    query = (
+        job_table.update()
+        .where(job_table.c.status == DEAD)
+        .values(status=PENDING, attempts=0, run_at=utcnow())
+    )
+    with engine.begin() as connection:
+        return connection.execute(query).rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Background job worker")
+    parser.add_argument(
+        "command", choices=["work", "dead", "retry-dead"], nargs="?", default="work"
+    )
+    args = parser.parse_args()
+    if args.command == "dead":
+        list_dead_jobs()
+    elif args.command == "retry-dead":
+        print(f"Requeued {retry_dead_jobs()} dead jobs")
+    else:
+        try:
+            asyncio.run(work())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
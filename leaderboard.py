@@ -0,0 +1,95 @@
+import logging
+from bisect import bisect_left, bisect_right, insort
+from typing import Optional
+
+import sqlalchemy
+from databases import Database
+
+from social_media_app.config import config
+from social_media_app.database import post_table
+
+logger = logging.getLogger(__name__)
+
+
+class TopKLeaderboard:
+    """
+    The K most liked posts, kept in memory so the first pages of the
+    most_likes feed do not ask the database to rank every post.
+
+    Entries are kept in a sorted list of (-likes, -post_id) keys, i.e. in
+    feed order (likes desc, id desc), with bisect for O(log K) lookups.
+    Likes recorded by this worker are applied immediately, likes handled by
+    other workers show up at the next seed() (see LEADERBOARD_RESYNC_SECONDS).
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.seeded = False
+        # True when the board holds every post, so it can answer any page
+        self.complete = False
+        self._keys: list[tuple[int, int]] = []
+        self._likes: dict[int, int] = {}
+
+    async def seed(self, database: Database):
+        query = (
+            sqlalchemy.select(post_table.c.id, post_table.c.like_count)
+            .order_by(post_table.c.like_count.desc(), post_table.c.id.desc())
+            .limit(self.k)
+        )
+        logger.debug(query)
+        rows = await database.fetch_all(query)
+        self._likes = {row.id: row.like_count for row in rows}
+        self._keys = sorted((-likes, -post_id) for post_id, likes in self._likes.items())
+        self.complete = len(rows) < self.k
+        self.seeded = True
+        logger.debug(f"Seeded most liked leaderboard with {len(rows)} posts")
+
+    def reset(self):
+        self.seeded = False
+        self.complete = False
+        self._keys = []
+        self._likes = {}
+
+    def record(self, post_id: int, likes: int):
+        """
+        Set the like count of `post_id`, adding it if it now ranks in the top K.
+        """
+        if not self.seeded:
+            return
+        old_likes = self._likes.pop(post_id, None)
+        if old_likes is not None:
+            del self._keys[bisect_left(self._keys, (-old_likes, -post_id))]
+        key = (-likes, -post_id)
+        if len(self._keys) >= self.k and key > self._keys[-1]:
+            return
+        insort(self._keys, key)
+        self._likes[post_id] = likes
+        if len(self._keys) > self.k:
+            _, evicted = self._keys.pop()
+            del self._likes[-evicted]
+            self.complete = False
+
+    def page(
+        self, limit: int, after: Optional[tuple[int, int]] = None
+    ) -> Optional[list[tuple[int, int]]]:
+        """
+        Up to `limit + 1` (post_id, likes) entries following the (likes, id)
+        cursor `after`, or None when the page reaches past the board and has
+        to come from the database.
+        """
+        if not self.seeded:
+            return None
+        start = 0
+        if after is not None:
+            likes, post_id = after
+            start = bisect_right(self._keys, (-likes, -post_id))
+        keys = self._keys[start : start + limit + 1]
+        if len(keys) < limit + 1 and not self.complete:
+            return None
+        return [(-post_id, -likes) for likes, post_id in keys]
+
+    def stats(self) -> dict:
+        return {"size": len(self._keys), "k": self.k, "complete": self.complete}
+
+
+most_liked_posts = TopKLeaderboard(config.LEADERBOARD_SIZE)
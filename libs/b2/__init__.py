@@ -1,5 +1,8 @@
+import hashlib
+import io
 import logging
 from functools import lru_cache
+from urllib.parse import parse_qs, urlsplit
 
 import b2sdk.v2 as b2
 
@@ -13,23 +16,79 @@ def b2_api():
     logger.debug("Creating and authorizing b2 API")
     info = b2.InMemoryAccountInfo()
     b2_api = b2.B2Api(info)
-    b2_api.authorize_account("production", config.B2_KEY_ID, config.B2_APPLICATION_KEY)
+    b2_authorize(b2_api)
     return b2_api
 
 
+def b2_authorize(api: b2.B2Api):
+    # Also used to renew the auth token (valid 24 hours) ahead of its expiry
+    api.authorize_account("production", config.B2_KEY_ID, config.B2_APPLICATION_KEY)
+
+
 @lru_cache
 def b2_get_bucket(api: b2.B2Api):
     return api.get_bucket_by_name(config.B2_BUCKET_NAME)
 
 
-def b2_upload_file(local_file: str, file_name: str) -> str:
+def b2_warm_up():
+    """
+    Authorize and look up the bucket, so the first upload does not have to.
+    """
+    b2_get_bucket(b2_api())
+
+
+def b2_refresh_authorization():
+    logger.debug("Refreshing b2 authorization")
+    b2_authorize(b2_api())
+
+
+def b2_upload_bytes(data: bytes, file_name: str) -> str:
     api = b2_api()
-    logger.debug(f"Uploading {local_file} to {file_name}")
-    uploaded_file = b2_get_bucket(api).upload_local_file(
-        local_file=local_file, file_name=file_name
-    )
+    logger.debug(f"Uploading {len(data)} bytes to {file_name}")
+    uploaded_file = b2_get_bucket(api).upload_bytes(data, file_name)
     download_url = api.get_download_url_for_fileid(uploaded_file.id_)
     logger.debug(
-        f"Uploaded {local_file} to B2 sucessfuelly and got download url {download_url}"
+        f"Uploaded {file_name} to B2 sucessfuelly and got download url {download_url}"
     )
     return download_url
+
+
+# Large files are uploaded in parts (5 MB minimum except for the last one),
+# possibly in parallel, and assembled by finish_large_file
+
+
+def b2_start_large_file(file_name: str) -> str:
+    api = b2_api()
+    bucket = b2_get_bucket(api)
+    response = api.session.start_large_file(bucket.id_, file_name, "b2/x-auto", {})
+    logger.debug(f"Started large file {response['fileId']} for {file_name}")
+    return response["fileId"]
+
+
+def b2_upload_part(file_id: str, part_number: int, data: bytes) -> str:
+    sha1 = hashlib.sha1(data).hexdigest()
+    b2_api().session.upload_part(
+        file_id, part_number, len(data), sha1, io.BytesIO(data)
+    )
+    logger.debug(f"Uploaded part {part_number} ({len(data)} bytes) of {file_id}")
+    return sha1
+
+
+def b2_finish_large_file(file_id: str, part_sha1s: list[str]) -> str:
+    api = b2_api()
+    api.session.finish_large_file(file_id, part_sha1s)
+    download_url = api.get_download_url_for_fileid(file_id)
+    logger.debug(f"Finished large file {file_id} and got download url {download_url}")
+    return download_url
+
+
+def b2_cancel_large_file(file_id: str):
+    b2_api().session.cancel_large_file(file_id)
+    logger.debug(f"Cancelled large file {file_id}")
+
+
+def b2_delete_file(file_url: str, file_name: str):
+    # Download urls come from get_download_url_for_fileid and carry the file id
+    file_id = parse_qs(urlsplit(file_url).query)["fileId"][0]
+    b2_api().delete_file_version(file_id, file_name)
+    logger.debug(f"Deleted {file_name} ({file_id}) from B2")
@@ -0,0 +1,279 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import pathlib
+import threading
+import uuid
+from collections import Counter
+from typing import Optional
+
+from databases import Database
+
+from social_media_app.config import config
+from social_media_app.database import (
+    like_log_segment_table,
+    like_table,
+    post_table,
+    utcnow,
+)
+from social_media_app.versions import FEED, bump_versions, post_key
+
+logger = logging.getLogger(__name__)
+
+# Write-behind buffer for likes
+# Life cycle of a like when LIKE_WRITE_BEHIND is on:
+# 1- like_post appends it to the worker's log segment and acknowledges once it
+#    is fsynced. Likes arriving within LIKE_WRITE_BEHIND_GROUP_COMMIT_SECONDS
+#    share one fsync (group commit), run in a thread off the event loop
+# 2- it waits in memory, counted by pending_likes() so reads still see it
+# 3- on a size or time trigger the current segment is closed and every pending
+#    like is inserted in one transaction together with the segment name, and
+#    the versions of the liked posts and of the feed are bumped
+# 4- the segment file is deleted
+# On startup, segments left behind by a crashed worker are replayed unless
+# their name is already in like_log_segments.
+
+
+class LogSegment:
+    """
+    Append-only file of likes, one json line per like. The file is flock'ed
+    while open so other workers know it is not orphaned. sync() runs on a
+    thread, it and remove() hold `_lock` so the fd is never closed (and maybe
+    reused) under an fsync.
+    """
+
+    def __init__(self, path: pathlib.Path, fsync: bool = True):
+        import fcntl
+
+        self.path = path
+        self.name = path.stem
+        self.fsync = fsync
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.closed = False
+        self._lock = threading.Lock()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.fd)
+            raise
+
+    def append(self, like: dict):
+        os.write(self.fd, (json.dumps(like) + "\n").encode())
+
+    def sync(self):
+        with self._lock:
+            # A removed segment was flushed to the database, nothing to make durable
+            if not self.closed:
+                os.fsync(self.fd)
+
+    def read(self) -> list[dict]:
+        likes = []
+        for line in self.path.read_text().splitlines():
+            try:
+                likes.append(json.loads(line))
+            except ValueError:
+                # A torn last line was never fsynced, so never acknowledged
+                logger.warning(f"Skipping corrupt line in like log {self.name}")
+        return likes
+
+    def remove(self):
+        with self._lock:
+            self.path.unlink(missing_ok=True)
+            self.closed = True
+            os.close(self.fd)
+
+
+class LikeWriteBehindBuffer:
+    def __init__(
+        self,
+        log_dir: pathlib.Path,
+        max_pending: int,
+        flush_interval: float,
+        fsync: bool = True,
+        group_commit_delay: float = 0.002,
+    ):
+        self.log_dir = log_dir
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.group_commit_delay = group_commit_delay
+        self.database: Optional[Database] = None
+        self._pending: list[dict] = []
+        self._pending_counts: Counter = Counter()
+        self._flushing_counts: Counter = Counter()
+        self._segment: Optional[LogSegment] = None
+        self._closed_segments: list[LogSegment] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_requested = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._unsynced: set[LogSegment] = set()
+        self._next_sync: Optional[asyncio.Future] = None
+        self._sync_tasks: set[asyncio.Task] = set()
+
+    async def start(self, database: Database):
+        self.database = database
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        await self.replay()
+        self._segment = self._new_segment()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self._segment and not self._pending:
+            self._segment.remove()
+            self._segment = None
+
+    async def add(self, post_id: int, user_id: int):
+        like = {
+            "post_id": post_id,
+            "user_id": user_id,
+            "created_at": utcnow().isoformat(),
+        }
+        segment = self._segment
+        segment.append(like)
+        self._pending.append(like)
+        self._pending_counts[post_id] += 1
+        if len(self._pending) >= self.max_pending:
+            self._flush_requested.set()
+        if self.fsync:
+            await self._synced(segment)
+
+    def pending_likes(self, post_id: int) -> int:
+        """
+        Likes acknowledged for `post_id` that are not in the likes table yet.
+        """
+        return self._pending_counts[post_id] + self._flushing_counts[post_id]
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            likes, counts = self._pending, self._pending_counts
+            self._pending, self._pending_counts = [], Counter()
+            self._flushing_counts = counts
+            self._closed_segments.append(self._segment)
+            self._segment = self._new_segment()
+            segments = self._closed_segments
+            try:
+                await self._write(likes, counts, [segment.name for segment in segments])
+            except Exception:
+                # The closed segments still hold these likes, retry next flush
+                self._pending = likes + self._pending
+                self._pending_counts = counts + self._pending_counts
+                raise
+            finally:
+                self._flushing_counts = Counter()
+            self._closed_segments = []
+            await self._remove_segments(segments)
+            logger.debug(f"Flushed {len(likes)} buffered likes")
+
+    async def replay(self):
+        for path in sorted(self.log_dir.glob("*.log")):
+            try:
+                segment = LogSegment(path, self.fsync)
+            except BlockingIOError:
+                continue  # Owned by a running worker
+            query = like_log_segment_table.select().where(
+                like_log_segment_table.c.segment == segment.name
+            )
+            if await self.database.fetch_one(query) is None:
+                likes = segment.read()
+                logger.info(f"Replaying {len(likes)} likes from like log {segment.name}")
+                counts = Counter(like["post_id"] for like in likes)
+                await self._write(likes, counts, [segment.name])
+            await self._remove_segments([segment])
+
+    async def _write(self, likes: list[dict], counts: Counter, segments: list[str]):
+        async with self.database.transaction():
+            for like in likes:
+                created_at = like.get("created_at")
+                await self.database.execute(
+                    like_table.insert().values(
+                        post_id=like["post_id"],
+                        user_id=like["user_id"],
+                        created_at=created_at
+                        and datetime.datetime.fromisoformat(created_at),
+                    )
+                )
+            for post_id, count in counts.items():
+                await self.database.execute(
+                    post_table.update()
+                    .where(post_table.c.id == post_id)
+                    .values(like_count=post_table.c.like_count + count)
+                )
+            await bump_versions(*(post_key(post_id) for post_id in counts), FEED)
+            for segment in segments:
+                await self.database.execute(
+                    like_log_segment_table.insert().values(segment=segment)
+                )
+
+    async def _remove_segments(self, segments: list[LogSegment]):
+        for segment in segments:
+            # Waits for an fsync of the segment in progress, off the event loop
+            await asyncio.to_thread(segment.remove)
+        # The files are gone, so the markers can not be needed for a replay
+        await self.database.execute(
+            like_log_segment_table.delete().where(
+                like_log_segment_table.c.segment.in_(
+                    [segment.name for segment in segments]
+                )
+            )
+        )
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_requested.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered likes")
+
+    async def _synced(self, segment: LogSegment):
+        """
+        Wait for the next group fsync, which covers everything appended so far.
+        """
+        self._unsynced.add(segment)
+        if self._next_sync is None:
+            self._next_sync = asyncio.get_running_loop().create_future()
+            task = asyncio.create_task(self._group_sync(self._next_sync))
+            self._sync_tasks.add(task)
+            task.add_done_callback(self._sync_tasks.discard)
+        await asyncio.shield(self._next_sync)
+
+    async def _group_sync(self, done: asyncio.Future):
+        await asyncio.sleep(self.group_commit_delay)
+        # Likes appended from here on wait for the next fsync
+        segments, self._unsynced = self._unsynced, set()
+        self._next_sync = None
+        try:
+            for segment in segments:
+                await asyncio.to_thread(segment.sync)
+        except Exception as e:
+            logger.exception("Failed to fsync the like log")
+            done.set_exception(e)
+            done.exception()  # Retrieved here when every waiter is gone
+        else:
+            done.set_result(None)
+
+    def _new_segment(self) -> LogSegment:
+        return LogSegment(self.log_dir / f"likes-{uuid.uuid4().hex}.log", self.fsync)
+
+
+like_buffer = LikeWriteBehindBuffer(
+    pathlib.Path(config.LIKE_WRITE_BEHIND_LOG_DIR),
+    max_pending=config.LIKE_WRITE_BEHIND_MAX_PENDING,
+    flush_interval=config.LIKE_WRITE_BEHIND_FLUSH_SECONDS,
+    fsync=config.LIKE_WRITE_BEHIND_FSYNC,
+    group_commit_delay=config.LIKE_WRITE_BEHIND_GROUP_COMMIT_SECONDS,
+)
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 
@@ -5,13 +6,28 @@ from asgi_correlation_id import CorrelationIdMiddleware
 from fastapi import FastAPI, HTTPException
 from fastapi.exception_handlers import http_exception_handler
 
-from social_media_app.database import database
+from social_media_app.config import config
+from social_media_app.database import database, engine
+from social_media_app.http_client import http_client
+from social_media_app.jobs import JobWorker
+from social_media_app.leaderboard import most_liked_posts
+from social_media_app.like_buffer import like_buffer
 from social_media_app.logging_config import configure_logging
+from social_media_app.migrations import migrate
+from social_media_app.security import token_deny_list
+from social_media_app.storage import storage
 
 # Regestring endpoints
+from social_media_app.routers.metrics import router as metrics_router
 from social_media_app.routers.post import router as post_router
 from social_media_app.routers.upload import router as upload_router
 from social_media_app.routers.user import router as user_router
+from social_media_app.tasks import (
+    reconcile_post_counters,
+    run_periodically,
+    update_hot_scores,
+)
+from social_media_app.upload_sessions import expire_sessions
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +35,76 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     configure_logging()
+    migrate(engine)
     await database.connect()
+    await http_client.start()
+    await storage.start()
+    if config.LIKE_WRITE_BEHIND:
+        await like_buffer.start(database)
+    await most_liked_posts.seed(database)
+    await token_deny_list.sync(database)
+    periodic_tasks = []
+    if config.POST_COUNTERS_RECONCILE_SECONDS:
+        periodic_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    config.POST_COUNTERS_RECONCILE_SECONDS,
+                    reconcile_post_counters,
+                    database,
+                )
+            )
+        )
+    if config.HOT_SCORE_UPDATE_SECONDS:
+        periodic_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    config.HOT_SCORE_UPDATE_SECONDS, update_hot_scores, database
+                )
+            )
+        )
+    if config.LEADERBOARD_RESYNC_SECONDS:
+        periodic_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    config.LEADERBOARD_RESYNC_SECONDS, most_liked_posts.seed, database
+                )
+            )
+        )
+    if config.TOKEN_DENY_LIST_SYNC_SECONDS:
+        periodic_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    config.TOKEN_DENY_LIST_SYNC_SECONDS, token_deny_list.sync, database
+                )
+            )
+        )
+    if config.B2_AUTH_REFRESH_SECONDS:
+        periodic_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    config.B2_AUTH_REFRESH_SECONDS, storage.refresh_authorization
+                )
+            )
+        )
+    if config.UPLOAD_SESSION_EXPIRE_SECONDS:
+        periodic_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    config.UPLOAD_SESSION_EXPIRE_SECONDS, expire_sessions, database
+                )
+            )
+        )
+    job_worker = JobWorker(database) if config.JOB_WORKER_IN_APP else None
+    if job_worker:
+        periodic_tasks.append(asyncio.create_task(job_worker.run()))
     yield
+    for task in periodic_tasks:
+        task.cancel()
+    if job_worker:
+        await job_worker.stop()
+    if config.LIKE_WRITE_BEHIND:
+        await like_buffer.stop()
+    await http_client.stop()
     await database.disconnect()
 
 
@@ -30,6 +114,7 @@ app.add_middleware(CorrelationIdMiddleware)
 app.include_router(post_router)
 app.include_router(user_router)
 app.include_router(upload_router)
+app.include_router(metrics_router)
 
 
 @app.exception_handler(HTTPException)
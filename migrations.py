@@ -0,0 +1,217 @@
+import argparse
+import datetime
+import logging
+from typing import Callable, NamedTuple
+
+import sqlalchemy
+
+from social_media_app.database import (
+    comment_table,
+    engine,
+    file_reference_table,
+    job_table,
+    like_log_segment_table,
+    like_table,
+    post_table,
+    prompt_result_table,
+    resource_version_table,
+    stored_file_table,
+    upload_chunk_lease_table,
+    upload_chunk_table,
+    upload_session_table,
+    user_table,
+)
+from social_media_app.search import REBUILD_STATEMENT, create_search_index
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema migrations
+# Every migration runs once, in order, inside its own transaction and records
+# its version in the schema_version table. Steps are written to be idempotent
+# (checkfirst / column checks) because a fresh database gets tables created
+# from the current metadata by the first migration.
+# Usage: python -m social_media_app.migrations [upgrade|current]
+
+migration_metadata = sqlalchemy.MetaData()
+schema_version_table = sqlalchemy.Table(
+    "schema_version",
+    migration_metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    upgrade: Callable[[sqlalchemy.Connection], None]
+
+
+def _create_tables(connection: sqlalchemy.Connection, *tables: sqlalchemy.Table):
+    for table in tables:
+        table.create(connection, checkfirst=True)
+
+
+def _create_indexes(connection: sqlalchemy.Connection, *names: str):
+    indexes = {
+        index.name: index
+        for table in (post_table, comment_table, user_table, like_table)
+        for index in table.indexes
+    }
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+def _add_column(connection: sqlalchemy.Connection, table: str, column: str, ddl: str):
+    columns = sqlalchemy.inspect(connection).get_columns(table)
+    if column not in {existing["name"] for existing in columns}:
+        connection.execute(
+            sqlalchemy.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        )
+
+
+def _initial_schema(connection: sqlalchemy.Connection):
+    _create_tables(connection, user_table, post_table, comment_table, like_table)
+
+
+def _post_counters(connection: sqlalchemy.Connection):
+    _add_column(connection, "post", "like_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(connection, "post", "comment_count", "INTEGER NOT NULL DEFAULT 0")
+    connection.execute(
+        sqlalchemy.text(
+            "UPDATE post SET"
+            " like_count = (SELECT count(likes.id) FROM likes"
+            " WHERE likes.post_id = post.id),"
+            " comment_count = (SELECT count(comments.id) FROM comments"
+            " WHERE comments.post_id = post.id)"
+        )
+    )
+    _create_indexes(connection, "ix_post_like_count_id")
+
+
+def _secondary_indexes(connection: sqlalchemy.Connection):
+    # users.email is already indexed by its unique constraint
+    _create_indexes(
+        connection, "ix_comments_post_id_id", "ix_likes_post_id", "ix_post_user_id"
+    )
+
+
+def _like_log_segments(connection: sqlalchemy.Connection):
+    _create_tables(connection, like_log_segment_table)
+
+
+def _resource_versions(connection: sqlalchemy.Connection):
+    _create_tables(connection, resource_version_table)
+
+
+def _post_search_index(connection: sqlalchemy.Connection):
+    create_search_index(connection)
+    connection.execute(sqlalchemy.text(REBUILD_STATEMENT))
+
+
+def _activity_timestamps_and_hot_score(connection: sqlalchemy.Connection):
+    for table in ("post", "comments", "likes"):
+        _add_column(connection, table, "created_at", "DATETIME")
+    _add_column(connection, "post", "hot_score", "FLOAT NOT NULL DEFAULT 0")
+    _create_indexes(
+        connection,
+        "ix_post_hot_score_id",
+        "ix_post_created_at",
+        "ix_comments_created_at_post_id",
+        "ix_likes_created_at_post_id",
+    )
+
+
+def _user_token_version(connection: sqlalchemy.Connection):
+    _add_column(connection, "users", "token_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _jobs(connection: sqlalchemy.Connection):
+    _create_tables(connection, job_table)
+
+
+def _prompt_results(connection: sqlalchemy.Connection):
+    _create_tables(connection, prompt_result_table)
+
+
+def _upload_sessions(connection: sqlalchemy.Connection):
+    _create_tables(connection, upload_session_table, upload_chunk_table)
+
+
+def _stored_files(connection: sqlalchemy.Connection):
+    _create_tables(connection, stored_file_table, file_reference_table)
+
+
+def _upload_chunk_leases(connection: sqlalchemy.Connection):
+    _add_column(connection, "upload_sessions", "finishing_at", "DATETIME")
+    _create_tables(connection, upload_chunk_lease_table)
+
+
+MIGRATIONS = [
+    Migration(1, "initial_schema", _initial_schema),
+    Migration(2, "post_counters", _post_counters),
+    Migration(3, "secondary_indexes", _secondary_indexes),
+    Migration(4, "like_log_segments", _like_log_segments),
+    Migration(5, "resource_versions", _resource_versions),
+    Migration(6, "post_search_index", _post_search_index),
+    Migration(
+        7, "activity_timestamps_and_hot_score", _activity_timestamps_and_hot_score
+    ),
+    Migration(8, "user_token_version", _user_token_version),
+    Migration(9, "jobs", _jobs),
+    Migration(10, "prompt_results", _prompt_results),
+    Migration(11, "upload_sessions", _upload_sessions),
+    Migration(12, "stored_files", _stored_files),
+    Migration(13, "upload_chunk_leases", _upload_chunk_leases),
+]
+
+
+def current_version(engine: sqlalchemy.Engine) -> int:
+    with engine.begin() as connection:
+        schema_version_table.create(connection, checkfirst=True)
+        version = connection.execute(
+            sqlalchemy.select(sqlalchemy.func.max(schema_version_table.c.version))
+        ).scalar()
+    return version or 0
+
+
+def migrate(engine: sqlalchemy.Engine) -> list[int]:
+    """
+    Apply every migration newer than the database's schema version and return
+    the versions that were applied.
+    """
+    version = current_version(engine)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        logger.info(f"Applying migration {migration.version} {migration.name}")
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(
+                schema_version_table.insert().values(
+                    version=migration.version,
+                    name=migration.name,
+                    applied_at=datetime.datetime.now(datetime.timezone.utc),
+                )
+            )
+        applied.append(migration.version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument(
+        "command", choices=["upgrade", "current"], nargs="?", default="upgrade"
+    )
+    args = parser.parse_args()
+    if args.command == "current":
+        print(current_version(engine))
+        return
+    applied = migrate(engine)
+    print(f"Applied migrations: {applied}" if applied else "Database is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,10 @@ class UserPostwithLikes(UserPost):
     )  # ORM mode "pydantic to be able to handle sql objects"
 
 
+class PostSearchResult(UserPost):
+    snippet: str  # Matching part of the body as HTML, matches wrapped in <mark>
+
+
 class CommentIn(BaseModel):
     body: str
     post_id: int
@@ -43,7 +47,9 @@ class Comment(CommentIn):
 
 class UserPostWithComments(BaseModel):
     post: UserPostwithLikes
-    comments: list[Comment]
+    comments: list[Comment]  # First page only
+    comments_total: int = 0
+    comments_next_cursor: Optional[str] = None
 
 
 {
@@ -57,5 +63,12 @@ class PostLikeIn(BaseModel):
 
 
 class PostLike(PostLikeIn):
-    id: int
+    id: Optional[int] = None  # None while buffered by the like write-behind
     user_id: int
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    status_code: int
+    id: Optional[int] = None
+    detail: Optional[str] = None
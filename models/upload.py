@@ -0,0 +1,22 @@
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class UploadSessionIn(BaseModel):
+    file_name: str = Field(min_length=1)
+    size: int = Field(gt=0)  # Total size of the file in bytes
+
+
+class UploadSession(BaseModel):
+    id: str
+    file_name: str
+    size: int
+    # Every chunk but the last one is exactly chunk_size bytes, chunk i starts
+    # at offset i * chunk_size
+    chunk_size: int
+    chunk_count: int
+    status: str
+    missing_chunks: list[int]
+    missing_ranges: list[tuple[int, int]]  # [start, end) byte ranges
+    file_url: Optional[str] = None
@@ -10,3 +10,13 @@ class User(BaseModel):
 
 class UserIn(User):
     password: str
+
+
+class AuthenticatedUser(BaseModel):
+    """
+    The user behind an access token, built from the token's claims.
+    """
+
+    id: int
+    email: str
+    confirmed: bool = False
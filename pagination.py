@@ -0,0 +1,39 @@
+import base64
+import binascii
+import json
+import logging
+
+from fastapi import HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Keyset (cursor) pagination
+# The cursor is the sort key of the last row of a page, so the next page is
+# fetched with "WHERE key < last key ORDER BY key LIMIT n" which is an index
+# range scan instead of an OFFSET walk over every previous row.
+# Cursors are opaque to clients: url safe base64 of a small json object.
+
+
+def encode_cursor(values: dict) -> str:
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError) as e:
+        raise invalid_cursor_exception() from e
+    if not isinstance(values, dict):
+        raise invalid_cursor_exception()
+    return values
+
+
+def invalid_cursor_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor"
+    )
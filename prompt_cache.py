@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import unicodedata
+from typing import Awaitable, Callable, Optional
+
+import sqlalchemy
+from databases import Database
+from sqlalchemy.dialects.sqlite import insert
+
+from social_media_app.config import config
+from social_media_app.database import prompt_result_table, utcnow
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Prompts differing only in case, unicode form or whitespace share a result.
+    """
+    return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()
+
+
+class PromptResultCache:
+    """
+    Persistent prompt -> generated image url cache in the prompt_results table,
+    bounded to `max_entries` by evicting the least recently used prompts, with
+    entries older than `ttl` treated as missing. A hit records its use at most
+    once per `touch_interval`, so most hits are a read only.
+
+    get_or_generate() also coalesces identical prompts being generated by this
+    process, so concurrent posts with the same prompt make one external call.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, touch_interval: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    async def get(self, database: Database, prompt: str) -> Optional[str]:
+        key = prompt_key(prompt)
+        now = utcnow()
+        query = prompt_result_table.select().where(
+            prompt_result_table.c.key == key,
+            prompt_result_table.c.created_at
+            >= now - datetime.timedelta(seconds=self.ttl),
+        )
+        logger.debug(query)
+        row = await database.fetch_one(query)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if row.last_used_at < now - datetime.timedelta(seconds=self.touch_interval):
+            await database.execute(
+                prompt_result_table.update()
+                .where(prompt_result_table.c.key == key)
+                .values(last_used_at=now)
+            )
+        return row.output_url
+
+    async def set(self, database: Database, prompt: str, output_url: str):
+        now = utcnow()
+        query = (
+            insert(prompt_result_table)
+            .values(
+                key=prompt_key(prompt),
+                output_url=output_url,
+                created_at=now,
+                last_used_at=now,
+            )
+            .on_conflict_do_update(
+                index_elements=[prompt_result_table.c.key],
+                set_={"output_url": output_url, "created_at": now, "last_used_at": now},
+            )
+        )
+        await database.execute(query)
+        recent = (
+            sqlalchemy.select(prompt_result_table.c.key)
+            .order_by(prompt_result_table.c.last_used_at.desc())
+            .limit(self.max_entries)
+        )
+        await database.execute(
+            prompt_result_table.delete().where(prompt_result_table.c.key.not_in(recent))
+        )
+
+    async def get_or_generate(
+        self,
+        database: Database,
+        prompt: str,
+        generate: Callable[[str], Awaitable[str]],
+    ) -> str:
+        output_url = await self.get(database, prompt)
+        if output_url is not None:
+            return output_url
+
+        key = prompt_key(prompt)
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            output_url = await generate(prompt)
+            await self.set(database, prompt, output_url)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved here when nobody else was waiting
+            raise
+        finally:
+            del self._in_flight[key]
+        future.set_result(output_url)
+        return output_url
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+prompt_cache = PromptResultCache(
+    config.PROMPT_CACHE_MAX_ENTRIES,
+    config.PROMPT_CACHE_TTL_SECONDS,
+    config.PROMPT_CACHE_TOUCH_SECONDS,
+)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+
+from social_media_app.config import config
+from social_media_app.http_client import http_client
+
+logger = logging.getLogger(__name__)
+
+# Protection for third-party APIs (Mailgun, DeepAI)
+# Every call goes through its integration's circuit breaker and concurrency
+# limiter. After CIRCUIT_FAILURE_THRESHOLD consecutive failures (5xx, 429,
+# timeouts, connection errors) the circuit opens and calls fail at once; after
+# CIRCUIT_RESET_SECONDS one probe call is let through (half-open) and its
+# outcome closes or reopens the circuit. The limiter grows the number of
+# concurrent calls by one per `limit` fast calls and halves it on a slow or
+# failed call (AIMD), so a slowing API gets less traffic instead of a pile-up.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class IntegrationUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise IntegrationUnavailableError("Circuit is open")
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                raise IntegrationUnavailableError("Circuit is half open")
+            self._probing = True
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info("Circuit closed")
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning(f"Circuit opened after {self.failures} failures")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        # The probe ended without an outcome (e.g. the limiter rejected it)
+        self._probing = False
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        target_latency: float,
+        queue_timeout: float,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self._changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._changed:
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait_for(lambda: self.in_flight < int(self.limit)),
+                    timeout=self.queue_timeout,
+                )
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise IntegrationUnavailableError(
+                    f"Concurrency limit of {int(self.limit)} reached"
+                ) from None
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self.in_flight -= 1
+                self._changed.notify_all()
+
+    def on_success(self, latency: float):
+        if latency > self.target_latency:
+            self._decrease()
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def on_failure(self):
+        self._decrease()
+
+    def _decrease(self):
+        self.limit = max(self.limit / 2, self.minimum)
+
+
+class Integration:
+    """
+    A third-party API: its calls go through a CircuitBreaker and an AIMDLimiter
+    and raise IntegrationUnavailableError when either refuses them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.breaker = CircuitBreaker(
+            config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_SECONDS
+        )
+        self.limiter = AIMDLimiter(
+            initial=config.CONCURRENCY_LIMIT_INITIAL,
+            minimum=config.CONCURRENCY_LIMIT_MIN,
+            maximum=config.CONCURRENCY_LIMIT_MAX,
+            target_latency=config.CONCURRENCY_TARGET_LATENCY_SECONDS.get(
+                self.name, 5
+            ),
+            queue_timeout=config.CONCURRENCY_QUEUE_TIMEOUT_SECONDS,
+        )
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        try:
+            self.breaker.before_call()
+        except IntegrationUnavailableError as err:
+            raise IntegrationUnavailableError(f"{self.name}: {err}") from None
+        recorded = False
+        try:
+            async with self.limiter.slot():
+                start = time.monotonic()
+                try:
+                    response = await http_client.post(url, **kwargs)
+                except Exception:
+                    recorded = True
+                    self._failed()
+                    raise
+                recorded = True
+                if response.status_code >= 500 or response.status_code == 429:
+                    self._failed()
+                else:
+                    self.breaker.record_success()
+                    self.limiter.on_success(time.monotonic() - start)
+                return response
+        except IntegrationUnavailableError as err:
+            raise IntegrationUnavailableError(f"{self.name}: {err}") from None
+        finally:
+            # Rejected by the limiter or cancelled: no outcome, free the probe
+            if not recorded:
+                self.breaker.release_probe()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "concurrency_limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "rejected": self.limiter.rejected,
+        }
+
+    def _failed(self):
+        self.breaker.record_failure()
+        self.limiter.on_failure()
@@ -0,0 +1,36 @@
+import logging
+
+from fastapi import APIRouter
+
+from social_media_app.cache import post_cache
+from social_media_app.file_index import file_index
+from social_media_app.http_client import http_client
+from social_media_app.leaderboard import most_liked_posts
+from social_media_app.prompt_cache import prompt_cache
+from social_media_app.security import password_hash_pool, token_cache, user_cache
+from social_media_app.storage import storage
+from social_media_app.tasks import INTEGRATIONS, email_dispatcher
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def get_metrics():
+    logger.info("Fetching metrics")
+    return {
+        "post_cache": post_cache.stats(),
+        "most_liked_posts": most_liked_posts.stats(),
+        "user_cache": user_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "password_hash_pool": password_hash_pool.stats(),
+        "http_client": http_client.stats(),
+        "email_dispatcher": email_dispatcher.stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "storage": storage.stats(),
+        "file_index": file_index.stats(),
+        "integrations": {
+            name: integration.stats() for name, integration in INTEGRATIONS.items()
+        },
+    }
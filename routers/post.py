@@ -3,29 +3,73 @@ from enum import Enum
 from typing import Annotated
 
 import sqlalchemy
-from fastapi import APIRouter, Depends, HTTPException ,BackgroundTasks , Request
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
 
-from social_media_app.database import comment_table, database, like_table, post_table
-from social_media_app.tasks import generate_and_add_to_post
+from social_media_app.cache import post_cache
+from social_media_app.config import config
+from social_media_app.database import (
+    comment_table,
+    database,
+    like_table,
+    post_table,
+    utcnow,
+)
+from social_media_app.leaderboard import most_liked_posts
+from social_media_app.jobs import enqueue
+from social_media_app.like_buffer import like_buffer
 from social_media_app.models.post import (
+    BatchItemResult,
     Comment,
     CommentIn,
     PostLike,
     PostLikeIn,
+    PostSearchResult,
     UserPost,
     UserPostIn,
     UserPostWithComments,
 )
+from social_media_app.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+    invalid_cursor_exception,
+)
+from social_media_app.prompt_cache import prompt_cache
+from social_media_app.search import highlight, select_search_page
 from social_media_app.security import get_current_user
+from social_media_app.streaming import ndjson_response, wants_ndjson
+from social_media_app.versions import (
+    FEED,
+    HOT_FEED,
+    bump_versions,
+    etag_matches,
+    get_version,
+    make_etag,
+    not_modified_response,
+    post_key,
+)
 
 router = APIRouter()
 
+MAX_BATCH_SIZE = 100
+# Comments embedded in GET /post/{post_id}, the rest are paged from
+# GET /post/{post_id}/comments with the returned cursor
+EMBEDDED_COMMENTS = 20
+
 logger = logging.getLogger(__name__)
 
-select_post_and_likes = (
-    sqlalchemy.select(post_table, sqlalchemy.func.count(like_table.c.id).label("likes"))
-    .select_from(post_table.outerjoin(like_table))
-    .group_by(post_table.c.id)
+select_post_and_likes = sqlalchemy.select(
+    post_table, post_table.c.like_count.label("likes")
 )
 
 
@@ -36,83 +80,444 @@ async def find_post(post_id: int):
     return await database.fetch_one(query)
 
 
+async def find_existing_post_ids(post_ids: set[int]) -> set[int]:
+    logger.info(f"Finding {len(post_ids)} posts")
+    query = sqlalchemy.select(post_table.c.id).where(post_table.c.id.in_(post_ids))
+    logger.debug(query)
+    return {row.id for row in await database.fetch_all(query)}
+
+
+async def insert_batch(
+    table: sqlalchemy.Table,
+    items: list,
+    user_id: int,
+    existing_post_ids: set[int] | None = None,
+    counter: str | None = None,
+    feed_changed: bool = False,
+) -> list[dict]:
+    """
+    Insert every item referencing an existing post in one transaction, bump the
+    post's `counter` once per post, and return one result per item.
+    """
+    results = []
+    inserted_per_post: dict[int, int] = {}
+    counts: dict[int, int] = {}
+    async with database.transaction():
+        for index, item in enumerate(items):
+            data = {**item.model_dump(), "user_id": user_id, "created_at": utcnow()}
+            post_id = data.get("post_id")
+            if existing_post_ids is not None and post_id not in existing_post_ids:
+                results.append(
+                    {"index": index, "status_code": 404, "detail": "Post not found"}
+                )
+                continue
+            last_record_id = await database.execute(table.insert().values(data))
+            results.append({"index": index, "status_code": 201, "id": last_record_id})
+            if post_id is not None:
+                inserted_per_post[post_id] = inserted_per_post.get(post_id, 0) + 1
+
+        for post_id, inserted in inserted_per_post.items():
+            counts[post_id] = await database.fetch_val(
+                post_table.update()
+                .where(post_table.c.id == post_id)
+                .values({counter: post_table.c[counter] + inserted})
+                .returning(post_table.c[counter])
+            )
+        versions = [post_key(post_id) for post_id in inserted_per_post]
+        await bump_versions(*versions, *([FEED] if feed_changed else []))
+    for post_id in inserted_per_post:
+        await post_cache.invalidate(post_id)
+    if table is post_table:
+        for result in results:
+            most_liked_posts.record(result["id"], 0)
+    elif counter == "like_count":
+        for post_id, likes in counts.items():
+            most_liked_posts.record(post_id, likes)
+    return results
+
+
 @router.post("/post", response_model=UserPost, status_code=201)
 async def create_post(
-    post: UserPostIn, current_user: Annotated[str, Depends(get_current_user)] , background_tasks: BackgroundTasks , request: Request , prompt: str = None
+    post: UserPostIn, current_user: Annotated[str, Depends(get_current_user)] , request: Request , prompt: str = None
 ):
     logger.info(f"Creating post: {post}")
 
-    data = {**post.model_dump(), "user_id": current_user.id}
+    data = {**post.model_dump(), "user_id": current_user.id, "created_at": utcnow()}
+    if prompt:
+        # A prompt generated before gets its image right away, no job needed
+        data["image_url"] = await prompt_cache.get(database, prompt)
     query = post_table.insert().values(data)
     logger.debug(query)
-    last_record_id = await database.execute(query)
-    if prompt:
-        background_tasks.add_task(
-            generate_and_add_to_post,
-            current_user.email,
-            last_record_id,
-            request.url_for("get_post_with_comments", post_id=last_record_id),
-            database,
-            prompt
+    async with database.transaction():
+        last_record_id = await database.execute(query)
+        await bump_versions(FEED)
+        if prompt and data["image_url"] is None:
+            await enqueue(
+                "generate_and_add_to_post",
+                email=current_user.email,
+                post_id=last_record_id,
+                post_url=str(
+                    request.url_for("get_post_with_comments", post_id=last_record_id)
+                ),
+                prompt=prompt,
             )
-            
+    most_liked_posts.record(last_record_id, 0)
+
     return {**data, "id": last_record_id}
 
 
+@router.post("/post/batch", response_model=list[BatchItemResult], status_code=207)
+async def create_posts_batch(
+    posts: Annotated[list[UserPostIn], Body(max_length=MAX_BATCH_SIZE)],
+    current_user: Annotated[str, Depends(get_current_user)],
+):
+    logger.info(f"Creating {len(posts)} posts")
+    return await insert_batch(post_table, posts, current_user.id, feed_changed=True)
+
+
 @router.post("/like", response_model=PostLike, status_code=201)
 async def like_post(
-    Like: PostLikeIn, current_user: Annotated[UserPost, Depends(get_current_user)]
+    Like: PostLikeIn,
+    current_user: Annotated[UserPost, Depends(get_current_user)],
+    response: Response,
 ):
     logger.info("Liking post")
     post = await find_post(Like.post_id)
     if post is None:
         raise HTTPException(status_code=404, detail="Post not found")
-    data = {**Like.model_dump(), "user_id": current_user.id}
+    data = {**Like.model_dump(), "user_id": current_user.id, "created_at": utcnow()}
+    if config.LIKE_WRITE_BEHIND:
+        # Versions are bumped by the flush, together with like_count
+        await like_buffer.add(Like.post_id, current_user.id)
+        await post_cache.invalidate(Like.post_id)
+        most_liked_posts.record(
+            Like.post_id, post.like_count + like_buffer.pending_likes(Like.post_id)
+        )
+        response.status_code = 202
+        return data
     query = like_table.insert().values(data)
     logger.debug(query)
-    last_record_id = await database.execute(query)
+    async with database.transaction():
+        last_record_id = await database.execute(query)
+        like_count = await database.fetch_val(
+            post_table.update()
+            .where(post_table.c.id == Like.post_id)
+            .values(like_count=post_table.c.like_count + 1)
+            .returning(post_table.c.like_count)
+        )
+        await bump_versions(post_key(Like.post_id), FEED)
+    await post_cache.invalidate(Like.post_id)
+    most_liked_posts.record(Like.post_id, like_count)
     return {**data, "id": last_record_id}
 
 
+@router.post("/like/batch", response_model=list[BatchItemResult], status_code=207)
+async def like_posts_batch(
+    likes: Annotated[list[PostLikeIn], Body(max_length=MAX_BATCH_SIZE)],
+    current_user: Annotated[UserPost, Depends(get_current_user)],
+):
+    logger.info(f"Liking {len(likes)} posts")
+    existing = await find_existing_post_ids({like.post_id for like in likes})
+    return await insert_batch(
+        like_table, likes, current_user.id, existing, "like_count", feed_changed=True
+    )
+
+
 class PostSorting(str, Enum):
     new = "new"
     old = "old"
     most_likes = "most_likes"
+    hot = "hot"
+
+
+def _apply_post_cursor(query, sorting: PostSorting, cursor: str):
+    values = decode_cursor(cursor)
+    if values.get("sorting") != sorting.value or not isinstance(values.get("id"), int):
+        raise invalid_cursor_exception()
+    if sorting == PostSorting.new:
+        return query.where(post_table.c.id < values["id"])
+    if sorting == PostSorting.old:
+        return query.where(post_table.c.id > values["id"])
+    # most_likes / hot: (score, id) descending, the post id breaks ties between
+    # posts with the same score so every post shows up exactly once
+    if sorting == PostSorting.most_likes:
+        column, score = post_table.c.like_count, values.get("likes")
+        if not isinstance(score, int):
+            raise invalid_cursor_exception()
+    else:
+        column, score = post_table.c.hot_score, values.get("hot_score")
+        if not isinstance(score, (int, float)):
+            raise invalid_cursor_exception()
+    return query.where(
+        sqlalchemy.or_(
+            column < score,
+            sqlalchemy.and_(column == score, post_table.c.id < values["id"]),
+        )
+    )
+
+
+async def fetch_most_liked_page(
+    limit: int, cursor: str | None = None
+) -> tuple[list, str | None] | None:
+    """
+    A most_likes page ranked by the in-memory leaderboard, the posts themselves
+    are read by primary key. None when the page lies past the leaderboard.
+    """
+    after = None
+    if cursor:
+        values = decode_cursor(cursor)
+        likes, post_id = values.get("likes"), values.get("id")
+        if (
+            values.get("sorting") != PostSorting.most_likes.value
+            or not isinstance(likes, int)
+            or not isinstance(post_id, int)
+        ):
+            raise invalid_cursor_exception()
+        after = (likes, post_id)
+    entries = most_liked_posts.page(limit, after)
+    if entries is None:
+        return None
+
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        post_id, likes = entries[-1]
+        next_cursor = encode_cursor(
+            {"sorting": PostSorting.most_likes.value, "id": post_id, "likes": likes}
+        )
+    query = select_post_and_likes.where(
+        post_table.c.id.in_([post_id for post_id, _ in entries])
+    )
+    logger.debug(query)
+    posts = {post.id: post for post in await database.fetch_all(query)}
+    return [posts[post_id] for post_id, _ in entries if post_id in posts], next_cursor
+
+
+def _post_cursor(post, sorting: PostSorting) -> str:
+    values = {"sorting": sorting.value, "id": post.id}
+    if sorting == PostSorting.most_likes:
+        values["likes"] = post.likes
+    elif sorting == PostSorting.hot:
+        values["hot_score"] = post.hot_score
+    return encode_cursor(values)
 
 
 @router.get("/post", response_model=list[UserPost])
-async def get_all_posts(sorting: PostSorting = PostSorting.new):
+async def get_all_posts(
+    response: Response,
+    sorting: PostSorting = PostSorting.new,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+    paginate: bool = True,
+    accept: Annotated[str | None, Header()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
     logger.info("Featching all posts")
+    # Hot score updates only reorder the hot feed, the other sorts ignore them
+    hot_version = await get_version(HOT_FEED) if sorting == PostSorting.hot else 0
+    etag = make_etag(
+        FEED,
+        await get_version(FEED),
+        hot_version,
+        sorting.value,
+        limit,
+        cursor,
+        paginate,
+        wants_ndjson(accept),
+    )
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag)
+    response.headers["ETag"] = etag
+
     if sorting == PostSorting.new:
         query = select_post_and_likes.order_by(post_table.c.id.desc())
     elif sorting == PostSorting.old:
         query = select_post_and_likes.order_by(post_table.c.id.asc())
     elif sorting == PostSorting.most_likes:
-        query = select_post_and_likes.order_by(sqlalchemy.desc("likes"))
+        query = select_post_and_likes.order_by(
+            post_table.c.like_count.desc(), post_table.c.id.desc()
+        )
+    elif sorting == PostSorting.hot:
+        query = select_post_and_likes.order_by(
+            post_table.c.hot_score.desc(), post_table.c.id.desc()
+        )
+
+    if sorting == PostSorting.most_likes and paginate and not wants_ndjson(accept):
+        page = await fetch_most_liked_page(limit, cursor)
+        if page is not None:
+            posts, next_cursor = page
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return posts
 
+    if not paginate:
+        # Opt-in only: returns the whole table in one response
+        logger.debug(query)
+        if wants_ndjson(accept):
+            return ndjson_response(query, UserPost, headers={"ETag": etag})
+        return await database.fetch_all(query)
+
+    if cursor:
+        query = _apply_post_cursor(query, sorting, cursor)
+    # Fetch one extra row to know whether there is a next page
+    query = query.limit(limit + 1)
     logger.debug(query)
-    return await database.fetch_all(query)
+    if wants_ndjson(accept):
+        return ndjson_response(
+            query,
+            UserPost,
+            limit,
+            lambda post: _post_cursor(post, sorting),
+            headers={"ETag": etag},
+        )
+    posts = await database.fetch_all(query)
+
+    if len(posts) > limit:
+        posts = posts[:limit]
+        response.headers["X-Next-Cursor"] = _post_cursor(posts[-1], sorting)
+    return posts
+
+
+# Registered before /post/{post_id} so "search" is not taken for a post id
+@router.get("/post/search", response_model=list[PostSearchResult])
+async def search_posts(
+    response: Response,
+    q: Annotated[str, Query(min_length=1, pattern=r"\S")],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+):
+    logger.info("Searching posts")
+    score = post_id = None
+    if cursor:
+        values = decode_cursor(cursor)
+        score, post_id = values.get("score"), values.get("id")
+        if (
+            values.get("q") != q
+            or not isinstance(score, (int, float))
+            or not isinstance(post_id, int)
+        ):
+            raise invalid_cursor_exception()
+    query = select_search_page(q, limit, score, post_id)
+    logger.debug(query)
+    posts = await database.fetch_all(query)
+
+    if len(posts) > limit:
+        posts = posts[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            {"q": q, "score": posts[-1].score, "id": posts[-1].id}
+        )
+    return [{**post, "snippet": highlight(post.snippet)} for post in posts]
+
+
+def select_comments_page(post_id: int, limit: int, cursor: str | None = None):
+    """
+    Comments of a post in id order, `limit + 1` rows so the caller can tell
+    whether there is a next page. Served by the (post_id, id) index.
+    """
+    query = (
+        comment_table.select()
+        .where(comment_table.c.post_id == post_id)
+        .order_by(comment_table.c.id)
+    )
+    if cursor:
+        values = decode_cursor(cursor)
+        if values.get("post_id") != post_id or not isinstance(values.get("id"), int):
+            raise invalid_cursor_exception()
+        query = query.where(comment_table.c.id > values["id"])
+    return query.limit(limit + 1)
+
+
+def _comment_cursor(comment) -> str:
+    return encode_cursor({"post_id": comment.post_id, "id": comment.id})
+
+
+async def fetch_comments_page(
+    post_id: int, limit: int, cursor: str | None = None
+) -> tuple[list, str | None]:
+    query = select_comments_page(post_id, limit, cursor)
+    logger.debug(query)
+    comments = await database.fetch_all(query)
+    if len(comments) > limit:
+        comments = comments[:limit]
+        return comments, _comment_cursor(comments[-1])
+    return comments, None
 
 
 @router.get("/post/{post_id}/comments", response_model=list[Comment])
-async def get_comments_on_post(post_id: int):
+async def get_comments_on_post(
+    post_id: int,
+    response: Response,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+    accept: Annotated[str | None, Header()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
     logger.info(f"Fetching comments for post ID: {post_id}")
-    query = comment_table.select().where(comment_table.c.post_id == post_id)
-    logger.debug(query)
-    return await database.fetch_all(query)
+    key = post_key(post_id)
+    etag = make_etag(key, await get_version(key), limit, cursor, wants_ndjson(accept))
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag)
+    response.headers["ETag"] = etag
+
+    if wants_ndjson(accept):
+        query = select_comments_page(post_id, limit, cursor)
+        logger.debug(query)
+        return ndjson_response(
+            query, Comment, limit, _comment_cursor, headers={"ETag": etag}
+        )
+
+    comments, next_cursor = await fetch_comments_page(post_id, limit, cursor)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return comments
 
 
 @router.get("/post/{post_id}", response_model=UserPostWithComments)
-async def get_post_with_comments(post_id: int):
+async def get_post_with_comments(
+    post_id: int, if_none_match: Annotated[str | None, Header()] = None
+):
     logger.info(f"Fetching post with comments for post ID: {post_id}")
+    key = post_key(post_id)
+    # Buffered likes are in the body but not in the version yet
+    pending_likes = like_buffer.pending_likes(post_id)
+    version = await get_version(key)
+    etag = make_etag(key, version, pending_likes)
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag)
+
+    cached = await post_cache.get(post_id, etag)
+    if cached is not None:
+        return Response(
+            content=cached, media_type="application/json", headers={"ETag": etag}
+        )
+
     query = select_post_and_likes.where(post_table.c.id == post_id)
     logger.debug(query)
     post = await database.fetch_one(query)
 
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
+    post = {**post, "likes": post.likes + pending_likes}
 
-    return {"post": post, "comments": await get_comments_on_post(post_id)}
+    comments, next_cursor = await fetch_comments_page(post_id, EMBEDDED_COMMENTS)
+    content = UserPostWithComments.model_validate(
+        {
+            "post": post,
+            "comments": comments,
+            "comments_total": post["comment_count"],
+            "comments_next_cursor": next_cursor,
+        }
+    ).model_dump_json()
+    # A write landing during the reads may not be in the body, which is then
+    # served but not cached
+    if (
+        await get_version(key) == version
+        and like_buffer.pending_likes(post_id) == pending_likes
+    ):
+        await post_cache.set(post_id, etag, content.encode())
+    return Response(
+        content=content, media_type="application/json", headers={"ETag": etag}
+    )
 
 
 @router.post("/comment", response_model=Comment, status_code=201)
@@ -125,8 +530,30 @@ async def create_comment(
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
 
-    data = {**comment.model_dump(), "user_id": current_user.id}
+    data = {**comment.model_dump(), "user_id": current_user.id, "created_at": utcnow()}
     query = comment_table.insert().values(data)
-    last_record_id = await database.execute(query)
+    async with database.transaction():
+        last_record_id = await database.execute(query)
+        await database.execute(
+            post_table.update()
+            .where(post_table.c.id == comment.post_id)
+            .values(comment_count=post_table.c.comment_count + 1)
+        )
+        await bump_versions(post_key(comment.post_id))
+    await post_cache.invalidate(comment.post_id)
     logger.debug(query)
     return {**data, "id": last_record_id}
+
+
+@router.post(
+    "/comment/batch", response_model=list[BatchItemResult], status_code=207
+)
+async def create_comments_batch(
+    comments: Annotated[list[CommentIn], Body(max_length=MAX_BATCH_SIZE)],
+    current_user: Annotated[str, Depends(get_current_user)],
+):
+    logger.info(f"Creating {len(comments)} comments")
+    existing = await find_existing_post_ids({comment.post_id for comment in comments})
+    return await insert_batch(
+        comment_table, comments, current_user.id, existing, "comment_count"
+    )
@@ -1,40 +1,339 @@
 import logging
-import tempfile
+from contextlib import contextmanager
+from functools import partial
+from typing import Annotated, AsyncIterator, Optional
 
-import aiofiles
-from fastapi import APIRouter, HTTPException, UploadFile, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from python_multipart.multipart import MultipartParser, parse_options_header
 
-from social_media_app.libs.b2 import b2_upload_file
+from social_media_app import upload_sessions
+from social_media_app.database import database
+from social_media_app.file_index import StoredFileGoneError, file_index
+from social_media_app.models.upload import UploadSession, UploadSessionIn
+from social_media_app.models.user import AuthenticatedUser
+from social_media_app.security import get_current_user
+from social_media_app.storage import StorageUnavailableError, upload_stream
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 # Life cycle of upload endpoint
-# Client -> server (tempfile) -> B2 -> delete temp file
+# Client -> server (memory) -> B2
 
-# 1- Client split up the file into chuncks 1 MB
-# 2- Client sends up chuncks 1 at a time
-# 3- Client sends the  last chunck
-# 4- fastapi puts all the chucncks into 1 temp file
-# 5- it uploads the file to B2 and then deletes the temp file
+# 1- Client sends the file as the `file` field of a multipart/form-data body
+# 2- fastapi parses the body as it arrives, without spooling it to disk
+# 3- the file bytes are packed into parts and every full part is uploaded to
+#    B2 while the next one is still being received
+# 4- once the last part is uploaded B2 assembles them into one file, unless
+#    the sha256 of the bytes shows the same file is stored already (see
+#    file_index.py), then that file is used and the parts are dropped
 
-CHUNCK_SIZE = 1024 * 1024
+# Resumable uploads (see upload_sessions.py)
+# 1- POST /upload/sessions with the file name and size returns a session
+# 2- PUT each chunk_size chunk to /upload/sessions/{id}/chunks/{index} (or
+#    /upload/sessions/{id}?offset=), in any order, retrying failed ones
+# 3- GET /upload/sessions/{id} lists the missing ranges to resume from
+# 4- POST /upload/sessions/{id}/finalize assembles the file in B2
 
+UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"file": {"type": "string", "format": "binary"}},
+                "required": ["file"],
+            }
+        }
+    },
+}
 
-@router.post("/upload", status_code=201)
-async def upload_file(file: UploadFile):
+
+class FormFileStream:
+    """
+    Streams the bytes of one file field of a multipart/form-data request.
+    """
+
+    def __init__(self, request: Request, field_name: str):
+        content_type, params = parse_options_header(
+            request.headers.get("content-type", "")
+        )
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Expected a multipart/form-data body",
+            )
+        self.field_name = field_name
+        self.filename: Optional[str] = None
+        self._body = request.stream()
+        self._headers: dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._in_file = False
+        self._file_done = False
+        self._received: list[bytes] = []
+        self._parser = MultipartParser(
+            params[b"boundary"],
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    async def start(self):
+        """
+        Read the body until the file field starts, setting `filename`.
+        """
+        while self.filename is None:
+            if not await self._feed():
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Missing file field {self.field_name}",
+                )
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while True:
+            if self._received:
+                yield b"".join(self._received)
+                self._received.clear()
+            if self._file_done:
+                return
+            if not await self._feed():
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Request body ended before the file",
+                )
+
+    async def _feed(self) -> bool:
+        chunk = await anext(self._body, None)
+        if chunk is None:
+            return False
+        self._parser.write(chunk)
+        return True
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(
+            self._headers.get(b"content-disposition", b"")
+        )
+        name = options.get(b"name", b"").decode()
+        filename = options.get(b"filename")
+        if name == self.field_name and filename is not None and not self._file_done:
+            self._in_file = True
+            self.filename = filename.decode()
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._received.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._file_done = True
+
+
+@contextmanager
+def storage_errors(file_name: str):
     try:
-        with tempfile.NamedTemporaryFile() as temp_file:
-            file_name = temp_file.name
-            logger.debug(f"Saving uploaded file temporarily to {file_name}")
-            async with aiofiles.open(file_name, "wb") as f:
-                while chunck := await file.read(CHUNCK_SIZE):
-                    await f.write(chunck)
-            file_url = b2_upload_file(local_file=file_name, file_name=file.filename)
+        yield
+    except HTTPException:
+        raise
+    except StorageUnavailableError as e:
+        logger.warning(f"Uploading {file_name} failed: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Storage is busy, please try again",
+            headers={"Retry-After": "5"},
+        )
     except Exception:
+        logger.exception(f"Uploading {file_name} failed")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="There was an error uploading the file",
         )
-    return {"detail": f"Sucessfully uploaded {file.filename}", "file_url": file_url}
+
+
+@router.post(
+    "/upload",
+    status_code=201,
+    openapi_extra={"requestBody": UPLOAD_REQUEST_BODY},
+)
+async def upload_file(
+    request: Request,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    file = FormFileStream(request, "file")
+    await file.start()
+    with storage_errors(file.filename):
+        upload = await upload_stream(
+            file.chunks(),
+            file.filename,
+            find_existing=partial(file_index.find, database),
+        )
+        try:
+            upload_id, file_url = await file_index.add_upload(
+                database, upload, file.filename, current_user.id
+            )
+        except StoredFileGoneError:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="The file was deleted while uploading, please try again",
+            )
+    return {
+        "detail": f"Sucessfully uploaded {file.filename}",
+        "file_url": file_url,
+        "id": upload_id,
+    }
+
+
+@router.delete("/upload/{upload_id}")
+async def delete_upload(
+    upload_id: int,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    if not await file_index.release(database, upload_id, current_user.id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found"
+        )
+    return {"detail": "Upload deleted"}
+
+
+async def find_upload_session(session_id: str, user_id: int):
+    session = await upload_sessions.get_session(database, session_id, user_id)
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found"
+        )
+    return session
+
+
+async def upload_session_state(session) -> UploadSession:
+    received = await upload_sessions.received_chunks(database, session.id)
+    missing = upload_sessions.missing_chunks(session, set(received))
+    return UploadSession(
+        id=session.id,
+        file_name=session.file_name,
+        size=session.size,
+        chunk_size=session.chunk_size,
+        chunk_count=upload_sessions.chunk_count(session.size, session.chunk_size),
+        status=session.status,
+        missing_chunks=missing,
+        missing_ranges=upload_sessions.missing_ranges(session, missing),
+        file_url=session.file_url if session.status == upload_sessions.FINISHED else None,
+    )
+
+
+async def read_chunk(request: Request, expected: int) -> bytes:
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > expected:
+            break
+    if len(data) != expected:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Chunk must be {expected} bytes",
+        )
+    return bytes(data)
+
+
+@router.post("/upload/sessions", status_code=201, response_model=UploadSession)
+async def create_upload_session(
+    session_in: UploadSessionIn,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    with storage_errors(session_in.file_name):
+        try:
+            session = await upload_sessions.create_session(
+                database, current_user.id, session_in.file_name, session_in.size
+            )
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+            )
+    return await upload_session_state(session)
+
+
+@router.get("/upload/sessions/{session_id}", response_model=UploadSession)
+async def get_upload_session(
+    session_id: str,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    session = await find_upload_session(session_id, current_user.id)
+    return await upload_session_state(session)
+
+
+@router.put(
+    "/upload/sessions/{session_id}/chunks/{index}", response_model=UploadSession
+)
+async def put_upload_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    session = await find_upload_session(session_id, current_user.id)
+    if not 0 <= index < upload_sessions.chunk_count(session.size, session.chunk_size):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Chunk {index} is out of range",
+        )
+    data = await read_chunk(request, upload_sessions.chunk_length(session, index))
+    with storage_errors(session.file_name):
+        try:
+            await upload_sessions.put_chunk(database, session, index, data)
+        except upload_sessions.UploadSessionConflictError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    session = await find_upload_session(session_id, current_user.id)
+    return await upload_session_state(session)
+
+
+@router.put("/upload/sessions/{session_id}", response_model=UploadSession)
+async def put_upload_chunk_at_offset(
+    session_id: str,
+    offset: int,
+    request: Request,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    session = await find_upload_session(session_id, current_user.id)
+    if offset % session.chunk_size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Offset must be a multiple of {session.chunk_size}",
+        )
+    return await put_upload_chunk(
+        session_id, offset // session.chunk_size, request, current_user
+    )
+
+
+@router.post("/upload/sessions/{session_id}/finalize")
+async def finalize_upload_session(
+    session_id: str,
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    session = await find_upload_session(session_id, current_user.id)
+    with storage_errors(session.file_name):
+        try:
+            file_url = await upload_sessions.finalize_session(database, session)
+        except upload_sessions.UploadSessionConflictError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return {"detail": f"Sucessfully uploaded {session.file_name}", "file_url": file_url}
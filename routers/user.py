@@ -3,61 +3,51 @@
 import logging
 from typing import Annotated
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
 
-from social_media_app import tasks
 from social_media_app.database import database, user_table
-from social_media_app.models.user import UserIn
+from social_media_app.jobs import enqueue
+from social_media_app.models.user import AuthenticatedUser, UserIn
 from social_media_app.security import (
     authenticate_user,
     create_access_token,
     create_confirmation_token,
     get_password_hashed,
     get_subject_for_token_type,
+    get_current_user,
     get_user,
+    invalidate_cached_user,
+    revoke_tokens,
 )
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-async def send_registration_email(email: str, confirmation_url: str):
-    """
-    Wrapper function to safely send registration email in the background.
-    """
-    try:
-        await tasks.send_user_registeration_email(
-            email,
-            confirmation_url=confirmation_url,
-        )
-    except tasks.APIResponseError as e:
-        logger.error(
-            f"Error sending confirmation email to {email}: {e}", extra={"email": email}
-        )
-
-
 @router.post("/register", status_code=201)
-async def register(user: UserIn, request: Request, background_tasks: BackgroundTasks):
+async def register(user: UserIn, request: Request):
     if await get_user(user.email):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="A user with that email already exists!",
         )
 
-    hashed_password = get_password_hashed(user.password)
+    hashed_password = await get_password_hashed(user.password)
 
     query = user_table.insert().values(email=user.email, password=hashed_password)
     logger.debug(query)
-    await database.execute(query)
-
-    background_tasks.add_task(
-        send_registration_email,
-        user.email,
-        confirmation_url=request.url_for(
-            "confirm_email", token=create_confirmation_token(user.email)
-        ),
-    )
+    async with database.transaction():
+        await database.execute(query)
+        await enqueue(
+            "send_user_registeration_email",
+            email=user.email,
+            confirmation_url=str(
+                request.url_for(
+                    "confirm_email", token=create_confirmation_token(user.email)
+                )
+            ),
+        )
 
     return {"detail": "User created. Please confirm your email."}
 
@@ -65,10 +55,23 @@ async def register(user: UserIn, request: Request, background_tasks: BackgroundT
 @router.post("/token")
 async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     user = await authenticate_user(form_data.username, form_data.password)
-    access_token = create_access_token(user.email)
+    access_token = create_access_token(
+        user.email,
+        user_id=user.id,
+        confirmed=user.confirmed,
+        token_version=user.token_version,
+    )
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@router.post("/token/revoke")
+async def revoke_all_tokens(
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
+):
+    await revoke_tokens(current_user.id, current_user.email)
+    return {"detail": "All access tokens revoked"}
+
+
 @router.get("/confirm/{token}")
 async def confirm_email(token: str):
     email = get_subject_for_token_type(token, "confirmation")
@@ -77,4 +80,5 @@ async def confirm_email(token: str):
     )
     logger.debug(query)
     await database.execute(query)
+    invalidate_cached_user(email)
     return {"detail": "User confirmed"}
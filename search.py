@@ -0,0 +1,108 @@
+import argparse
+import html
+import logging
+
+import sqlalchemy
+
+from social_media_app.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Full-text search over post bodies
+# post_fts is an SQLite FTS5 index over post.body (external content table, so
+# the text is stored once in post). Triggers keep it in sync with inserts,
+# body updates and deletes on post; rebuild() re-indexes every existing row.
+# Usage: python -m social_media_app.search rebuild
+
+SNIPPET_TOKENS = 16
+# FTS5 wraps matches in these private use characters, the snippet is then
+# HTML-escaped and they become <mark> tags, so markup in a body stays text
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+CREATE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    "body, content='post', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN"
+    " INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN"
+    " INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF body ON post BEGIN"
+    " INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body);"
+    " INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body);"
+    " END",
+]
+
+REBUILD_STATEMENT = "INSERT INTO post_fts(post_fts) VALUES ('rebuild')"
+
+
+def create_search_index(connection: sqlalchemy.Connection):
+    for statement in CREATE_STATEMENTS:
+        connection.execute(sqlalchemy.text(statement))
+
+
+def rebuild(engine: sqlalchemy.Engine):
+    logger.info("Rebuilding post search index")
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(REBUILD_STATEMENT))
+
+
+def match_expression(q: str) -> str:
+    """
+    Turn free text into an FTS5 query matching posts that contain every word,
+    quoting each word so FTS5 operators and syntax in user input are ignored.
+    """
+    words = q.split()
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def select_search_page(
+    q: str, limit: int, score: float | None = None, post_id: int | None = None
+) -> sqlalchemy.TextClause:
+    """
+    Posts matching `q` ordered by bm25 score (lower is more relevant) then id,
+    `limit + 1` rows starting after the (score, post_id) keyset cursor.
+    """
+    after_cursor = ""
+    values = {"match": match_expression(q), "limit": limit + 1}
+    if score is not None:
+        after_cursor = (
+            " AND (bm25(post_fts) > :score"
+            " OR (bm25(post_fts) = :score AND post.id > :post_id))"
+        )
+        values.update(score=score, post_id=post_id)
+    return sqlalchemy.text(
+        "SELECT post.id, post.body, post.user_id, post.image_url,"
+        " bm25(post_fts) AS score,"
+        f" snippet(post_fts, 0, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS})"
+        " AS snippet"
+        " FROM post_fts JOIN post ON post.id = post_fts.rowid"
+        f" WHERE post_fts MATCH :match{after_cursor}"
+        " ORDER BY score, post.id"
+        " LIMIT :limit"
+    ).bindparams(**values)
+
+
+def highlight(snippet: str) -> str:
+    """
+    HTML-escape a snippet of select_search_page, with matches in <mark>.
+    """
+    return (
+        html.escape(snippet)
+        .replace(MATCH_START, "<mark>")
+        .replace(MATCH_END, "</mark>")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post full-text search index")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.parse_args()
+    rebuild(engine)
+    print("Search index rebuilt")
+
+
+if __name__ == "__main__":
+    main()
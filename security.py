@@ -1,14 +1,22 @@
+import asyncio
 import datetime
+import hashlib
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated, Literal
 
+import sqlalchemy
+from databases import Database
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import ExpiredSignatureError, JWTError, jwt
 from passlib.context import CryptContext
 
+from social_media_app.cache import LRUCache
 from social_media_app.config import config
 from social_media_app.database import database, user_table
+from social_media_app.models.user import AuthenticatedUser
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +31,62 @@ def credintials_exception(exception_details: str) -> HTTPException:
     )
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.BCRYPT_ROUNDS
+)
+
+
+class PasswordHashPool:
+    """
+    Runs bcrypt off the event loop. bcrypt releases the GIL, so a small thread
+    pool hashes in parallel while the loop keeps serving other requests. At
+    most `workers` calls run at once and `max_queue` more may wait, past that
+    callers get a 503 instead of piling up behind the pool.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.in_flight = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hash")
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.capacity:
+            self.rejected += 1
+            logger.warning("Password hash pool saturated, rejecting request")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.workers, 0),
+            "rejected": self.rejected,
+        }
+
+
+password_hash_pool = PasswordHashPool(
+    config.PASSWORD_HASH_WORKERS, config.PASSWORD_HASH_MAX_QUEUE
+)
+
+# Users behind access tokens, keyed by token subject (email). Anything that
+# changes a user row must call invalidate_cached_user().
+user_cache = LRUCache(config.USER_CACHE_MAX_ENTRIES, ttl=config.USER_CACHE_TTL_SECONDS)
+
+# Claims of tokens that passed jwt.decode, keyed by the token's sha256
+# so the cache holds no usable credentials. Entries expire with the token.
+token_cache = LRUCache(config.TOKEN_CACHE_MAX_ENTRIES, ttl=0)
 
 
 def access_token_expire_minutes() -> int:
@@ -34,12 +97,53 @@ def confirmation_token_expire_minutes() -> int:
     return 1440
 
 
-def create_access_token(email: str):
+class TokenDenyList:
+    """
+    Lowest valid access token version of every user that revoked tokens.
+    Revocations made by this worker apply at once, sync() picks up the ones
+    made by other workers (see TOKEN_DENY_LIST_SYNC_SECONDS).
+    """
+
+    def __init__(self):
+        self._min_versions: dict[int, int] = {}
+
+    def is_revoked(self, user_id: int, token_version: int) -> bool:
+        return token_version < self._min_versions.get(user_id, 0)
+
+    def revoke(self, user_id: int, token_version: int):
+        self._min_versions[user_id] = max(
+            token_version, self._min_versions.get(user_id, 0)
+        )
+
+    async def sync(self, database: Database):
+        query = sqlalchemy.select(user_table.c.id, user_table.c.token_version).where(
+            user_table.c.token_version > 0
+        )
+        logger.debug(query)
+        rows = await database.fetch_all(query)
+        self._min_versions = {row.id: row.token_version for row in rows}
+
+    def clear(self):
+        self._min_versions = {}
+
+
+token_deny_list = TokenDenyList()
+
+
+def create_access_token(
+    email: str,
+    user_id: int | None = None,
+    confirmed: bool = False,
+    token_version: int = 0,
+):
     logger.debug("Creating access token", extra={"email": email})
     expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
         minutes=access_token_expire_minutes()
     )
     jwt_data = {"sub": email, "exp": expire, "type": "access"}
+    if user_id is not None:
+        # Lets get_current_user answer without reading the users table
+        jwt_data.update(uid=user_id, confirmed=confirmed, ver=token_version)
     encoded_jwt = jwt.encode(jwt_data, key=config.SECRET_KEY, algorithm=config.ALGORITHM)
     return encoded_jwt
 
@@ -54,9 +158,16 @@ def create_confirmation_token(email: str):
     return encoded_jwt
 
 
-def get_subject_for_token_type(
+def get_claims_for_token_type(
     token: str, type: Literal["access", "confirmation"]
-) -> str:
+) -> dict:
+    key = hashlib.sha256(token.encode()).digest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        if cached["type"] != type:
+            raise credintials_exception(f"Token has incorrect type , expected '{type}'")
+        return cached
+
     try:
         payload = jwt.decode(token, key=config.SECRET_KEY, algorithms=[config.ALGORITHM])
     except ExpiredSignatureError as e:
@@ -72,15 +183,26 @@ def get_subject_for_token_type(
     if token_type is None or token_type != type:
         raise credintials_exception(f"Token has incorrect type , expected '{type}'")
 
-    return email
+    expires_in = payload.get("exp", 0) - time.time()
+    if expires_in > 0:
+        token_cache.set(key, payload, ttl=expires_in)
+    return payload
 
 
-def get_password_hashed(password: str) -> str:
-    return pwd_context.hash(password)
+def get_subject_for_token_type(
+    token: str, type: Literal["access", "confirmation"]
+) -> str:
+    return get_claims_for_token_type(token, type)["sub"]
+
 
+async def get_password_hashed(password: str) -> str:
+    return await password_hash_pool.run(pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hash_pool.run(
+        pwd_context.verify, plain_password, hashed_password
+    )
 
 
 async def get_user(email: str):
@@ -91,21 +213,68 @@ async def get_user(email: str):
         return result
 
 
+def invalidate_cached_user(email: str):
+    user_cache.delete(email)
+
+
 async def authenticate_user(email: str, password: str):
     logger.debug("Authenticating user", extra={"email": email})
     user = await get_user(email)
     if not user:
         raise credintials_exception("Invalid email or password")
-    if not verify_password(password, user.password):
+    valid, new_hash = await password_hash_pool.run(
+        pwd_context.verify_and_update, password, user.password
+    )
+    if not valid:
         raise credintials_exception("Invalid email or password")
     if not user.confirmed:
         raise credintials_exception("User has not confirmed email")
+    if new_hash:
+        # Stored with another bcrypt cost than BCRYPT_ROUNDS
+        logger.debug("Rehashing password", extra={"email": email})
+        query = (
+            user_table.update()
+            .where(user_table.c.email == email)
+            .values(password=new_hash)
+        )
+        await database.execute(query)
+        invalidate_cached_user(email)
     return user
 
 
+async def revoke_tokens(user_id: int, email: str):
+    """
+    Invalidate every access token issued to the user so far.
+    """
+    query = (
+        user_table.update()
+        .where(user_table.c.id == user_id)
+        .values(token_version=user_table.c.token_version + 1)
+        .returning(user_table.c.token_version)
+    )
+    logger.debug(query)
+    token_version = await database.fetch_val(query)
+    token_deny_list.revoke(user_id, token_version)
+    invalidate_cached_user(email)
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2scheme)]):
-    email = get_subject_for_token_type(token, "access")
-    user = await get_user(email)
+    claims = get_claims_for_token_type(token, "access")
+    email = claims["sub"]
+    if "uid" in claims:
+        if token_deny_list.is_revoked(claims["uid"], claims.get("ver", 0)):
+            raise credintials_exception("Token has been revoked")
+        return AuthenticatedUser(
+            id=claims["uid"], email=email, confirmed=claims.get("confirmed", False)
+        )
+
+    # Tokens issued before the user id was embedded
+    user = user_cache.get(email)
     if user is None:
-        raise credintials_exception("Could not find user for this token")
+        user = await get_user(email)
+        if user is None:
+            raise credintials_exception("Could not find user for this token")
+        user_cache.set(email, user)
+    if user.token_version > 0:
+        raise credintials_exception("Token has been revoked")
     return user
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+
+from social_media_app.config import config
+from social_media_app.libs.b2 import (
+    b2_cancel_large_file,
+    b2_delete_file,
+    b2_finish_large_file,
+    b2_refresh_authorization,
+    b2_start_large_file,
+    b2_upload_bytes,
+    b2_upload_part,
+    b2_warm_up,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StorageUnavailableError(Exception):
+    pass
+
+
+class B2Storage:
+    """
+    Async facade over the blocking b2sdk calls of libs.b2. They run on a
+    dedicated thread pool so an upload never holds the event loop (nor the
+    default executor other code relies on). At most `workers` calls run at
+    once and `max_queue` more may wait, each call gets `timeout` seconds
+    including the wait. Past either limit StorageUnavailableError is raised.
+    """
+
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="b2")
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.capacity:
+            self.rejected += 1
+            logger.warning("B2 storage pool saturated, rejecting call")
+            raise StorageUnavailableError("Storage is busy")
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(func, *args)
+        self.in_flight += 1
+        # Counted until the call really ends, not when its caller gives up on
+        # it, so a timed out call still holds its place
+        future.add_done_callback(lambda _: self._call_done(loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # The thread cannot be interrupted, b2sdk's own timeouts end it
+            self.timed_out += 1
+            raise StorageUnavailableError(
+                f"{func.__name__} timed out after {self.timeout}s"
+            ) from None
+
+    def _call_done(self, loop: asyncio.AbstractEventLoop):
+        # Runs on the thread that ended the call, usually a worker
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # The loop is closed, nothing is waiting for the count
+
+    def _release(self):
+        self.in_flight -= 1
+
+    async def start(self):
+        """
+        Authorize and find the bucket before the first upload needs them.
+        """
+        if not config.B2_KEY_ID:
+            logger.info("B2 is not configured, uploads will fail")
+            return
+        try:
+            await self.run(b2_warm_up)
+        except Exception:
+            # Not fatal, the first upload authorizes instead
+            logger.exception("Could not authorize with B2")
+
+    async def refresh_authorization(self):
+        if config.B2_KEY_ID:
+            await self.run(b2_refresh_authorization)
+
+    async def upload_bytes(self, data: bytes, file_name: str) -> str:
+        return await self.run(b2_upload_bytes, data, file_name)
+
+    async def start_large_file(self, file_name: str) -> str:
+        return await self.run(b2_start_large_file, file_name)
+
+    async def upload_part(self, file_id: str, part_number: int, data: bytes) -> str:
+        return await self.run(b2_upload_part, file_id, part_number, data)
+
+    async def finish_large_file(self, file_id: str, part_sha1s: list[str]) -> str:
+        return await self.run(b2_finish_large_file, file_id, part_sha1s)
+
+    async def cancel_large_file(self, file_id: str):
+        await self.run(b2_cancel_large_file, file_id)
+
+    async def delete_file(self, file_url: str, file_name: str):
+        await self.run(b2_delete_file, file_url, file_name)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.workers, 0),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+storage = B2Storage(
+    config.B2_WORKERS, config.B2_MAX_QUEUE, config.B2_CALL_TIMEOUT_SECONDS
+)
+
+# Streaming uploads to B2
+# upload_stream() forwards an upload while it is still being received. Chunks
+# are packed into UPLOAD_PART_SIZE parts (B2 rejects smaller parts except the
+# last one) and each part is sent as soon as it is full, with at most
+# UPLOAD_MAX_PARTS_IN_FLIGHT parts being sent at once. Reading waits for a free
+# slot, so one upload holds about (UPLOAD_MAX_PARTS_IN_FLIGHT + 2) parts in
+# memory whatever its size. Uploads of a single part are sent in one request.
+
+
+async def read_parts(
+    chunks: AsyncIterator[bytes], part_size: int
+) -> AsyncIterator[bytes]:
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+class StoredUpload(NamedTuple):
+    url: str
+    sha256: str
+    reused: bool  # An identical file was stored already, nothing was added
+
+
+async def upload_stream(
+    chunks: AsyncIterator[bytes],
+    file_name: str,
+    find_existing: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+) -> StoredUpload:
+    """
+    Upload the bytes of `chunks` to B2 as `file_name`, hashing them on the way.
+
+    `find_existing(sha256)` returns the url of a stored file with the same
+    content, if any, which is then used instead. The hash is only known once
+    the last chunk is read, so this skips the upload of single part files and
+    cancels the already uploaded parts of larger ones.
+    """
+    digest = hashlib.sha256()
+
+    async def hashed_chunks():
+        async for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+
+    async def existing_url() -> Optional[str]:
+        return find_existing and await find_existing(digest.hexdigest())
+
+    parts = read_parts(hashed_chunks(), config.UPLOAD_PART_SIZE)
+    part = await anext(parts, b"")
+    next_part = await anext(parts, b"")
+    if not next_part:
+        if url := await existing_url():
+            return StoredUpload(url, digest.hexdigest(), reused=True)
+        url = await storage.upload_bytes(part, file_name)
+        return StoredUpload(url, digest.hexdigest(), reused=False)
+
+    file_id = await storage.start_large_file(file_name)
+    slots = asyncio.Semaphore(config.UPLOAD_MAX_PARTS_IN_FLIGHT)
+    uploads: list[asyncio.Task] = []
+
+    async def upload_part(part_number: int, data: bytes) -> str:
+        try:
+            return await storage.upload_part(file_id, part_number, data)
+        finally:
+            slots.release()
+
+    try:
+        part_number = 1
+        while part:
+            await slots.acquire()
+            for upload in uploads:
+                if upload.done() and upload.exception():
+                    raise upload.exception()
+            uploads.append(asyncio.create_task(upload_part(part_number, part)))
+            part_number += 1
+            part, next_part = next_part, next_part and await anext(parts, b"")
+        part_sha1s = await asyncio.gather(*uploads)
+        url = await existing_url()
+        if not url:
+            url = await storage.finish_large_file(file_id, part_sha1s)
+            return StoredUpload(url, digest.hexdigest(), reused=False)
+    except BaseException:
+        for upload in uploads:
+            upload.cancel()
+        await asyncio.gather(*uploads, return_exceptions=True)
+        await _cancel_large_file(file_id)
+        raise
+    await _cancel_large_file(file_id)
+    return StoredUpload(url, digest.hexdigest(), reused=True)
+
+
+async def _cancel_large_file(file_id: str):
+    try:
+        await storage.cancel_large_file(file_id)
+    except Exception:
+        logger.exception(f"Could not cancel large file {file_id}")
@@ -0,0 +1,63 @@
+import json
+import logging
+from contextlib import aclosing
+from typing import Callable, Optional
+
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from social_media_app.database import database
+
+logger = logging.getLogger(__name__)
+
+# Streaming (NDJSON) responses
+# Rows are pulled from the database one at a time with `database.iterate` and
+# written as one json document per line, so memory per request stays constant
+# and the first bytes go out before the query has finished. The ASGI server
+# only asks for the next line once the previous one was sent, which slows the
+# database cursor down to the speed of the client.
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    return accept is not None and NDJSON_MEDIA_TYPE in accept
+
+
+async def _ndjson_lines(
+    query,
+    model: type[BaseModel],
+    limit: Optional[int],
+    next_cursor: Optional[Callable],
+):
+    count = 0
+    last_row = None
+    async with aclosing(database.iterate(query)) as rows:
+        async for row in rows:
+            if limit is not None and count == limit:
+                # One extra row was found: the last line links to the next page
+                yield json.dumps({"next_cursor": next_cursor(last_row)}) + "\n"
+                break
+            yield model.model_validate(row).model_dump_json() + "\n"
+            last_row = row
+            count += 1
+    logger.debug(f"Streamed {count} rows")
+
+
+def ndjson_response(
+    query,
+    model: type[BaseModel],
+    limit: Optional[int] = None,
+    next_cursor: Optional[Callable] = None,
+    headers: Optional[dict] = None,
+) -> StreamingResponse:
+    """
+    Stream `query` rows serialized with `model`. When `limit` is set the query
+    must fetch `limit + 1` rows; if the extra row exists a final
+    `{"next_cursor": ...}` line built by `next_cursor(last_row)` is written.
+    """
+    return StreamingResponse(
+        _ndjson_lines(query, model, limit, next_cursor),
+        media_type=NDJSON_MEDIA_TYPE,
+        headers=headers,
+    )
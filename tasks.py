@@ -1,11 +1,20 @@
+import asyncio
+import datetime
+import json
 import logging
 from json import JSONDecodeError
+from typing import NamedTuple
 
 import httpx
+import sqlalchemy
 from databases import Database
 
+from social_media_app.cache import post_cache
 from social_media_app.config import config
-from social_media_app.database import post_table
+from social_media_app.database import comment_table, like_table, post_table, utcnow
+from social_media_app.prompt_cache import prompt_cache
+from social_media_app.resilience import Integration, IntegrationUnavailableError
+from social_media_app.versions import FEED, HOT_FEED, bump_versions, post_key
 
 logger = logging.getLogger(__name__)
 
@@ -14,67 +23,229 @@ class APIResponseError(Exception):
     pass
 
 
+mailgun = Integration("mailgun")
+deepai = Integration("deepai")
+INTEGRATIONS = {integration.name: integration for integration in (mailgun, deepai)}
+
+
 async def send_simple_email(to: str, subject: str, body: str):
     logger.debug(f"Sending email to '{to[:3]}' , with subject '{subject[:20]}' ")
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await mailgun.post(
+            f"https://api.mailgun.net/v3/{config.MAILGUN_DOMAIN}/messages",
+            auth=("api", config.MAILGUN_API_KEY),
+            data={
+                "from": f"Social Media App <postmaster@{config.MAILGUN_DOMAIN}>",
+                "to": f"{to} <{to}>",
+                "subject": subject,
+                "text": body,
+            },
+        )
+        response.raise_for_status()
+
+        logger.debug(response.content)
+
+        return response
+
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code of {err.response.status_code}"
+        ) from err
+    except IntegrationUnavailableError as err:
+        raise APIResponseError(str(err)) from err
+
+
+class EmailTemplate(NamedTuple):
+    # `text` is filled in per recipient by Mailgun from %recipient.<name>%
+    name: str
+    subject: str
+    text: str
+
+
+REGISTRATION_EMAIL = EmailTemplate(
+    "registration",
+    "Successfully signed up",
+    "Hi %recipient.email%! You have successfully signed up to Social Media REST API."
+    " Please confirm your email by clicking on the"
+    " following link: %recipient.confirmation_url%",
+)
+IMAGE_FAILED_EMAIL = EmailTemplate(
+    "image_failed",
+    "Failed to generate image",
+    "Hi %recipient.email%! You have failed to generate image for post"
+    " %recipient.post_url%. Please try again later.",
+)
+IMAGE_GENERATED_EMAIL = EmailTemplate(
+    "image_generated",
+    "Image generated successfully",
+    "Hi %recipient.email%! You have successfully generated image for post"
+    " %recipient.post_url%. Please check your email for the image.",
+)
+
+
+class _PendingEmail(NamedTuple):
+    to: str
+    variables: dict
+    future: asyncio.Future
+
+
+class EmailDispatcher:
+    """
+    Coalesces emails using the same template into one Mailgun request with
+    recipient-variables, up to `max_recipients` per request. A batch is sent
+    `window` seconds after its first email, or as soon as it is full.
+
+    send() resolves once the recipient's email was accepted, or raises
+    APIResponseError for that recipient only: a batch rejected because of a
+    bad address is split in halves until the bad address is isolated.
+    """
+
+    def __init__(self, window: float, max_recipients: int):
+        self.window = window
+        self.max_recipients = max_recipients
+        self.batches_sent = 0
+        self.emails_sent = 0
+        self.emails_failed = 0
+        self._pending: dict[EmailTemplate, list[_PendingEmail]] = {}
+        self._timers: dict[EmailTemplate, asyncio.Task] = {}
+        self._sending: set[asyncio.Task] = set()
+
+    async def send(self, template: EmailTemplate, to: str, **variables):
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(template, [])
+        pending.append(_PendingEmail(to, {"email": to, **variables}, future))
+        if len(pending) >= self.max_recipients:
+            task = asyncio.create_task(self._send(template, self._take(template)))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+        elif template not in self._timers:
+            self._timers[template] = asyncio.create_task(self._send_after_window(template))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches_sent": self.batches_sent,
+            "emails_sent": self.emails_sent,
+            "emails_failed": self.emails_failed,
+        }
+
+    def _take(self, template: EmailTemplate) -> list[_PendingEmail]:
+        timer = self._timers.pop(template, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        return self._pending.pop(template, [])
+
+    async def _send_after_window(self, template: EmailTemplate):
+        await asyncio.sleep(self.window)
+        await self._send(template, self._take(template))
+
+    async def _send(self, template: EmailTemplate, emails: list[_PendingEmail]):
+        # recipient-variables are keyed by address, so one address per request
+        batches: list[list[_PendingEmail]] = []
+        for email in emails:
+            batch = next(
+                (b for b in batches if all(e.to != email.to for e in b)), None
+            )
+            if batch is None:
+                batches.append([email])
+            else:
+                batch.append(email)
+        for batch in batches:
+            await self._deliver(template, batch)
+
+    async def _deliver(self, template: EmailTemplate, batch: list[_PendingEmail]):
+        logger.debug(f"Sending '{template.name}' email to {len(batch)} recipients")
         try:
-            response = await client.post(
+            response = await mailgun.post(
                 f"https://api.mailgun.net/v3/{config.MAILGUN_DOMAIN}/messages",
                 auth=("api", config.MAILGUN_API_KEY),
                 data={
                     "from": f"Social Media App <postmaster@{config.MAILGUN_DOMAIN}>",
-                    "to": f"{to} <{to}>",
-                    "subject": subject,
-                    "text": body,
+                    "to": [email.to for email in batch],
+                    "subject": template.subject,
+                    "text": template.text,
+                    "recipient-variables": json.dumps(
+                        {email.to: email.variables for email in batch}
+                    ),
                 },
             )
             response.raise_for_status()
+        except httpx.HTTPStatusError as err:
+            if err.response.status_code == 400 and len(batch) > 1:
+                half = len(batch) // 2
+                await self._deliver(template, batch[:half])
+                await self._deliver(template, batch[half:])
+                return
+            self._fail(
+                batch,
+                APIResponseError(
+                    f"API request failed with status code of {err.response.status_code}"
+                ),
+            )
+            return
+        except IntegrationUnavailableError as err:
+            self._fail(batch, APIResponseError(str(err)))
+            return
+        except Exception as err:
+            self._fail(batch, err)
+            return
+        self.batches_sent += 1
+        self.emails_sent += len(batch)
+        for email in batch:
+            if not email.future.done():
+                email.future.set_result(None)
 
-            logger.debug(response.content)
+    def _fail(self, batch: list[_PendingEmail], error: Exception):
+        logger.error(f"Failed to send email to {len(batch)} recipients: {error}")
+        self.emails_failed += len(batch)
+        for email in batch:
+            if not email.future.done():
+                email.future.set_exception(error)
 
-            return response
 
-        except httpx.HTTPStatusError as err:
-            raise APIResponseError(
-                f"API request failed with status code of {err.response.status_code}"
-            ) from err
+email_dispatcher = EmailDispatcher(
+    config.MAILGUN_BATCH_WINDOW_SECONDS, config.MAILGUN_BATCH_MAX_RECIPIENTS
+)
 
 
 async def send_user_registeration_email(email: str, confirmation_url: str):
-    return await send_simple_email(
-        email,
-        "Successfully signed up",
-        (
-            f"Hi {email}! You have successfully signed up to Social Media REST API."
-            " Please confirm your email by clicking on the"
-            f" following link: {confirmation_url}"
-        ),
+    return await email_dispatcher.send(
+        REGISTRATION_EMAIL, email, confirmation_url=confirmation_url
     )
 
 
 async def _generate_cute_creature_image_api(prompt: str):
     logger.debug(f"Generating image for prompt '{prompt[:20]}'")
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                "https://api.deepai.org/api/text2img",
-                data={
-                    "text": f"{prompt}",
-                },
-                headers={"api-key": config.DEEPAI_API_KEY},
-            )
-            logger.debug(response)
-            response.raise_for_status()
-            return response.json()
+    try:
+        response = await deepai.post(
+            "https://api.deepai.org/api/text2img",
+            data={
+                "text": f"{prompt}",
+            },
+            headers={"api-key": config.DEEPAI_API_KEY},
+        )
+        logger.debug(response)
+        response.raise_for_status()
+        return response.json()
+
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"DeepAI API request failed with status code of {err.response.status_code}"
+        ) from err
+    except (JSONDecodeError, TypeError) as err:
+        raise APIResponseError(
+            f"API response parsing failed with error {err}"
+        ) from err
+    except IntegrationUnavailableError as err:
+        raise APIResponseError(str(err)) from err
 
-        except httpx.HTTPStatusError as err:
-            raise APIResponseError(
-                f"DeepAI API request failed with status code of {err.response.status_code}"
-            ) from err
-        except (JSONDecodeError, TypeError) as err:
-            raise APIResponseError(
-                f"API response parsing failed with error {err}"
-            ) from err
+
+async def _generate_image_url(prompt: str) -> str:
+    response = await _generate_cute_creature_image_api(prompt)
+    try:
+        return response["output_url"]
+    except (KeyError, TypeError) as err:
+        raise APIResponseError(f"DeepAI API response has no output_url: {err}") from err
 
 
 async def generate_and_add_to_post(
@@ -85,31 +256,167 @@ async def generate_and_add_to_post(
     prompt: str = "A blue cat is sitting on couch",
 ):
     try:
-        response = await _generate_cute_creature_image_api(prompt)
+        output_url = await prompt_cache.get_or_generate(
+            database, prompt, _generate_image_url
+        )
     except APIResponseError:
-        return await send_simple_email(
-            email,
-            "Failed to generate image",
-            (
-                f"Hi {email}! You have failed to generate image for post {post_url}."
-                " Please try again later."
-            ),
+        return await email_dispatcher.send(
+            IMAGE_FAILED_EMAIL, email, post_url=str(post_url)
         )
     logger.debug("Connecting to database to update post")
     query = (
         post_table.update()
         .where(post_table.c.id == post_id)
-        .values({"image_url": response["output_url"]})
+        .values({"image_url": output_url})
     )
     logger.debug(query)
-    await database.execute(query)
+    async with database.transaction():
+        await database.execute(query)
+        await bump_versions(post_key(post_id), FEED)
+    await post_cache.invalidate(post_id)
     logger.debug("Database connection in background task closed")
-    return await send_simple_email(
-        email,
-        "Image generated successfully",
-        (
-            f"Hi {email}! You have successfully generated image for post {post_url}."
-            " Please check your email for the image."
-        ),
+    return await email_dispatcher.send(
+        IMAGE_GENERATED_EMAIL, email, post_url=str(post_url)
+    )
+
+
+async def reconcile_post_counters(database: Database):
+    """
+    Recompute the denormalized like / comment counters on the post table from
+    the likes and comments tables, fixing any drift.
+    """
+    logger.info("Reconciling post like and comment counters")
+    like_count = (
+        sqlalchemy.select(sqlalchemy.func.count(like_table.c.id))
+        .where(like_table.c.post_id == post_table.c.id)
+        .scalar_subquery()
+    )
+    comment_count = (
+        sqlalchemy.select(sqlalchemy.func.count(comment_table.c.id))
+        .where(comment_table.c.post_id == post_table.c.id)
+        .scalar_subquery()
+    )
+    drifted = sqlalchemy.select(post_table.c.id).where(
+        sqlalchemy.or_(
+            post_table.c.like_count != like_count,
+            post_table.c.comment_count != comment_count,
+        )
+    )
+    logger.debug(drifted)
+    post_ids = [row.id for row in await database.fetch_all(drifted)]
+    if not post_ids:
+        return
+    logger.info(f"Fixing counters of {len(post_ids)} posts")
+    query = (
+        post_table.update()
+        .where(post_table.c.id.in_(post_ids))
+        .values(like_count=like_count, comment_count=comment_count)
+    )
+    logger.debug(query)
+    async with database.transaction():
+        await database.execute(query)
+        await bump_versions(*[post_key(post_id) for post_id in post_ids], FEED)
+    for post_id in post_ids:
+        await post_cache.invalidate(post_id)
+
+
+# Hot ranking: activity in the last HOT_WINDOW divided by a power of the age,
+# score = (1 + likes + COMMENT_WEIGHT * comments) / (age_hours + 2) ** GRAVITY
+HOT_WINDOW = datetime.timedelta(hours=48)
+HOT_COMMENT_WEIGHT = 2
+HOT_GRAVITY = 1.5
+
+
+def hot_score(likes: int, comments: int, age_hours: float) -> float:
+    activity = 1 + likes + HOT_COMMENT_WEIGHT * comments
+    return activity / (max(age_hours, 0) + 2) ** HOT_GRAVITY
+
+
+async def update_hot_scores(database: Database, now: datetime.datetime | None = None):
+    """
+    Recompute post.hot_score for posts that can have a non zero score: posts
+    created or liked / commented within HOT_WINDOW, plus posts that still have
+    a score and need it decayed to zero. Everything else is left untouched.
+    """
+    now = now or utcnow()
+    since = now - HOT_WINDOW
+    recent_likes = (
+        sqlalchemy.select(like_table.c.post_id, sqlalchemy.func.count().label("n"))
+        .where(like_table.c.created_at >= since)
+        .group_by(like_table.c.post_id)
     )
-    return response
+    recent_comments = (
+        sqlalchemy.select(comment_table.c.post_id, sqlalchemy.func.count().label("n"))
+        .where(comment_table.c.created_at >= since)
+        .group_by(comment_table.c.post_id)
+    )
+    likes = {row.post_id: row.n for row in await database.fetch_all(recent_likes)}
+    comments = {
+        row.post_id: row.n for row in await database.fetch_all(recent_comments)
+    }
+    candidates = sqlalchemy.select(
+        post_table.c.id, post_table.c.created_at, post_table.c.hot_score
+    ).where(
+        sqlalchemy.or_(
+            post_table.c.created_at >= since,
+            post_table.c.hot_score > 0,
+            post_table.c.id.in_(likes.keys() | comments.keys()),
+        )
+    )
+    logger.debug(candidates)
+    posts = await database.fetch_all(candidates)
+
+    scores = {}
+    for post in posts:
+        score = 0.0
+        if post.created_at is not None:
+            age_hours = (now - post.created_at).total_seconds() / 3600
+            recent = likes.get(post.id, 0) + comments.get(post.id, 0)
+            if recent or post.created_at >= since:
+                score = hot_score(
+                    likes.get(post.id, 0), comments.get(post.id, 0), age_hours
+                )
+        if score != post.hot_score:
+            scores[post.id] = score
+    if not scores:
+        return
+    logger.info(f"Updating hot score of {len(scores)} posts")
+    async with database.transaction():
+        for post_id, score in scores.items():
+            await database.execute(
+                post_table.update()
+                .where(post_table.c.id == post_id)
+                .values(hot_score=score)
+            )
+        if _hot_order_changed(posts, scores):
+            await bump_versions(HOT_FEED)
+
+
+def _hot_order_changed(posts: list, scores: dict[int, float]) -> bool:
+    """
+    Whether the new `scores` reorder the hot feed. Scores decay on every run,
+    but the feed only changes when the ranking does. Posts outside `posts`
+    all score 0, so a post moving from or to 0 moves relative to them too.
+    """
+    old = {post.id: post.hot_score or 0.0 for post in posts}
+    new = {**old, **scores}
+    if any((old[post_id] > 0) != (new[post_id] > 0) for post_id in scores):
+        return True
+
+    def ranking(score: dict[int, float]) -> list[int]:
+        return sorted(score, key=lambda post_id: (-score[post_id], -post_id))
+
+    return ranking(old) != ranking(new)
+
+
+async def run_periodically(interval: float, func, *args):
+    """
+    Run `func(*args)` every `interval` seconds until cancelled, logging and
+    swallowing errors so one failed run does not stop the schedule.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func(*args)
+        except Exception:
+            logger.exception(f"Periodic task {func.__name__} failed")
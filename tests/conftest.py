@@ -8,8 +8,19 @@ from httpx import ASGITransport, AsyncClient, Request, Response
 
 os.environ["ENV_STATE"] = "test"
 
-from social_media_app.database import database, user_table
+from social_media_app.cache import post_cache  # noqa: E402
+from social_media_app.database import database, engine, user_table  # noqa: E402
+from social_media_app.http_client import http_client  # noqa: E402
+from social_media_app.leaderboard import most_liked_posts  # noqa: E402
 from social_media_app.main import app  # noqa: E402
+from social_media_app.migrations import migrate  # noqa: E402
+from social_media_app.security import (  # noqa: E402
+    token_cache,
+    token_deny_list,
+    user_cache,
+)
+from social_media_app.tasks import INTEGRATIONS  # noqa: E402
+from social_media_app.tests.fake_mailgun import create_fake_mailgun  # noqa: E402
 from social_media_app.tests.helpers import create_post # noqa: E402
 
 @pytest.fixture(scope="session")
@@ -17,6 +28,11 @@ def anyio_backend():
     return "asyncio"
 
 
+@pytest.fixture(scope="session", autouse=True)
+def migrated_database():
+    migrate(engine)
+
+
 @pytest.fixture()
 def client() -> Generator:
     yield TestClient(app)
@@ -29,6 +45,14 @@ async def db() -> AsyncGenerator:
     await database.connect()
     yield database
     await database.disconnect()
+    # The database is rolled back after each test, so cached reads must go too
+    post_cache.clear()
+    most_liked_posts.reset()
+    user_cache.clear()
+    token_cache.clear()
+    token_deny_list.clear()
+    for integration in INTEGRATIONS.values():
+        integration.reset()
 
 
 @pytest.fixture()
@@ -76,14 +100,25 @@ async def logged_in_token(async_client: AsyncClient, confirmed_user: dict) -> st
 
 @pytest.fixture(autouse=True)
 def mock_httpx_client(mocker):
-    mocked_cleint = mocker.patch("social_media_app.tasks.httpx.AsyncClient")
-
     mocked_async_client = Mock()
     response = Response(status_code=200, content="", request=Request("POST", "//"))
     mocked_async_client.post = AsyncMock(return_value=response)
-    mocked_cleint.return_value.__aenter__.return_value = mocked_async_client
+    mocker.patch.object(http_client, "_client", mocked_async_client)
     return mocked_async_client
 
+@pytest.fixture()
+async def fake_mailgun(mocker):
+    mocker.patch.multiple(
+        "social_media_app.tasks.config",
+        MAILGUN_DOMAIN="example.net",
+        MAILGUN_API_KEY="key",
+    )
+    fake = create_fake_mailgun(rejected={"rejected@example.net"})
+    async with AsyncClient(transport=ASGITransport(app=fake)) as client:
+        mocker.patch.object(http_client, "_client", client)
+        yield fake.state
+
+
 @pytest.fixture()
 async def created_post(async_client: AsyncClient, logged_in_token: str):
     return await create_post("Test post", async_client, logged_in_token)
\ No newline at end of file
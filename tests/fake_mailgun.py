@@ -0,0 +1,49 @@
+import json
+import re
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+MAX_RECIPIENTS = 1000
+
+
+def create_fake_mailgun(rejected: set[str] = frozenset()) -> FastAPI:
+    """
+    In-process stand-in for the Mailgun messages API, served to the app's
+    http client through httpx.ASGITransport so tests run offline. Requests are
+    kept in app.state.requests and the per-recipient emails Mailgun would
+    deliver (recipient variables filled in) in app.state.delivered. A request
+    with an address in `rejected` fails as a whole, like Mailgun does.
+    """
+    app = FastAPI()
+    app.state.requests = []
+    app.state.delivered = []
+
+    @app.post("/v3/{domain}/messages")
+    async def messages(domain: str, request: Request):
+        form = await request.form()
+        to = form.getlist("to")
+        app.state.requests.append(to)
+        invalid = [address for address in to if "@" not in address or address in rejected]
+        if invalid:
+            return JSONResponse(
+                {"message": f"'to' parameter is not a valid address: {invalid[0]}"},
+                status_code=400,
+            )
+        if len(to) > MAX_RECIPIENTS:
+            return JSONResponse({"message": "Too many recipients"}, status_code=400)
+
+        variables = json.loads(form.get("recipient-variables", "{}"))
+        for address in to:
+            text = re.sub(
+                r"%recipient\.(\w+)%",
+                lambda match: str(variables.get(address, {}).get(match[1], "")),
+                form["text"],
+            )
+            app.state.delivered.append(
+                {"to": address, "subject": form["subject"], "text": text}
+            )
+        return {"id": f"<{uuid.uuid4().hex}@{domain}>", "message": "Queued. Thank you."}
+
+    return app
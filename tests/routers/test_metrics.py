@@ -0,0 +1,11 @@
+import pytest
+from httpx import AsyncClient
+
+
+@pytest.mark.anyio
+async def test_get_metrics(async_client: AsyncClient, created_post: dict):
+    await async_client.get(f"/post/{created_post['id']}")
+    await async_client.get(f"/post/{created_post['id']}")
+    response = await async_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.json()["post_cache"]["hits"] >= 1
@@ -1,8 +1,19 @@
+import json
+
 import pytest
 from httpx import AsyncClient
 
 from social_media_app import security
+from social_media_app.cache import post_cache
+from social_media_app.database import database, post_table
+from social_media_app.jobs import JobWorker
+from social_media_app.leaderboard import most_liked_posts
+from social_media_app.like_buffer import like_buffer
+from social_media_app.prompt_cache import prompt_cache
+from social_media_app.routers import post as post_router
+from social_media_app.tasks import update_hot_scores
 from social_media_app.tests.helpers import create_post,create_comment,like_post
+from social_media_app.versions import HOT_FEED, bump_versions, post_key
 
 @pytest.fixture()
 async def mock_generate_cute_cereature_api(mocker):
@@ -53,10 +64,28 @@ async def test_create_post_with_prompt(
         "body": body,
         "image_url": None,
     }.items() <= response.json().items()
+    mock_generate_cute_cereature_api.assert_not_called()
+
+    await JobWorker(database).run_once()
     mock_generate_cute_cereature_api.assert_called()
 
 
 
+@pytest.mark.anyio
+async def test_create_post_with_cached_prompt(
+    async_client: AsyncClient, logged_in_token: str, mock_generate_cute_cereature_api
+):
+    await prompt_cache.set(database, "A cat", "https://example.com/cat.jpg")
+    response = await async_client.post(
+        "/post?prompt=a  cat",
+        json={"body": "Test Post"},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.json()["image_url"] == "https://example.com/cat.jpg"
+    await JobWorker(database).run_once()
+    mock_generate_cute_cereature_api.assert_not_called()
+
+
 @pytest.mark.anyio
 async def test_create_post_expired_token(
     async_client: AsyncClient, confirmed_user: dict, mocker
@@ -98,6 +127,94 @@ async def test_like_post(
     assert response.status_code == 201
 
 
+@pytest.mark.anyio
+async def test_like_post_updates_like_count(
+    created_post: dict, async_client: AsyncClient, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 2
+
+
+@pytest.mark.anyio
+async def test_like_missing_post(async_client: AsyncClient, logged_in_token: str):
+    response = await async_client.post(
+        "/like",
+        json={"post_id": 2},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_create_posts_batch(
+    async_client: AsyncClient, confirmed_user: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/post/batch",
+        json=[{"body": "Test Post 1"}, {"body": "Test Post 2"}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 207
+    assert [item["id"] for item in response.json()] == [1, 2]
+
+    response = await async_client.get("/post", params={"sorting": "old"})
+    assert [post["body"] for post in response.json()] == ["Test Post 1", "Test Post 2"]
+
+
+@pytest.mark.anyio
+async def test_like_posts_batch_partial_failure(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/like/batch",
+        json=[
+            {"post_id": created_post["id"]},
+            {"post_id": 99},
+            {"post_id": created_post["id"]},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 207
+    assert [item["status_code"] for item in response.json()] == [201, 404, 201]
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 2
+
+
+@pytest.mark.anyio
+async def test_create_comments_batch(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/comment/batch",
+        json=[
+            {"body": "Test comment", "post_id": created_post["id"]},
+            {"body": "Test comment", "post_id": 99},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 207
+    assert response.json() == [
+        {"index": 0, "status_code": 201, "id": 1, "detail": None},
+        {"index": 1, "status_code": 404, "id": None, "detail": "Post not found"},
+    ]
+
+    response = await async_client.get(f"/post/{created_post['id']}/comments")
+    assert len(response.json()) == 1
+
+
+@pytest.mark.anyio
+async def test_batch_too_large(async_client: AsyncClient, logged_in_token: str):
+    response = await async_client.post(
+        "/post/batch",
+        json=[{"body": "Test Post"}] * 101,
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 422
+
+
 @pytest.mark.anyio
 async def test_get_all_posts(async_client: AsyncClient, created_post: dict):
     response = await async_client.get("/post")
@@ -139,6 +256,133 @@ async def test_get_all_posts_sorting_likes(
     assert posts_ids == excepted_order
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "sorting, excepted_pages",
+    [("new", [[3, 2], [1]]), ("old", [[1, 2], [3]]), ("most_likes", [[2, 3], [1]])],
+)
+async def test_get_all_posts_pagination(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sorting: str,
+    excepted_pages: list[list[int]],
+):
+    for body in ("Test Post 1", "Test Post 2", "Test Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+
+    pages = []
+    params = {"sorting": sorting, "limit": 2}
+    while True:
+        response = await async_client.get("/post", params=params)
+        assert response.status_code == 200
+        pages.append([post["id"] for post in response.json()])
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert pages == excepted_pages
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("leaderboard_size", [2, 10])
+async def test_get_all_posts_most_likes_leaderboard(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    mocker,
+    leaderboard_size: int,
+):
+    mocker.patch.object(most_liked_posts, "k", leaderboard_size)
+    await most_liked_posts.seed(database)
+    for body in ("Test Post 1", "Test Post 2", "Test Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    await like_post(1, async_client, logged_in_token)
+    await like_post(3, async_client, logged_in_token)
+    await like_post(3, async_client, logged_in_token)
+    page = mocker.spy(most_liked_posts, "page")
+
+    pages = []
+    params = {"sorting": "most_likes", "limit": 1}
+    while True:
+        response = await async_client.get("/post", params=params)
+        pages.append([post["id"] for post in response.json()])
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert pages == [[3], [1], [2]]
+    # Pages reaching past a board of 2 come from the database
+    served = [result is not None for result in page.spy_return_list]
+    assert served == [True, False, False] if leaderboard_size == 2 else [True] * 3
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_sorting_hot(
+    async_client: AsyncClient, logged_in_token: str
+):
+    for body in ("Test Post 1", "Test Post 2", "Test Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    await like_post(1, async_client, logged_in_token)
+    await like_post(1, async_client, logged_in_token)
+    await create_comment("Test comment", 1, async_client, logged_in_token)
+    await update_hot_scores(database)
+
+    response = await async_client.get("/post", params={"sorting": "hot", "limit": 2})
+    assert [post["id"] for post in response.json()] == [1, 3]
+    response = await async_client.get(
+        "/post",
+        params={
+            "sorting": "hot",
+            "limit": 2,
+            "cursor": response.headers["X-Next-Cursor"],
+        },
+    )
+    assert [post["id"] for post in response.json()] == [2]
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_unpaginated(
+    async_client: AsyncClient, logged_in_token: str
+):
+    for body in ("Test Post 1", "Test Post 2", "Test Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    response = await async_client.get("/post", params={"limit": 1, "paginate": False})
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("cursor", ["not a cursor", "eyJzb3J0aW5nIjoib2xkIiwiaWQiOjF9"])
+async def test_get_all_posts_invalid_cursor(
+    async_client: AsyncClient, created_post: dict, cursor: str
+):
+    response = await async_client.get("/post", params={"sorting": "new", "cursor": cursor})
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_ndjson(async_client: AsyncClient, logged_in_token: str):
+    for body in ("Test Post 1", "Test Post 2", "Test Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    response = await async_client.get(
+        "/post",
+        params={"limit": 2},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [post["id"] for post in lines[:2]] == [3, 2]
+
+    response = await async_client.get(
+        "/post",
+        params={"limit": 2, "cursor": lines[2]["next_cursor"]},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [1]
+
+
 @pytest.mark.anyio
 async def test_get_all_posts_sorting_wrong(
     async_client: AsyncClient,
@@ -148,6 +392,67 @@ async def test_get_all_posts_sorting_wrong(
     assert response.status_code == 422
 
 
+@pytest.mark.anyio
+async def test_search_posts(async_client: AsyncClient, logged_in_token: str):
+    await create_post("A blue cat on the couch", async_client, logged_in_token)
+    await create_post("A dog in the garden", async_client, logged_in_token)
+    await create_post("Cats and cats and more cats", async_client, logged_in_token)
+
+    response = await async_client.get("/post/search", params={"q": "cat"})
+    assert response.status_code == 200
+    data = response.json()
+    assert [post["id"] for post in data] == [3, 1]
+    assert "<mark>cat</mark>" in data[1]["snippet"]
+
+
+@pytest.mark.anyio
+async def test_search_posts_escapes_markup(
+    async_client: AsyncClient, logged_in_token: str
+):
+    await create_post(
+        'A cat <img src=x onerror="alert(1)"><script>alert(2)</script>',
+        async_client,
+        logged_in_token,
+    )
+
+    response = await async_client.get("/post/search", params={"q": "cat"})
+    snippet = response.json()[0]["snippet"]
+    assert "<mark>cat</mark>" in snippet
+    assert "<img" not in snippet and "<script>" not in snippet
+    assert "&lt;script&gt;" in snippet
+
+
+@pytest.mark.anyio
+async def test_search_posts_pagination(async_client: AsyncClient, logged_in_token: str):
+    for _ in range(3):
+        await create_post("Test post", async_client, logged_in_token)
+
+    response = await async_client.get("/post/search", params={"q": "test", "limit": 2})
+    ids = [post["id"] for post in response.json()]
+    response = await async_client.get(
+        "/post/search",
+        params={"q": "test", "limit": 2, "cursor": response.headers["X-Next-Cursor"]},
+    )
+    ids += [post["id"] for post in response.json()]
+    assert ids == [1, 2, 3]
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("q", ['"unbalanced', "cat OR", "NEAR(cat"])
+async def test_search_posts_ignores_query_syntax(
+    async_client: AsyncClient, created_post: dict, q: str
+):
+    response = await async_client.get("/post/search", params={"q": q})
+    assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_search_posts_blank_query(async_client: AsyncClient):
+    response = await async_client.get("/post/search", params={"q": "  "})
+    assert response.status_code == 422
+
+
 @pytest.mark.anyio
 async def test_create_comment(
     async_client: AsyncClient,
@@ -181,6 +486,40 @@ async def test_get_comments_on_post(
     assert response.json() == [created_comment]
 
 
+@pytest.mark.anyio
+async def test_get_comments_on_post_ndjson(
+    async_client: AsyncClient, created_post: dict, created_comment: dict
+):
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comments",
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        created_comment
+    ]
+
+
+@pytest.mark.anyio
+async def test_get_comments_on_post_pagination(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    for _ in range(3):
+        await create_comment("Test comment", created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comments", params={"limit": 2}
+    )
+    assert [comment["id"] for comment in response.json()] == [1, 2]
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comments",
+        params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]},
+    )
+    assert [comment["id"] for comment in response.json()] == [3]
+    assert "X-Next-Cursor" not in response.headers
+
+
 @pytest.mark.anyio
 async def test_get_comments_on_post_empty(
     async_client: AsyncClient, created_post: dict
@@ -203,6 +542,166 @@ async def test_get_post_with_comments(
     }.items() <= response.json().items()
 
 
+@pytest.mark.anyio
+async def test_get_post_with_comments_bounded(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str, mocker
+):
+    mocker.patch("social_media_app.routers.post.EMBEDDED_COMMENTS", 2)
+    for _ in range(3):
+        await create_comment("Test comment", created_post["id"], async_client, logged_in_token)
+
+    data = (await async_client.get(f"/post/{created_post['id']}")).json()
+    assert [comment["id"] for comment in data["comments"]] == [1, 2]
+    assert data["comments_total"] == 3
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comments",
+        params={"cursor": data["comments_next_cursor"]},
+    )
+    assert [comment["id"] for comment in response.json()] == [3]
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_cached(
+    async_client: AsyncClient, created_post: dict, mocker
+):
+    first = await async_client.get(f"/post/{created_post['id']}")
+    cache_get = mocker.spy(post_cache, "get")
+    second = await async_client.get(f"/post/{created_post['id']}")
+
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    assert cache_get.spy_return is not None
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_invalidated_on_write(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await async_client.get(f"/post/{created_post['id']}")
+    await like_post(created_post["id"], async_client, logged_in_token)
+    await create_comment("Test comment", created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 1
+    assert len(response.json()["comments"]) == 1
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_not_cached_when_written_meanwhile(
+    async_client: AsyncClient, created_post: dict, mocker
+):
+    fetch_comments_page = post_router.fetch_comments_page
+
+    async def comment_written_meanwhile(*args, **kwargs):
+        await bump_versions(post_key(created_post["id"]))
+        return await fetch_comments_page(*args, **kwargs)
+
+    mocker.patch.object(
+        post_router, "fetch_comments_page", side_effect=comment_written_meanwhile
+    )
+    cache_set = mocker.spy(post_cache, "set")
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.status_code == 200
+    cache_set.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_written_by_another_process(
+    async_client: AsyncClient, created_post: dict
+):
+    await async_client.get(f"/post/{created_post['id']}")
+    # A like from another worker does not invalidate this worker's cache
+    await database.execute(
+        post_table.update()
+        .where(post_table.c.id == created_post["id"])
+        .values(like_count=1)
+    )
+    await bump_versions(post_key(created_post["id"]))
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 1
+    etag = response.headers["ETag"]
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_etag_covers_buffered_likes(
+    async_client: AsyncClient, created_post: dict, mocker
+):
+    etag = (await async_client.get(f"/post/{created_post['id']}")).headers["ETag"]
+    mocker.patch.object(like_buffer, "pending_likes", return_value=1)
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["post"]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_not_modified(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.get(f"/post/{created_post['id']}")
+    etag = response.headers["ETag"]
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    await create_comment("Test comment", created_post["id"], async_client, logged_in_token)
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_not_modified(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    etag = (await async_client.get("/post")).headers["ETag"]
+    response = await async_client.get("/post", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = await async_client.get(
+        "/post", params={"sorting": "old"}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.get("/post", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_hot_score_update_only_invalidates_hot_feed(
+    async_client: AsyncClient, created_post: dict
+):
+    new_etag = (await async_client.get("/post")).headers["ETag"]
+    hot_etag = (
+        await async_client.get("/post", params={"sorting": "hot"})
+    ).headers["ETag"]
+
+    await bump_versions(HOT_FEED)
+
+    response = await async_client.get("/post", headers={"If-None-Match": new_etag})
+    assert response.status_code == 304
+    response = await async_client.get(
+        "/post", params={"sorting": "hot"}, headers={"If-None-Match": hot_etag}
+    )
+    assert response.status_code == 200
+
+
 @pytest.mark.anyio
 async def test_get_missing_post_with_comments(
     async_client: AsyncClient, created_post: dict, created_comment: dict
@@ -1,44 +1,49 @@
-import contextlib
-import os
 import pathlib
 import tempfile
 
 import pytest
 from httpx import AsyncClient
 
+from social_media_app.config import config
+from social_media_app.security import create_access_token
+from social_media_app.storage import StorageUnavailableError
+
 
 # Create fake file system
 @pytest.fixture(autouse=True)
 def sample_image(fs) -> pathlib.Path:
     path = (pathlib.Path(__file__).parent / "asset" / "my_file.png").resolve()
-    fs.create_file(path)
+    fs.create_file(path, contents=b"0123456789")
     return path
 
 
-# Mock B2 upload file fixture
+# Mock B2 upload fixture
 @pytest.fixture(autouse=True)
-def mock_b2_upload_file(mocker):
+def mock_b2_upload_bytes(mocker):
     return mocker.patch(
-        "social_media_app.routers.upload.b2_upload_file",
+        "social_media_app.storage.b2_upload_bytes",
         return_value="https://example.com",
     )
 
 
-# Mock B2 open file fixture
-@pytest.fixture(autouse=True)
-def aiofiles_mock_open(mocker, fs):
-    mock_open = mocker.patch("aiofiles.open")
-
-    @contextlib.asynccontextmanager
-    async def async_file_open(fname: str, mode: str = "r"):
-        out_fs_mock = mocker.AsyncMock(name=f"async_file_open:{fname!r}/{mode!r}")
-        with open(fname, mode) as fin:
-            out_fs_mock.read.side_effect = fin.read
-            out_fs_mock.write.side_effect = fin.write
-            yield out_fs_mock
-
-    mock_open.side_effect = async_file_open
-    return mock_open
+# Mock B2 large file fixture
+@pytest.fixture()
+def mock_b2_large_file(mocker):
+    mocker.patch.object(config, "UPLOAD_PART_SIZE", 4)
+    return {
+        "start": mocker.patch(
+            "social_media_app.storage.b2_start_large_file", return_value="file-id"
+        ),
+        "upload_part": mocker.patch(
+            "social_media_app.storage.b2_upload_part",
+            side_effect=lambda file_id, part_number, data: f"sha1-{data.decode()}",
+        ),
+        "finish": mocker.patch(
+            "social_media_app.storage.b2_finish_large_file",
+            return_value="https://example.com/large",
+        ),
+        "cancel": mocker.patch("social_media_app.storage.b2_cancel_large_file"),
+    }
 
 
 async def call_upload_endpoint(
@@ -53,21 +58,302 @@ async def call_upload_endpoint(
 
 @pytest.mark.anyio
 async def test_upload_image(
-    async_client: AsyncClient, logged_in_token: str, sample_image: pathlib.Path
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sample_image: pathlib.Path,
+    mock_b2_upload_bytes,
 ):
     resposne = await call_upload_endpoint(async_client, logged_in_token, sample_image)
     assert resposne.status_code == 201
     assert resposne.json()["file_url"] == "https://example.com"
+    mock_b2_upload_bytes.assert_called_once_with(b"0123456789", "my_file.png")
 
 
 @pytest.mark.anyio
-async def test_temp_file_removed_after_upload(
+async def test_upload_does_not_use_temp_files(
     async_client: AsyncClient, logged_in_token: str, sample_image: pathlib.Path, mocker
 ):
     named_temp_file_spy = mocker.spy(tempfile, "NamedTemporaryFile")
+    spooled_temp_file_spy = mocker.spy(tempfile, "SpooledTemporaryFile")
+
+    response = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    assert response.status_code == 201
+
+    assert named_temp_file_spy.call_count == 0
+    assert spooled_temp_file_spy.call_count == 0
+
+
+@pytest.mark.anyio
+async def test_upload_large_file_in_parts(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sample_image: pathlib.Path,
+    mock_b2_upload_bytes,
+    mock_b2_large_file,
+):
+    response = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://example.com/large"
+
+    mock_b2_upload_bytes.assert_not_called()
+    mock_b2_large_file["start"].assert_called_once_with("my_file.png")
+    parts = [call.args for call in mock_b2_large_file["upload_part"].call_args_list]
+    assert sorted(parts) == [
+        ("file-id", 1, b"0123"),
+        ("file-id", 2, b"4567"),
+        ("file-id", 3, b"89"),
+    ]
+    mock_b2_large_file["finish"].assert_called_once_with(
+        "file-id", ["sha1-0123", "sha1-4567", "sha1-89"]
+    )
+
+
+@pytest.mark.anyio
+async def test_upload_failed_part_cancels_large_file(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sample_image: pathlib.Path,
+    mock_b2_large_file,
+):
+    mock_b2_large_file["upload_part"].side_effect = RuntimeError("B2 is down")
+
+    response = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    assert response.status_code == 500
+
+    mock_b2_large_file["finish"].assert_not_called()
+    mock_b2_large_file["cancel"].assert_called_once_with("file-id")
+
+
+@pytest.mark.anyio
+async def test_upload_without_file(async_client: AsyncClient, logged_in_token: str):
+    response = await async_client.post(
+        "/upload",
+        files={"other": ("other.txt", b"data")},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_upload_storage_busy(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sample_image: pathlib.Path,
+    mock_b2_upload_bytes,
+):
+    mock_b2_upload_bytes.side_effect = StorageUnavailableError("Storage is busy")
 
     response = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+
+async def create_upload_session(
+    async_client: AsyncClient, token: str, size: int
+) -> dict:
+    response = await async_client.post(
+        "/upload/sessions",
+        json={"file_name": "my_file.png", "size": size},
+        headers={"Authorization": f"Bearer {token}"},
+    )
     assert response.status_code == 201
+    return response.json()
+
+
+async def put_chunk(
+    async_client: AsyncClient, token: str, session_id: str, index: int, data: bytes
+):
+    return await async_client.put(
+        f"/upload/sessions/{session_id}/chunks/{index}",
+        content=data,
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+async def finalize(async_client: AsyncClient, token: str, session_id: str):
+    return await async_client.post(
+        f"/upload/sessions/{session_id}/finalize",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+@pytest.mark.anyio
+async def test_upload_session_chunks_in_any_order(
+    async_client: AsyncClient, logged_in_token: str, mock_b2_large_file
+):
+    session = await create_upload_session(async_client, logged_in_token, 10)
+    assert session["chunk_size"] == 4
+    assert session["chunk_count"] == 3
+    assert session["missing_ranges"] == [[0, 10]]
+    mock_b2_large_file["start"].assert_called_once_with("my_file.png")
+
+    await put_chunk(async_client, logged_in_token, session["id"], 2, b"89")
+    response = await put_chunk(async_client, logged_in_token, session["id"], 0, b"0123")
+    assert response.status_code == 200
+    assert response.json()["missing_chunks"] == [1]
+    assert response.json()["missing_ranges"] == [[4, 8]]
+
+    response = await finalize(async_client, logged_in_token, session["id"])
+    assert response.status_code == 409
 
-    created_temp_file = named_temp_file_spy.spy_return
-    assert not os.path.exists(created_temp_file.name)
+    response = await async_client.put(
+        f"/upload/sessions/{session['id']}",
+        params={"offset": 4},
+        content=b"4567",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 200
+    assert response.json()["missing_ranges"] == []
+
+    response = await finalize(async_client, logged_in_token, session["id"])
+    assert response.status_code == 200
+    assert response.json()["file_url"] == "https://example.com/large"
+    part_numbers = [
+        call.args[1] for call in mock_b2_large_file["upload_part"].call_args_list
+    ]
+    assert part_numbers == [3, 1, 2]
+    mock_b2_large_file["finish"].assert_called_once_with(
+        "file-id", ["sha1-0123", "sha1-4567", "sha1-89"]
+    )
+
+
+@pytest.mark.anyio
+async def test_upload_session_resent_chunk_replaces_it(
+    async_client: AsyncClient, logged_in_token: str, mock_b2_large_file
+):
+    session = await create_upload_session(async_client, logged_in_token, 8)
+    await put_chunk(async_client, logged_in_token, session["id"], 0, b"0123")
+    await put_chunk(async_client, logged_in_token, session["id"], 0, b"abcd")
+    await put_chunk(async_client, logged_in_token, session["id"], 1, b"4567")
+
+    response = await finalize(async_client, logged_in_token, session["id"])
+    assert response.status_code == 200
+    mock_b2_large_file["finish"].assert_called_once_with(
+        "file-id", ["sha1-abcd", "sha1-4567"]
+    )
+
+
+@pytest.mark.anyio
+async def test_upload_session_finalize_twice(
+    async_client: AsyncClient, logged_in_token: str, mock_b2_large_file
+):
+    session = await create_upload_session(async_client, logged_in_token, 8)
+    await put_chunk(async_client, logged_in_token, session["id"], 0, b"0123")
+    await put_chunk(async_client, logged_in_token, session["id"], 1, b"4567")
+
+    first = await finalize(async_client, logged_in_token, session["id"])
+    second = await finalize(async_client, logged_in_token, session["id"])
+    assert first.json() == second.json()
+    mock_b2_large_file["finish"].assert_called_once()
+
+    response = await put_chunk(async_client, logged_in_token, session["id"], 0, b"0123")
+    assert response.status_code == 409
+
+
+@pytest.mark.anyio
+async def test_upload_session_single_chunk(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    mock_b2_upload_bytes,
+    mock_b2_large_file,
+):
+    session = await create_upload_session(async_client, logged_in_token, 3)
+    mock_b2_large_file["start"].assert_not_called()
+
+    await put_chunk(async_client, logged_in_token, session["id"], 0, b"abc")
+    response = await finalize(async_client, logged_in_token, session["id"])
+
+    assert response.status_code == 200
+    assert response.json()["file_url"] == "https://example.com"
+    mock_b2_upload_bytes.assert_called_once_with(b"abc", "my_file.png")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "index, data", [(0, b"012"), (1, b"45678"), (2, b"89"), (-1, b"0123")]
+)
+async def test_upload_session_rejects_bad_chunks(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    mock_b2_large_file,
+    index: int,
+    data: bytes,
+):
+    session = await create_upload_session(async_client, logged_in_token, 8)
+
+    response = await put_chunk(async_client, logged_in_token, session["id"], index, data)
+    assert response.status_code == 400
+    mock_b2_large_file["upload_part"].assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_upload_session_of_other_user(
+    async_client: AsyncClient, logged_in_token: str, mock_b2_large_file
+):
+    session = await create_upload_session(async_client, logged_in_token, 8)
+    other_token = create_access_token("other@example.net", user_id=999)
+
+    response = await async_client.get(
+        f"/upload/sessions/{session['id']}",
+        headers={"Authorization": f"Bearer {other_token}"},
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_upload_same_file_twice_is_stored_once(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sample_image: pathlib.Path,
+    mock_b2_upload_bytes,
+):
+    first = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    second = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+
+    assert second.status_code == 201
+    assert second.json()["file_url"] == first.json()["file_url"]
+    assert second.json()["id"] != first.json()["id"]
+    mock_b2_upload_bytes.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_delete_upload_keeps_file_until_last_reference(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sample_image: pathlib.Path,
+    mock_b2_upload_bytes,
+    mocker,
+):
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+    first = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    second = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    headers = {"Authorization": f"Bearer {logged_in_token}"}
+
+    response = await async_client.delete(
+        f"/upload/{first.json()['id']}", headers=headers
+    )
+    assert response.status_code == 200
+    delete_file.assert_not_called()
+
+    response = await async_client.delete(
+        f"/upload/{first.json()['id']}", headers=headers
+    )
+    assert response.status_code == 404
+
+    await async_client.delete(f"/upload/{second.json()['id']}", headers=headers)
+    delete_file.assert_called_once_with("https://example.com", "my_file.png")
+
+    # Nothing refers to the content anymore, it is uploaded again
+    await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    assert mock_b2_upload_bytes.call_count == 2
+
+
+@pytest.mark.anyio
+async def test_upload_requires_login(
+    async_client: AsyncClient, sample_image: pathlib.Path, mock_b2_upload_bytes
+):
+    response = await async_client.post(
+        "/upload", files={"file": open(sample_image, "rb")}
+    )
+    assert response.status_code == 401
+    mock_b2_upload_bytes.assert_not_called()
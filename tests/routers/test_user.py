@@ -1,7 +1,8 @@
 import pytest
-from fastapi import BackgroundTasks
 from httpx import AsyncClient
 
+from social_media_app.routers import user as user_router
+
 
 async def register_user(async_client: AsyncClient, email: str, password: str):
     return await async_client.post(
@@ -34,10 +35,10 @@ async def test_confirm_user(async_client: AsyncClient, mocker):
     2- look at the response and grap the confirmation url
     3- call it
     """
-    spy = mocker.spy(BackgroundTasks, "add_task")
+    spy = mocker.spy(user_router, "enqueue")
     email = "test@example.com"
     await register_user(async_client, email, "1234")
-    confirmation_url = str(spy.call_args[1]["confirmation_url"])
+    confirmation_url = spy.call_args.kwargs["confirmation_url"]
     response = await async_client.get(confirmation_url)
 
     assert response.status_code == 200
@@ -55,10 +56,10 @@ async def test_confirm_user_expired_token(async_client: AsyncClient, mocker):
     mocker.patch(
         "social_media_app.security.confirmation_token_expire_minutes", return_value=-1
     )
-    spy = mocker.spy(BackgroundTasks, "add_task")
+    spy = mocker.spy(user_router, "enqueue")
     email = "test@example.com"
     await register_user(async_client, email, "1234")
-    confirmation_url = str(spy.call_args[1]["confirmation_url"])
+    confirmation_url = spy.call_args.kwargs["confirmation_url"]
     response = await async_client.get(confirmation_url)
 
     assert response.status_code == 401
@@ -97,3 +98,13 @@ async def test_login_user(async_client: AsyncClient, confirmed_user: dict):
         },
     )
     assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_revoke_tokens(async_client: AsyncClient, logged_in_token: str):
+    headers = {"Authorization": f"Bearer {logged_in_token}"}
+    response = await async_client.post("/token/revoke", headers=headers)
+    assert response.status_code == 200
+
+    response = await async_client.post("/token/revoke", headers=headers)
+    assert response.status_code == 401
@@ -0,0 +1,71 @@
+import pytest
+
+from social_media_app.cache import LRUCache
+
+
+@pytest.mark.anyio
+async def test_lru_cache_hit_and_miss():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set(1, b"post")
+    assert cache.get(1) == b"post"
+    assert cache.get(2) is None
+    assert {"hits": 1, "misses": 1}.items() <= cache.stats().items()
+
+
+@pytest.mark.anyio
+async def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set(1, b"one")
+    cache.set(2, b"two")
+    cache.get(1)
+    cache.set(3, b"three")
+    assert cache.get(2) is None
+    assert cache.get(1) == b"one"
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.anyio
+async def test_lru_cache_memory_bound():
+    cache = LRUCache(max_entries=10, ttl=60, max_bytes=8)
+    cache.set(1, b"1234")
+    cache.set(2, b"5678")
+    cache.set(3, b"90")
+    assert cache.get(1) is None
+    assert cache.stats()["bytes"] == 6
+    cache.set(4, b"too large to cache")
+    assert cache.get(4) is None
+
+
+@pytest.mark.anyio
+async def test_lru_cache_too_large_value_drops_previous_one():
+    cache = LRUCache(max_entries=10, ttl=60, max_bytes=8)
+    cache.set(1, b"1234")
+    cache.set(1, b"too large to cache")
+    assert cache.get(1) is None
+    assert cache.stats()["bytes"] == 0
+
+
+@pytest.mark.anyio
+async def test_lru_cache_tag_mismatch_is_a_miss():
+    cache = LRUCache(max_entries=10, ttl=60)
+    cache.set(1, b"post", tag="v1")
+    assert cache.get(1, "v2") is None
+    assert cache.get(1, "v1") == b"post"
+
+
+@pytest.mark.anyio
+async def test_lru_cache_ttl(mocker):
+    monotonic = mocker.patch("social_media_app.cache.time.monotonic", return_value=0)
+    cache = LRUCache(max_entries=10, ttl=5)
+    cache.set(1, b"post")
+    monotonic.return_value = 6
+    assert cache.get(1) is None
+
+
+@pytest.mark.anyio
+async def test_lru_cache_delete():
+    cache = LRUCache(max_entries=10, ttl=60, max_bytes=100)
+    cache.set(1, b"post")
+    cache.delete(1)
+    assert cache.get(1) is None
+    assert cache.stats()["bytes"] == 0
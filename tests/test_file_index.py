@@ -0,0 +1,98 @@
+import pytest
+
+from social_media_app.database import file_reference_table, stored_file_table
+from social_media_app.file_index import FileIndex, StoredFileGoneError
+from social_media_app.storage import StoredUpload
+
+
+@pytest.mark.anyio
+async def test_concurrent_upload_of_same_bytes_keeps_one_file(
+    db, registered_user, mocker
+):
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+    file_index = FileIndex()
+    user_id = registered_user["id"]
+
+    # Both uploads missed the index and stored their own copy
+    assert await file_index.find(db, "abc") is None
+    _, first_url = await file_index.add_upload(
+        db, StoredUpload("https://example.com/1", "abc", reused=False), "a.png", user_id
+    )
+    _, second_url = await file_index.add_upload(
+        db, StoredUpload("https://example.com/2", "abc", reused=False), "a.png", user_id
+    )
+
+    assert first_url == second_url == "https://example.com/1"
+    delete_file.assert_called_once_with("https://example.com/2", "a.png")
+    assert await file_index.find(db, "abc") == "https://example.com/1"
+    assert file_index.stats()["hits"] == 1
+    stored_file = await db.fetch_one(stored_file_table.select())
+    assert stored_file.ref_count == 2
+
+
+@pytest.mark.anyio
+async def test_release_other_users_upload(db, registered_user, mocker):
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+    file_index = FileIndex()
+    upload_id, _ = await file_index.add_upload(
+        db,
+        StoredUpload("https://example.com", "abc", reused=False),
+        "a.png",
+        registered_user["id"],
+    )
+
+    assert not await file_index.release(db, upload_id, registered_user["id"] + 1)
+    assert await file_index.release(db, upload_id, registered_user["id"])
+    delete_file.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_reference_not_taken_when_insert_fails(db, registered_user, mocker):
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+    file_index = FileIndex()
+    await file_index.add_upload(
+        db,
+        StoredUpload("https://example.com", "abc", reused=False),
+        "a.png",
+        registered_user["id"],
+    )
+
+    # Inserting the file_references row fails
+    execute = mocker.patch.object(db, "execute", side_effect=RuntimeError("disk full"))
+    with pytest.raises(RuntimeError):
+        await file_index.add_upload(
+            db,
+            StoredUpload("https://example.com", "abc", reused=True),
+            "a.png",
+            registered_user["id"],
+        )
+    mocker.stop(execute)
+
+    stored_file = await db.fetch_one(stored_file_table.select())
+    assert stored_file.ref_count == 1
+    assert len(await db.fetch_all(file_reference_table.select())) == 1
+    delete_file.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_reused_file_deleted_before_reference(db, registered_user, mocker):
+    mocker.patch("social_media_app.storage.b2_delete_file")
+    file_index = FileIndex()
+    upload_id, _ = await file_index.add_upload(
+        db,
+        StoredUpload("https://example.com", "abc", reused=False),
+        "a.png",
+        registered_user["id"],
+    )
+    assert await file_index.find(db, "abc") == "https://example.com"
+    await file_index.release(db, upload_id, registered_user["id"])
+
+    with pytest.raises(StoredFileGoneError):
+        await file_index.add_upload(
+            db,
+            StoredUpload("https://example.com", "abc", reused=True),
+            "a.png",
+            registered_user["id"],
+        )
+
+    assert not await db.fetch_all(file_reference_table.select())
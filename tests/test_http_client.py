@@ -0,0 +1,31 @@
+import pytest
+
+from social_media_app.http_client import SharedHTTPClient, http_client
+
+
+@pytest.mark.anyio
+async def test_post_uses_host_timeout(mock_httpx_client):
+    await http_client.post("https://api.deepai.org/api/text2img", data={})
+    await http_client.post("https://example.com/")
+    timeouts = [call.kwargs["timeout"] for call in mock_httpx_client.post.call_args_list]
+    assert timeouts == [60, 10]
+
+
+@pytest.mark.anyio
+async def test_reuse_stats():
+    client = SharedHTTPClient()
+    client.requests = 4
+    await client._trace("connection.connect_tcp.complete", {})
+    assert client.stats() == {
+        "requests": 4,
+        "connections_opened": 1,
+        "reuse_rate": 0.75,
+    }
+
+
+@pytest.mark.anyio
+async def test_client_created_once():
+    client = SharedHTTPClient()
+    assert client.client is client.client
+    await client.stop()
+    assert client._client is None
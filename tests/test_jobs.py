@@ -0,0 +1,131 @@
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+from databases import Database
+
+from social_media_app.database import job_table, utcnow
+from social_media_app.jobs import (
+    DEAD,
+    HANDLERS,
+    PENDING,
+    JobWorker,
+    claim_jobs,
+    enqueue,
+    retry_delay,
+)
+
+
+@pytest.fixture()
+def handler(mocker) -> AsyncMock:
+    handler = AsyncMock()
+    mocker.patch.dict(HANDLERS, {"test_job": handler})
+    return handler
+
+
+async def get_job(db: Database, job_id: int):
+    return await db.fetch_one(job_table.select().where(job_table.c.id == job_id))
+
+
+@pytest.mark.anyio
+async def test_run_job(db: Database, handler: AsyncMock):
+    job_id = await enqueue("test_job", value=1)
+    assert await JobWorker(db).run_once() == 1
+    handler.assert_awaited_once_with(db, value=1)
+    assert await get_job(db, job_id) is None
+
+
+@pytest.mark.anyio
+async def test_failed_job_is_retried_with_backoff(db: Database, handler: AsyncMock):
+    handler.side_effect = RuntimeError("boom")
+    job_id = await enqueue("test_job")
+    await JobWorker(db).run_once()
+
+    job = await get_job(db, job_id)
+    assert (job.status, job.attempts) == (PENDING, 1)
+    assert job.last_error == "RuntimeError: boom"
+    assert job.run_at > utcnow()
+    assert await JobWorker(db).run_once() == 0  # not due yet
+
+
+@pytest.mark.anyio
+async def test_job_is_dead_after_max_attempts(
+    db: Database, handler: AsyncMock, mocker
+):
+    mocker.patch("social_media_app.jobs.config.JOB_MAX_ATTEMPTS", 2)
+    mocker.patch("social_media_app.jobs.retry_delay", return_value=0)
+    handler.side_effect = RuntimeError("boom")
+    job_id = await enqueue("test_job")
+    await JobWorker(db).run_once()
+    await JobWorker(db).run_once()
+
+    job = await get_job(db, job_id)
+    assert (job.status, job.attempts) == (DEAD, 2)
+    assert await JobWorker(db).run_once() == 0
+
+
+@pytest.mark.anyio
+async def test_expired_lock_is_claimed_again(db: Database, handler: AsyncMock, mocker):
+    job_id = await enqueue("test_job")
+    assert len(await claim_jobs(db, 10)) == 1
+    assert await claim_jobs(db, 10) == []
+
+    mocker.patch("social_media_app.jobs.config.JOB_VISIBILITY_TIMEOUT_SECONDS", -1)
+    await db.execute(
+        job_table.update().where(job_table.c.id == job_id).values(locked_until=utcnow())
+    )
+    [job] = await claim_jobs(db, 10)
+    assert job.attempts == 2
+
+
+@pytest.mark.anyio
+async def test_enqueue_unknown_job():
+    with pytest.raises(ValueError):
+        await enqueue("no_such_job")
+
+
+@pytest.mark.anyio
+async def test_register_enqueues_email(async_client, db: Database):
+    await async_client.post(
+        "/register", json={"email": "test@example.net", "password": "1234"}
+    )
+    [job] = await db.fetch_all(job_table.select())
+    assert job.name == "send_user_registeration_email"
+    assert json.loads(job.payload)["email"] == "test@example.net"
+
+
+@pytest.mark.anyio
+async def test_email_jobs_are_sent_in_one_batch(db: Database, fake_mailgun):
+    emails = [f"user{n}@example.net" for n in range(25)]
+    for email in emails:
+        await enqueue(
+            "send_user_registeration_email", email=email, confirmation_url="/confirm"
+        )
+
+    # Many more emails than job slots
+    assert await JobWorker(db, concurrency=2).run_once() == 25
+
+    assert fake_mailgun.requests == [emails]
+    assert await db.fetch_all(job_table.select()) == []
+
+
+@pytest.mark.anyio
+async def test_failed_email_job_is_retried_alone(db: Database, fake_mailgun):
+    await enqueue(
+        "send_user_registeration_email", email="one@example.net", confirmation_url="/c"
+    )
+    job_id = await enqueue(
+        "send_user_registeration_email",
+        email="rejected@example.net",
+        confirmation_url="/c",
+    )
+
+    await JobWorker(db).run_once()
+
+    [job] = await db.fetch_all(job_table.select())
+    assert (job.id, job.status, job.attempts) == (job_id, PENDING, 1)
+
+
+@pytest.mark.anyio
+async def test_retry_delay():
+    assert [retry_delay(attempts) for attempts in (1, 2, 3)] == [10, 20, 40]
@@ -0,0 +1,55 @@
+import pytest
+from databases import Database
+
+from social_media_app.database import post_table
+from social_media_app.leaderboard import TopKLeaderboard
+
+
+async def insert_posts(db: Database, *like_counts: int):
+    for like_count in like_counts:
+        await db.execute(
+            post_table.insert().values(body="Test post", user_id=1, like_count=like_count)
+        )
+
+
+@pytest.mark.anyio
+async def test_seed_keeps_top_k(db: Database):
+    await insert_posts(db, 5, 1, 3, 3)
+    leaderboard = TopKLeaderboard(3)
+    await leaderboard.seed(db)
+    assert leaderboard.page(10) is None  # incomplete: post 2 is not on the board
+    assert leaderboard.page(2) == [(1, 5), (4, 3), (3, 3)]
+    assert leaderboard.stats() == {"size": 3, "k": 3, "complete": False}
+
+
+@pytest.mark.anyio
+async def test_record_reorders_and_evicts(db: Database):
+    await insert_posts(db, 2, 1)
+    leaderboard = TopKLeaderboard(2)
+    await leaderboard.seed(db)
+    assert leaderboard.complete is False
+
+    leaderboard.record(2, 3)
+    assert leaderboard.page(1) == [(2, 3), (1, 2)]
+    leaderboard.record(3, 0)  # ranks below the board
+    assert leaderboard.page(1) == [(2, 3), (1, 2)]
+    leaderboard.record(3, 4)
+    assert leaderboard.page(1) == [(3, 4), (2, 3)]
+    assert leaderboard.page(0, after=(3, 2)) is None
+
+
+@pytest.mark.anyio
+async def test_complete_board_serves_every_page(db: Database):
+    await insert_posts(db, 1)
+    leaderboard = TopKLeaderboard(5)
+    await leaderboard.seed(db)
+    leaderboard.record(2, 0)
+    assert leaderboard.page(10) == [(1, 1), (2, 0)]
+    assert leaderboard.page(10, after=(1, 1)) == [(2, 0)]
+
+
+@pytest.mark.anyio
+async def test_unseeded_board_is_not_used():
+    leaderboard = TopKLeaderboard(5)
+    leaderboard.record(1, 10)
+    assert leaderboard.page(10) is None
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import pathlib
+import time
+
+import pytest
+from databases import Database
+from httpx import AsyncClient
+
+from social_media_app.config import config
+from social_media_app.database import like_log_segment_table, like_table, post_table
+from social_media_app.like_buffer import LikeWriteBehindBuffer
+from social_media_app.versions import FEED, get_version, post_key
+
+
+def make_buffer(log_dir: pathlib.Path) -> LikeWriteBehindBuffer:
+    return LikeWriteBehindBuffer(log_dir, max_pending=100, flush_interval=60, fsync=False)
+
+
+@pytest.fixture()
+async def like_buffer(tmp_path: pathlib.Path, db: Database):
+    buffer = make_buffer(tmp_path)
+    await buffer.start(db)
+    yield buffer
+    await buffer.stop()
+
+
+async def get_like_count(db: Database, post_id: int) -> int:
+    query = post_table.select().where(post_table.c.id == post_id)
+    return (await db.fetch_one(query)).like_count
+
+
+@pytest.mark.anyio
+async def test_flush_writes_buffered_likes(
+    like_buffer: LikeWriteBehindBuffer, created_post: dict, db: Database
+):
+    await like_buffer.add(created_post["id"], 1)
+    await like_buffer.add(created_post["id"], 1)
+    assert like_buffer.pending_likes(created_post["id"]) == 2
+    assert await get_like_count(db, created_post["id"]) == 0
+
+    await like_buffer.flush()
+
+    assert like_buffer.pending_likes(created_post["id"]) == 0
+    assert await get_like_count(db, created_post["id"]) == 2
+    assert len(await db.fetch_all(like_table.select())) == 2
+    assert len(list(like_buffer.log_dir.glob("*.log"))) == 1  # the new segment
+
+
+@pytest.mark.anyio
+async def test_likes_share_one_fsync(
+    tmp_path: pathlib.Path, created_post: dict, db: Database, mocker
+):
+    buffer = LikeWriteBehindBuffer(
+        tmp_path, max_pending=100, flush_interval=60, fsync=True
+    )
+    await buffer.start(db)
+    fsync = mocker.spy(os, "fsync")
+
+    await asyncio.gather(*(buffer.add(created_post["id"], 1) for _ in range(5)))
+    assert fsync.call_count == 1
+
+    await buffer.add(created_post["id"], 1)
+    assert fsync.call_count == 2
+    await buffer.stop()
+
+
+@pytest.mark.anyio
+async def test_flush_during_group_fsync(
+    tmp_path: pathlib.Path, created_post: dict, db: Database, mocker
+):
+    buffer = LikeWriteBehindBuffer(
+        tmp_path, max_pending=100, flush_interval=60, fsync=True
+    )
+    await buffer.start(db)
+    fsync = os.fsync
+    fsync_started = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def slow_fsync(fd):
+        loop.call_soon_threadsafe(fsync_started.set)
+        time.sleep(0.05)
+        fsync(fd)
+
+    mocker.patch("social_media_app.like_buffer.os.fsync", side_effect=slow_fsync)
+
+    like = asyncio.create_task(buffer.add(created_post["id"], 1))
+    await fsync_started.wait()
+    # Removes the segment being fsynced
+    await buffer.flush()
+    await like
+
+    assert await get_like_count(db, created_post["id"]) == 1
+    await buffer.stop()
+
+
+@pytest.mark.anyio
+async def test_flush_bumps_versions(
+    like_buffer: LikeWriteBehindBuffer, created_post: dict, db: Database
+):
+    post_version = await get_version(post_key(created_post["id"]))
+    feed_version = await get_version(FEED)
+
+    await like_buffer.add(created_post["id"], 1)
+    assert await get_version(FEED) == feed_version
+
+    await like_buffer.flush()
+    assert await get_version(post_key(created_post["id"])) == post_version + 1
+    assert await get_version(FEED) == feed_version + 1
+
+
+@pytest.mark.anyio
+async def test_replay_after_crash(
+    tmp_path: pathlib.Path, created_post: dict, db: Database
+):
+    crashed = make_buffer(tmp_path)
+    await crashed.start(db)
+    await crashed.add(created_post["id"], 1)
+    await crashed.add(created_post["id"], 1)
+    # Simulate the worker dying: its lock is released, the log stays
+    crashed._flush_task.cancel()
+    os.close(crashed._segment.fd)
+
+    restarted = make_buffer(tmp_path)
+    await restarted.start(db)
+    assert await get_like_count(db, created_post["id"]) == 2
+    await restarted.stop()
+
+
+@pytest.mark.anyio
+async def test_replay_skips_flushed_segment(
+    tmp_path: pathlib.Path, created_post: dict, db: Database
+):
+    # Crash between committing a flush and deleting its segment file
+    (tmp_path / "likes-flushed.log").write_text(
+        f'{{"post_id": {created_post["id"]}, "user_id": 1}}\n'
+    )
+    await db.execute(like_log_segment_table.insert().values(segment="likes-flushed"))
+
+    buffer = make_buffer(tmp_path)
+    await buffer.start(db)
+    assert await get_like_count(db, created_post["id"]) == 0
+    assert not (tmp_path / "likes-flushed.log").exists()
+    await buffer.stop()
+
+
+@pytest.mark.anyio
+async def test_like_post_write_behind(
+    async_client: AsyncClient,
+    created_post: dict,
+    logged_in_token: str,
+    like_buffer: LikeWriteBehindBuffer,
+    mocker,
+):
+    mocker.patch.object(config, "LIKE_WRITE_BEHIND", True)
+    mocker.patch("social_media_app.routers.post.like_buffer", like_buffer)
+    response = await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 202
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 1
@@ -0,0 +1,65 @@
+import pytest
+import sqlalchemy
+
+from social_media_app.migrations import MIGRATIONS, current_version, migrate
+
+
+@pytest.fixture()
+def fresh_engine(tmp_path) -> sqlalchemy.Engine:
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+
+
+def index_names(engine: sqlalchemy.Engine, table: str) -> set[str]:
+    return {index["name"] for index in sqlalchemy.inspect(engine).get_indexes(table)}
+
+
+@pytest.mark.anyio
+async def test_migrate_fresh_database(fresh_engine: sqlalchemy.Engine):
+    applied = migrate(fresh_engine)
+
+    assert applied == [migration.version for migration in MIGRATIONS]
+    assert current_version(fresh_engine) == MIGRATIONS[-1].version
+    assert {"ix_post_like_count_id", "ix_post_user_id"} <= index_names(
+        fresh_engine, "post"
+    )
+    assert "ix_comments_post_id_id" in index_names(fresh_engine, "comments")
+    assert "ix_likes_post_id" in index_names(fresh_engine, "likes")
+
+
+@pytest.mark.anyio
+async def test_migrate_is_idempotent(fresh_engine: sqlalchemy.Engine):
+    migrate(fresh_engine)
+    assert migrate(fresh_engine) == []
+
+
+@pytest.mark.anyio
+async def test_migrate_existing_database(fresh_engine: sqlalchemy.Engine):
+    # Schema created by metadata.create_all before migrations existed
+    with fresh_engine.begin() as connection:
+        for statement in (
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR UNIQUE,"
+            " password VARCHAR, confirmed BOOLEAN)",
+            "CREATE TABLE post (id INTEGER PRIMARY KEY, body VARCHAR,"
+            " user_id INTEGER NOT NULL, image_url VARCHAR)",
+            "CREATE TABLE comments (id INTEGER PRIMARY KEY, body VARCHAR,"
+            " post_id INTEGER NOT NULL, user_id INTEGER NOT NULL)",
+            "CREATE TABLE likes (id INTEGER PRIMARY KEY,"
+            " post_id INTEGER NOT NULL, user_id INTEGER NOT NULL)",
+            "INSERT INTO users (id, email) VALUES (1, 'test@example.net')",
+            "INSERT INTO post (id, body, user_id) VALUES (1, 'Test post', 1)",
+            "INSERT INTO likes (post_id, user_id) VALUES (1, 1)",
+        ):
+            connection.execute(sqlalchemy.text(statement))
+
+    migrate(fresh_engine)
+
+    with fresh_engine.connect() as connection:
+        post = connection.execute(
+            sqlalchemy.text("SELECT like_count, comment_count FROM post")
+        ).one()
+        indexed = connection.execute(
+            sqlalchemy.text("SELECT rowid FROM post_fts WHERE post_fts MATCH 'test'")
+        ).all()
+    assert tuple(post) == (1, 0)
+    assert [tuple(row) for row in indexed] == [(1,)]
+    assert "ix_likes_post_id" in index_names(fresh_engine, "likes")
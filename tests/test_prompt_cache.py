@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock
+
+import pytest
+from databases import Database
+
+from social_media_app.database import prompt_result_table, utcnow
+from social_media_app.prompt_cache import PromptResultCache, normalize_prompt
+
+
+@pytest.mark.anyio
+async def test_normalize_prompt():
+    assert normalize_prompt("  A  Blue\tCAT ") == normalize_prompt("a blue cat")
+
+
+@pytest.mark.anyio
+async def test_get_or_generate_caches_result(db: Database):
+    cache = PromptResultCache(max_entries=10, ttl=60)
+    generate = AsyncMock(return_value="https://example.com/cat.jpg")
+    assert await cache.get_or_generate(db, "A cat", generate) == generate.return_value
+    assert await cache.get_or_generate(db, "a  CAT", generate) == generate.return_value
+    generate.assert_awaited_once()
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.anyio
+async def test_identical_prompts_are_coalesced(db: Database):
+    cache = PromptResultCache(max_entries=10, ttl=60)
+
+    async def generate(prompt: str) -> str:
+        await asyncio.sleep(0.01)
+        return "https://example.com/cat.jpg"
+
+    generate = AsyncMock(side_effect=generate)
+    results = await asyncio.gather(
+        *(cache.get_or_generate(db, "A cat", generate) for _ in range(10))
+    )
+    assert set(results) == {"https://example.com/cat.jpg"}
+    generate.assert_awaited_once()
+    assert cache.stats()["coalesced"] == 9
+
+
+@pytest.mark.anyio
+async def test_coalesced_prompts_share_failure(db: Database):
+    cache = PromptResultCache(max_entries=10, ttl=60)
+
+    async def generate(prompt: str) -> str:
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    results = await asyncio.gather(
+        cache.get_or_generate(db, "A cat", generate),
+        cache.get_or_generate(db, "A cat", generate),
+        return_exceptions=True,
+    )
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+
+
+@pytest.mark.anyio
+async def test_expired_and_evicted_entries(db: Database):
+    cache = PromptResultCache(max_entries=2, ttl=60)
+    for prompt in ("one", "two", "three"):
+        await cache.set(db, prompt, f"https://example.com/{prompt}.jpg")
+    assert await cache.get(db, "one") is None
+    assert len(await db.fetch_all(prompt_result_table.select())) == 2
+
+    await db.execute(
+        prompt_result_table.update().values(
+            created_at=datetime.datetime(2000, 1, 1)
+        )
+    )
+    assert await cache.get(db, "two") is None
+
+
+@pytest.mark.anyio
+async def test_hits_touch_entries_at_most_once_per_interval(db: Database, mocker):
+    cache = PromptResultCache(max_entries=10, ttl=3600, touch_interval=60)
+    await cache.set(db, "cat", "https://example.com/cat.jpg")
+    execute = mocker.spy(db, "execute")
+
+    assert await cache.get(db, "cat") == "https://example.com/cat.jpg"
+    execute.assert_not_called()
+
+    await db.execute(
+        prompt_result_table.update().values(
+            last_used_at=utcnow() - datetime.timedelta(minutes=5)
+        )
+    )
+    execute.reset_mock()
+    await cache.get(db, "cat")
+    execute.assert_called_once()
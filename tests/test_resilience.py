@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from social_media_app.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    AIMDLimiter,
+    CircuitBreaker,
+    IntegrationUnavailableError,
+)
+from social_media_app.tasks import (
+    APIResponseError,
+    _generate_cute_creature_image_api,
+    deepai,
+    mailgun,
+    send_simple_email,
+)
+
+
+@pytest.mark.anyio
+async def test_circuit_opens_and_probes(mocker):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(IntegrationUnavailableError):
+        breaker.before_call()
+
+    mocker.patch("social_media_app.resilience.time.monotonic", return_value=1e9)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(IntegrationUnavailableError):
+        breaker.before_call()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+@pytest.mark.anyio
+async def test_failed_probe_reopens_circuit(mocker):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    mocker.patch("social_media_app.resilience.time.monotonic", return_value=1e9)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+@pytest.mark.anyio
+async def test_aimd_limiter():
+    limiter = AIMDLimiter(
+        initial=4, minimum=1, maximum=5, target_latency=1, queue_timeout=0.01
+    )
+    for _ in range(5):
+        limiter.on_success(0.1)
+    assert int(limiter.limit) == 5
+    limiter.on_success(2)
+    assert int(limiter.limit) == 2
+    limiter.on_failure()
+    limiter.on_failure()
+    assert limiter.limit == 1
+
+    async with limiter.slot():
+        with pytest.raises(IntegrationUnavailableError):
+            async with limiter.slot():
+                pass
+    assert limiter.rejected == 1
+
+
+@pytest.mark.anyio
+async def test_open_circuit_fails_fast(mock_httpx_client, mocker):
+    mocker.patch.object(deepai.breaker, "failure_threshold", 2)
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=503, content="", request=httpx.Request("POST", "//")
+    )
+    for _ in range(2):
+        with pytest.raises(APIResponseError):
+            await _generate_cute_creature_image_api("A cat")
+    assert deepai.stats()["state"] == OPEN
+
+    mock_httpx_client.post.reset_mock()
+    with pytest.raises(APIResponseError, match="Circuit is open"):
+        await _generate_cute_creature_image_api("A cat")
+    mock_httpx_client.post.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_client_errors_do_not_open_circuit(mock_httpx_client):
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=400, content="", request=httpx.Request("POST", "//")
+    )
+    for _ in range(10):
+        with pytest.raises(APIResponseError):
+            await send_simple_email("test@example.com", "Test Subject", "Test Body")
+    assert mailgun.stats()["state"] == CLOSED
+
+
+def expire_open_circuit(integration):
+    integration.breaker.state = OPEN
+    integration.breaker.opened_at = time.monotonic() - integration.breaker.reset_timeout
+
+
+@pytest.mark.anyio
+async def test_cancelled_probe_is_released(mock_httpx_client):
+    expire_open_circuit(deepai)
+    mock_httpx_client.post.side_effect = asyncio.CancelledError
+
+    with pytest.raises(asyncio.CancelledError):
+        await deepai.post("https://api.deepai.org/api/cute-creature-generator")
+    assert deepai.stats()["state"] == HALF_OPEN
+
+    mock_httpx_client.post.side_effect = None
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=200, content="", request=httpx.Request("POST", "//")
+    )
+    await deepai.post("https://api.deepai.org/api/cute-creature-generator")
+    assert deepai.stats()["state"] == CLOSED
+
+
+@pytest.mark.anyio
+async def test_unexpected_error_counts_as_failure(mock_httpx_client):
+    expire_open_circuit(deepai)
+    mock_httpx_client.post.side_effect = ValueError("Bad request body")
+
+    with pytest.raises(ValueError):
+        await deepai.post("https://api.deepai.org/api/cute-creature-generator")
+    assert deepai.stats()["state"] == OPEN
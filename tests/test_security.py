@@ -95,10 +95,47 @@ async def test_get_subject_for_token_type_sub_wrong_type():
         )
 
 
+@pytest.mark.anyio
+async def test_get_subject_for_token_type_cached(mocker):
+    email = "test@example.com"
+    token = security.create_access_token(email)
+    assert security.get_subject_for_token_type(token, "access") == email
+    hits = security.token_cache.hits
+    spy = mocker.spy(security.jwt, "decode")
+    assert security.get_subject_for_token_type(token, "access") == email
+    spy.assert_not_called()
+    with pytest.raises(security.HTTPException):
+        security.get_subject_for_token_type(token, "confirmation")
+    assert security.token_cache.hits == hits + 2
+
+
 @pytest.mark.anyio
 async def test_password_hashes():
     password = "password"
-    assert security.verify_password(password, security.get_password_hashed(password))
+    assert await security.verify_password(
+        password, await security.get_password_hashed(password)
+    )
+
+
+@pytest.mark.anyio
+async def test_password_hash_pool_saturated(mocker):
+    mocker.patch.object(security.password_hash_pool, "in_flight", 100)
+    with pytest.raises(security.HTTPException) as exc_info:
+        await security.get_password_hashed("password")
+    assert exc_info.value.status_code == 503
+
+
+@pytest.mark.anyio
+async def test_authenticate_user_rehashes_password(confirmed_user: dict):
+    old_context = security.CryptContext(schemes=["bcrypt"], bcrypt__rounds=5)
+    await security.database.execute(
+        security.user_table.update()
+        .where(security.user_table.c.email == confirmed_user["email"])
+        .values(password=old_context.hash(confirmed_user["password"]))
+    )
+    await security.authenticate_user(confirmed_user["email"], confirmed_user["password"])
+    user = await security.get_user(confirmed_user["email"])
+    assert user.password.startswith(f"$2b${config.BCRYPT_ROUNDS:02d}$")
 
 
 # 4- Create test for get user function
@@ -143,6 +180,56 @@ async def test_get_current_user(registered_user: dict):
     assert user.email == registered_user["email"]
 
 
+@pytest.mark.anyio
+async def test_get_current_user_cached(registered_user: dict, mocker):
+    token = security.create_access_token(registered_user["email"])
+    await security.get_current_user(token)
+    spy = mocker.spy(security, "get_user")
+    user = await security.get_current_user(token)
+    assert user.email == registered_user["email"]
+    spy.assert_not_called()
+    assert security.user_cache.stats()["hits"] >= 1
+
+    security.invalidate_cached_user(registered_user["email"])
+    await security.get_current_user(token)
+    spy.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_from_claims(registered_user: dict, mocker):
+    token = security.create_access_token(
+        registered_user["email"], user_id=registered_user["id"], confirmed=True
+    )
+    spy = mocker.spy(security, "get_user")
+    user = await security.get_current_user(token)
+    assert (user.id, user.email, user.confirmed) == (
+        registered_user["id"],
+        registered_user["email"],
+        True,
+    )
+    spy.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_revoked(registered_user: dict):
+    token = security.create_access_token(
+        registered_user["email"], user_id=registered_user["id"]
+    )
+    await security.revoke_tokens(registered_user["id"], registered_user["email"])
+    with pytest.raises(security.HTTPException) as exc_info:
+        await security.get_current_user(token)
+    assert exc_info.value.detail == "Token has been revoked"
+
+    # Other workers pick the revocation up from the users table
+    security.token_deny_list.clear()
+    await security.token_deny_list.sync(security.database)
+    with pytest.raises(security.HTTPException):
+        await security.get_current_user(token)
+    legacy_token = security.create_access_token(registered_user["email"])
+    with pytest.raises(security.HTTPException):
+        await security.get_current_user(legacy_token)
+
+
 @pytest.mark.anyio
 async def test_get_current_user_invalid_token():
     with pytest.raises(security.HTTPException):
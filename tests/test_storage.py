@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+import pytest
+
+from social_media_app import storage
+from social_media_app.config import config
+
+
+async def chunks(*data: bytes):
+    for chunk in data:
+        yield chunk
+
+
+@pytest.mark.anyio
+async def test_read_parts_packs_chunks():
+    parts = [part async for part in storage.read_parts(chunks(b"ab", b"cdefg", b"h"), 3)]
+    assert parts == [b"abc", b"def", b"gh"]
+
+
+@pytest.mark.anyio
+async def test_upload_stream_single_part(mocker):
+    upload_bytes = mocker.patch.object(
+        storage, "b2_upload_bytes", return_value="https://example.com"
+    )
+    start = mocker.patch.object(storage, "b2_start_large_file")
+
+    upload = await storage.upload_stream(chunks(b"small"), "file.txt")
+
+    assert upload.url == "https://example.com"
+    assert upload.sha256 == hashlib.sha256(b"small").hexdigest()
+    upload_bytes.assert_called_once_with(b"small", "file.txt")
+    start.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_upload_stream_bounds_parts_in_flight(mocker):
+    mocker.patch.object(config, "UPLOAD_PART_SIZE", 1)
+    mocker.patch.object(config, "UPLOAD_MAX_PARTS_IN_FLIGHT", 2)
+    mocker.patch.object(storage, "b2_start_large_file", return_value="file-id")
+    finish = mocker.patch.object(
+        storage, "b2_finish_large_file", return_value="https://example.com"
+    )
+    in_flight = 0
+    max_in_flight = 0
+
+    def upload_part(file_id, part_number, data):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        in_flight -= 1
+        return f"sha1-{part_number}"
+
+    mocker.patch.object(storage, "b2_upload_part", side_effect=upload_part)
+
+    upload = await storage.upload_stream(chunks(b"abcdef"), "file.txt")
+
+    assert upload.url == "https://example.com"
+    assert max_in_flight == 2
+    finish.assert_called_once_with("file-id", [f"sha1-{n}" for n in range(1, 7)])
+
+
+@pytest.mark.anyio
+async def test_upload_stream_cancelled_reading_cancels_large_file(mocker):
+    mocker.patch.object(config, "UPLOAD_PART_SIZE", 1)
+    mocker.patch.object(storage, "b2_start_large_file", return_value="file-id")
+    mocker.patch.object(storage, "b2_upload_part", return_value="sha1")
+    cancel = mocker.patch.object(storage, "b2_cancel_large_file")
+
+    async def broken_chunks():
+        yield b"abc"
+        raise asyncio.CancelledError
+
+    with pytest.raises(asyncio.CancelledError):
+        await storage.upload_stream(broken_chunks(), "file.txt")
+
+    cancel.assert_called_once_with("file-id")
+
+
+@pytest.mark.anyio
+async def test_upload_stream_reuses_existing_single_part(mocker):
+    upload_bytes = mocker.patch.object(storage, "b2_upload_bytes")
+    find_existing = mocker.AsyncMock(return_value="https://example.com/existing")
+
+    upload = await storage.upload_stream(
+        chunks(b"sm", b"all"), "file.txt", find_existing=find_existing
+    )
+
+    assert upload == storage.StoredUpload(
+        "https://example.com/existing",
+        hashlib.sha256(b"small").hexdigest(),
+        reused=True,
+    )
+    find_existing.assert_awaited_once_with(hashlib.sha256(b"small").hexdigest())
+    upload_bytes.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_upload_stream_reuses_existing_large_file(mocker):
+    mocker.patch.object(config, "UPLOAD_PART_SIZE", 2)
+    mocker.patch.object(storage, "b2_start_large_file", return_value="file-id")
+    mocker.patch.object(storage, "b2_upload_part", return_value="sha1")
+    finish = mocker.patch.object(storage, "b2_finish_large_file")
+    cancel = mocker.patch.object(storage, "b2_cancel_large_file")
+    find_existing = mocker.AsyncMock(return_value="https://example.com/existing")
+
+    upload = await storage.upload_stream(
+        chunks(b"abcde"), "file.txt", find_existing=find_existing
+    )
+
+    assert upload.url == "https://example.com/existing"
+    assert upload.reused
+    finish.assert_not_called()
+    cancel.assert_called_once_with("file-id")
+
+
+@pytest.mark.anyio
+async def test_storage_runs_calls_on_its_own_threads():
+    b2_storage = storage.B2Storage(workers=1, max_queue=0, timeout=1)
+
+    thread_name = await b2_storage.run(lambda: threading.current_thread().name)
+
+    assert thread_name.startswith("b2")
+
+
+@pytest.mark.anyio
+async def test_storage_rejects_calls_when_saturated():
+    b2_storage = storage.B2Storage(workers=1, max_queue=1, timeout=1)
+    busy = [asyncio.create_task(b2_storage.run(time.sleep, 0.05)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    with pytest.raises(storage.StorageUnavailableError):
+        await b2_storage.run(time.sleep, 0)
+
+    await asyncio.gather(*busy)
+    assert b2_storage.stats()["rejected"] == 1
+    assert b2_storage.stats()["in_flight"] == 0
+
+
+@pytest.mark.anyio
+async def test_storage_call_timeout():
+    b2_storage = storage.B2Storage(workers=1, max_queue=0, timeout=0.01)
+
+    with pytest.raises(storage.StorageUnavailableError):
+        await b2_storage.run(time.sleep, 0.1)
+
+    assert b2_storage.stats()["timed_out"] == 1
+    # The B2 call still runs on its thread
+    assert b2_storage.stats()["in_flight"] == 1
+    await asyncio.sleep(0.2)
+    assert b2_storage.stats()["in_flight"] == 0
+
+
+@pytest.mark.anyio
+async def test_storage_start_warms_up_b2(mocker):
+    warm_up = mocker.patch.object(storage, "b2_warm_up")
+    mocker.patch.object(config, "B2_KEY_ID", "key-id")
+
+    await storage.B2Storage(workers=1, max_queue=0, timeout=1).start()
+
+    warm_up.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_storage_start_survives_b2_errors(mocker):
+    mocker.patch.object(storage, "b2_warm_up", side_effect=RuntimeError("B2 is down"))
+    mocker.patch.object(config, "B2_KEY_ID", "key-id")
+
+    await storage.B2Storage(workers=1, max_queue=0, timeout=1).start()
+
+
+@pytest.mark.anyio
+async def test_storage_start_skipped_without_b2_credentials(mocker):
+    warm_up = mocker.patch.object(storage, "b2_warm_up")
+    mocker.patch.object(config, "B2_KEY_ID", None)
+
+    await storage.B2Storage(workers=1, max_queue=0, timeout=1).start()
+
+    warm_up.assert_not_called()
@@ -1,14 +1,24 @@
+import asyncio
+import datetime
+
 import httpx
 import pytest
 from databases import Database
 
-from social_media_app.database import post_table
+from social_media_app.cache import post_cache
+from social_media_app.database import comment_table, like_table, post_table, utcnow
 from social_media_app.tasks import (
     APIResponseError,
     _generate_cute_creature_image_api,
+    email_dispatcher,
     generate_and_add_to_post,
+    hot_score,
+    reconcile_post_counters,
     send_simple_email,
+    send_user_registeration_email,
+    update_hot_scores,
 )
+from social_media_app.versions import FEED, HOT_FEED, get_version, post_key
 
 
 @pytest.mark.anyio
@@ -72,3 +82,143 @@ async def test_generate_and_add_to_post_success(
 
     updated_post = await db.fetch_one(query)
     assert updated_post.image_url == json_data["output_url"]
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_invalidates_cache(
+    mock_httpx_client, created_post: dict, confirmed_user: dict, db: Database
+):
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=200,
+        json={"output_url": "https://example.com/image.jpg"},
+        request=httpx.Request("POST", "//"),
+    )
+    await post_cache.set(created_post["id"], '"etag"', b"stale")
+    await generate_and_add_to_post(
+        confirmed_user["email"], created_post["id"], "/post/1/", db, "A cat"
+    )
+    assert await post_cache.get(created_post["id"], '"etag"') is None
+
+
+@pytest.mark.anyio
+async def test_reconcile_post_counters(
+    created_post: dict, confirmed_user: dict, db: Database
+):
+    post_id = created_post["id"]
+    user_id = confirmed_user["id"]
+    # Insert rows behind the counters' back so they drift
+    await db.execute(like_table.insert().values(post_id=post_id, user_id=user_id))
+    await db.execute(
+        comment_table.insert().values(body="Hi", post_id=post_id, user_id=user_id)
+    )
+    await db.execute(
+        comment_table.insert().values(body="Hey", post_id=post_id, user_id=user_id)
+    )
+
+    await reconcile_post_counters(db)
+
+    post = await db.fetch_one(post_table.select().where(post_table.c.id == post_id))
+    assert post.like_count == 1
+    assert post.comment_count == 2
+
+
+@pytest.mark.anyio
+async def test_reconcile_post_counters_bumps_version(
+    created_post: dict, confirmed_user: dict, db: Database
+):
+    version = await get_version(post_key(created_post["id"]))
+    await db.execute(
+        like_table.insert().values(post_id=created_post["id"], user_id=confirmed_user["id"])
+    )
+    await reconcile_post_counters(db)
+    assert await get_version(post_key(created_post["id"])) == version + 1
+
+
+@pytest.mark.anyio
+async def test_update_hot_scores(
+    created_post: dict, confirmed_user: dict, db: Database
+):
+    now = utcnow()
+    await db.execute(
+        post_table.update()
+        .where(post_table.c.id == created_post["id"])
+        .values(created_at=now)
+    )
+    old_post_id = await db.execute(
+        post_table.insert().values(
+            body="Old post",
+            user_id=confirmed_user["id"],
+            created_at=now - datetime.timedelta(days=30),
+            hot_score=1.0,
+        )
+    )
+    await db.execute(
+        like_table.insert().values(
+            post_id=created_post["id"], user_id=confirmed_user["id"], created_at=now
+        )
+    )
+
+    await update_hot_scores(db, now + datetime.timedelta(hours=1))
+
+    posts = {row.id: row for row in await db.fetch_all(post_table.select())}
+    assert posts[created_post["id"]].hot_score == pytest.approx(hot_score(1, 0, 1))
+    assert posts[old_post_id].hot_score == 0
+
+
+@pytest.mark.anyio
+async def test_update_hot_scores_bumps_hot_feed_when_order_changes(
+    created_post: dict, confirmed_user: dict, db: Database
+):
+    now = utcnow()
+    await db.execute(
+        like_table.insert().values(
+            post_id=created_post["id"], user_id=confirmed_user["id"], created_at=now
+        )
+    )
+    feed_version = await get_version(FEED)
+    hot_version = await get_version(HOT_FEED)
+
+    await update_hot_scores(db, now + datetime.timedelta(hours=1))
+    assert await get_version(HOT_FEED) == hot_version + 1
+
+    # The score only decays, the ranking stays the same
+    await update_hot_scores(db, now + datetime.timedelta(hours=2))
+    assert await get_version(HOT_FEED) == hot_version + 1
+    assert await get_version(FEED) == feed_version
+
+
+@pytest.mark.anyio
+async def test_registration_emails_are_batched(fake_mailgun):
+    emails = ["one@example.net", "two@example.net", "three@example.net"]
+    await asyncio.gather(
+        *(send_user_registeration_email(email, f"/confirm/{email}") for email in emails)
+    )
+    assert fake_mailgun.requests == [emails]
+    assert [email["to"] for email in fake_mailgun.delivered] == emails
+    assert "/confirm/two@example.net" in fake_mailgun.delivered[1]["text"]
+
+
+@pytest.mark.anyio
+async def test_batched_email_reports_failed_recipient(fake_mailgun):
+    emails = ["one@example.net", "rejected@example.net", "two@example.net"]
+    results = await asyncio.gather(
+        *(send_user_registeration_email(email, "/confirm") for email in emails),
+        return_exceptions=True,
+    )
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], APIResponseError)
+    assert sorted(email["to"] for email in fake_mailgun.delivered) == [
+        "one@example.net",
+        "two@example.net",
+    ]
+
+
+@pytest.mark.anyio
+async def test_batch_flushed_when_full(fake_mailgun, mocker):
+    mocker.patch.object(email_dispatcher, "max_recipients", 2)
+    mocker.patch.object(email_dispatcher, "window", 60)
+    await asyncio.gather(
+        send_user_registeration_email("one@example.net", "/confirm"),
+        send_user_registeration_email("two@example.net", "/confirm"),
+    )
+    assert fake_mailgun.requests == [["one@example.net", "two@example.net"]]
@@ -0,0 +1,233 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from social_media_app import upload_sessions
+from social_media_app.database import (
+    upload_chunk_lease_table,
+    upload_chunk_table,
+    upload_session_table,
+)
+
+
+@pytest.fixture()
+def large_file_session(db, registered_user, mocker):
+    mocker.patch("social_media_app.config.config.UPLOAD_PART_SIZE", 4)
+    mocker.patch("social_media_app.storage.b2_start_large_file", return_value="file-id")
+
+    async def create():
+        return await upload_sessions.create_session(
+            db, registered_user["id"], "file.png", 8
+        )
+
+    return create
+
+
+@pytest.mark.anyio
+async def test_missing_ranges_merges_adjacent_chunks():
+    session = SimpleNamespace(size=22, chunk_size=4)
+
+    missing = upload_sessions.missing_chunks(session, {0, 3})
+
+    assert missing == [1, 2, 4, 5]
+    assert upload_sessions.missing_ranges(session, missing) == [(4, 12), (16, 22)]
+
+
+@pytest.mark.anyio
+async def test_expire_sessions_cancels_large_files(db, registered_user, mocker):
+    mocker.patch("social_media_app.config.config.UPLOAD_PART_SIZE", 4)
+    mocker.patch("social_media_app.storage.b2_start_large_file", return_value="file-id")
+    mocker.patch("social_media_app.storage.b2_upload_part", return_value="sha1")
+    cancel = mocker.patch("social_media_app.storage.b2_cancel_large_file")
+    expired = await upload_sessions.create_session(
+        db, registered_user["id"], "old.png", 8
+    )
+    await upload_sessions.put_chunk(db, expired, 0, b"0123")
+    await db.execute(
+        upload_session_table.update()
+        .where(upload_session_table.c.id == expired.id)
+        .values(created_at=datetime.datetime(2000, 1, 1))
+    )
+    recent = await upload_sessions.create_session(
+        db, registered_user["id"], "new.png", 8
+    )
+
+    assert await upload_sessions.expire_sessions(db) == 1
+
+    cancel.assert_called_once_with("file-id")
+    assert await upload_sessions.get_session(db, expired.id, registered_user["id"]) is None
+    assert await upload_sessions.get_session(db, recent.id, registered_user["id"])
+    assert not await db.fetch_all(
+        upload_chunk_table.select().where(upload_chunk_table.c.session_id == expired.id)
+    )
+
+
+@pytest.mark.anyio
+async def test_put_chunk_rejected_once_finalize_claimed(db, large_file_session, mocker):
+    upload_part = mocker.patch(
+        "social_media_app.storage.b2_upload_part", return_value="sha1"
+    )
+    session = await large_file_session()
+    await db.execute(
+        upload_session_table.update()
+        .where(upload_session_table.c.id == session.id)
+        .values(status=upload_sessions.FINISHING)
+    )
+
+    # `session` is the row read before the claim
+    with pytest.raises(upload_sessions.UploadSessionConflictError):
+        await upload_sessions.put_chunk(db, session, 0, b"0123")
+
+    upload_part.assert_not_called()
+    assert await upload_sessions.received_chunks(db, session.id) == {}
+
+
+@pytest.mark.anyio
+async def test_chunk_upload_in_flight_blocks_resend_and_finalize(
+    db, large_file_session, mocker
+):
+    session = await large_file_session()
+    mocker.patch("social_media_app.storage.b2_upload_part", return_value="sha1")
+    await upload_sessions.put_chunk(db, session, 1, b"4567")
+
+    async def upload_part(file_id, part_number, data):
+        with pytest.raises(upload_sessions.UploadSessionConflictError):
+            await upload_sessions.put_chunk(db, session, 0, b"abcd")
+        with pytest.raises(upload_sessions.UploadSessionConflictError):
+            await upload_sessions.finalize_session(db, session)
+        return "sha1-0"
+
+    mocker.patch.object(upload_sessions.storage, "upload_part", side_effect=upload_part)
+
+    await upload_sessions.put_chunk(db, session, 0, b"0123")
+
+    assert await upload_sessions.received_chunks(db, session.id) == {
+        0: "sha1-0",
+        1: "sha1",
+    }
+    assert not await db.fetch_all(upload_chunk_lease_table.select())
+
+
+@pytest.mark.anyio
+async def test_put_chunk_not_recorded_after_losing_its_lease(
+    db, large_file_session, mocker
+):
+    session = await large_file_session()
+
+    async def upload_part(file_id, part_number, data):
+        # The lease ran out and another request took the chunk over
+        await db.execute(
+            upload_chunk_lease_table.update().values(token="other-request")
+        )
+        return "stale-sha1"
+
+    mocker.patch.object(upload_sessions.storage, "upload_part", side_effect=upload_part)
+
+    with pytest.raises(upload_sessions.UploadSessionConflictError):
+        await upload_sessions.put_chunk(db, session, 0, b"0123")
+
+    assert await upload_sessions.received_chunks(db, session.id) == {}
+
+
+@pytest.mark.anyio
+async def test_expire_sessions_drops_stale_finishing_sessions(
+    db, registered_user, large_file_session, mocker
+):
+    cancel = mocker.patch("social_media_app.storage.b2_cancel_large_file")
+    stale = await large_file_session()
+    finishing = await large_file_session()
+    for session, finishing_at in [
+        (stale, datetime.datetime(2000, 1, 2)),
+        (finishing, upload_sessions.utcnow()),
+    ]:
+        await db.execute(
+            upload_session_table.update()
+            .where(upload_session_table.c.id == session.id)
+            .values(
+                status=upload_sessions.FINISHING,
+                created_at=datetime.datetime(2000, 1, 1),
+                finishing_at=finishing_at,
+            )
+        )
+
+    assert await upload_sessions.expire_sessions(db) == 1
+
+    cancel.assert_called_once_with("file-id")
+    assert await upload_sessions.get_session(db, stale.id, registered_user["id"]) is None
+    assert await upload_sessions.get_session(db, finishing.id, registered_user["id"])
+
+
+@pytest.fixture()
+def single_chunk_session(db, registered_user, mocker):
+    mocker.patch("social_media_app.config.config.UPLOAD_PART_SIZE", 4)
+
+    async def create():
+        return await upload_sessions.create_session(
+            db, registered_user["id"], "file.png", 3
+        )
+
+    return create
+
+
+@pytest.mark.anyio
+async def test_resent_single_chunk_deletes_replaced_file(
+    db, single_chunk_session, mocker
+):
+    mocker.patch(
+        "social_media_app.storage.b2_upload_bytes",
+        side_effect=["https://example.com/1", "https://example.com/2"],
+    )
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+    session = await single_chunk_session()
+
+    await upload_sessions.put_chunk(db, session, 0, b"abc")
+    await upload_sessions.put_chunk(db, session, 0, b"abc")
+
+    delete_file.assert_called_once_with("https://example.com/1", "file.png")
+    assert await upload_sessions.finalize_session(db, session) == "https://example.com/2"
+
+
+@pytest.mark.anyio
+async def test_unrecorded_single_chunk_deletes_its_file(
+    db, single_chunk_session, mocker
+):
+    session = await single_chunk_session()
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+
+    async def upload_bytes(data, file_name):
+        await db.execute(
+            upload_chunk_lease_table.update().values(token="other-request")
+        )
+        return "https://example.com"
+
+    mocker.patch.object(
+        upload_sessions.storage, "upload_bytes", side_effect=upload_bytes
+    )
+
+    with pytest.raises(upload_sessions.UploadSessionConflictError):
+        await upload_sessions.put_chunk(db, session, 0, b"abc")
+
+    delete_file.assert_called_once_with("https://example.com", "file.png")
+
+
+@pytest.mark.anyio
+async def test_expire_sessions_deletes_single_chunk_files(
+    db, registered_user, single_chunk_session, mocker
+):
+    mocker.patch(
+        "social_media_app.storage.b2_upload_bytes", return_value="https://example.com"
+    )
+    delete_file = mocker.patch("social_media_app.storage.b2_delete_file")
+    session = await single_chunk_session()
+    await upload_sessions.put_chunk(db, session, 0, b"abc")
+    await db.execute(
+        upload_session_table.update()
+        .where(upload_session_table.c.id == session.id)
+        .values(created_at=datetime.datetime(2000, 1, 1))
+    )
+
+    assert await upload_sessions.expire_sessions(db) == 1
+
+    delete_file.assert_called_once_with("https://example.com", "file.png")
+    assert await upload_sessions.get_session(db, session.id, registered_user["id"]) is None
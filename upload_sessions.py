@@ -0,0 +1,384 @@
+import datetime
+import hashlib
+import logging
+import uuid
+
+import sqlalchemy
+from databases import Database
+from sqlalchemy.dialects.sqlite import insert
+
+from social_media_app.config import config
+from social_media_app.database import (
+    upload_chunk_lease_table,
+    upload_chunk_table,
+    upload_session_table,
+    utcnow,
+)
+from social_media_app.storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Resumable chunked uploads
+# A client creates a session for a file of known size, PUTs its chunks (any
+# order, in parallel, retrying any of them) and finalizes it. Each chunk goes
+# straight to B2 as one part of a large file started with the session, so the
+# server keeps no chunk data, only which chunks arrived and their sha1 in the
+# upload_chunks table. Chunks are UPLOAD_PART_SIZE bytes, the smallest part B2
+# accepts. Files of a single chunk are uploaded in one request instead, a
+# re-sent chunk deletes the B2 file it replaces.
+# Sessions not finalized within UPLOAD_SESSION_TTL_SECONDS are dropped along
+# with their B2 large file.
+# A chunk upload leases its chunk in upload_chunk_leases (if the session is
+# still open) and records its sha1 only while it holds the lease, so parallel
+# sends of one chunk can't leave a sha1 that differs from the part in B2, and
+# finalize only claims a session that has no chunk upload in flight.
+
+OPEN = "open"
+FINISHING = "finishing"
+FINISHED = "finished"
+EXPIRED = "expired"
+
+# B2 large files have at most 10000 parts
+MAX_CHUNKS = 10_000
+
+
+class UploadSessionConflictError(Exception):
+    pass
+
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    return -(-size // chunk_size)
+
+
+def chunk_length(session, index: int) -> int:
+    start = index * session.chunk_size
+    return min(session.chunk_size, session.size - start)
+
+
+def missing_chunks(session, received: set[int]) -> list[int]:
+    return [
+        index
+        for index in range(chunk_count(session.size, session.chunk_size))
+        if index not in received
+    ]
+
+
+def missing_ranges(session, missing: list[int]) -> list[tuple[int, int]]:
+    """
+    Merge missing chunks into [start, end) byte ranges.
+    """
+    ranges = []
+    for index in missing:
+        start = index * session.chunk_size
+        end = start + chunk_length(session, index)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+async def create_session(
+    database: Database, user_id: int, file_name: str, size: int
+):
+    chunk_size = config.UPLOAD_PART_SIZE
+    if chunk_count(size, chunk_size) > MAX_CHUNKS:
+        raise ValueError(f"Files are limited to {MAX_CHUNKS * chunk_size} bytes")
+    b2_file_id = None
+    if size > chunk_size:
+        b2_file_id = await storage.start_large_file(file_name)
+    session_id = uuid.uuid4().hex
+    query = upload_session_table.insert().values(
+        id=session_id,
+        user_id=user_id,
+        file_name=file_name,
+        size=size,
+        chunk_size=chunk_size,
+        status=OPEN,
+        b2_file_id=b2_file_id,
+        created_at=utcnow(),
+    )
+    logger.debug(query)
+    await database.execute(query)
+    return await get_session(database, session_id, user_id)
+
+
+async def get_session(database: Database, session_id: str, user_id: int):
+    query = upload_session_table.select().where(
+        upload_session_table.c.id == session_id,
+        upload_session_table.c.user_id == user_id,
+    )
+    logger.debug(query)
+    return await database.fetch_one(query)
+
+
+async def received_chunks(database: Database, session_id: str) -> dict[int, str]:
+    query = (
+        sqlalchemy.select(upload_chunk_table.c.chunk_index, upload_chunk_table.c.sha1)
+        .where(upload_chunk_table.c.session_id == session_id)
+        .order_by(upload_chunk_table.c.chunk_index)
+    )
+    return {row.chunk_index: row.sha1 for row in await database.fetch_all(query)}
+
+
+async def put_chunk(database: Database, session, index: int, data: bytes):
+    """
+    Upload chunk `index` of `session`. Sending a chunk again replaces it.
+    """
+    if session.status != OPEN:
+        raise UploadSessionConflictError(f"Upload session is {session.status}")
+    token = uuid.uuid4().hex
+    if not await _lease_chunk(database, session.id, index, token):
+        raise UploadSessionConflictError(
+            f"Chunk {index} is being uploaded or the session is no longer open"
+        )
+    file_url = replaced_url = None
+    try:
+        if session.b2_file_id:
+            sha1 = await storage.upload_part(session.b2_file_id, index + 1, data)
+        else:
+            sha1 = hashlib.sha1(data).hexdigest()
+            file_url = await storage.upload_bytes(data, session.file_name)
+        async with database.transaction():
+            # Only record the chunk if no one took the lease over meanwhile
+            lease_held = sqlalchemy.exists().where(
+                upload_chunk_lease_table.c.session_id == session.id,
+                upload_chunk_lease_table.c.chunk_index == index,
+                upload_chunk_lease_table.c.token == token,
+                upload_chunk_lease_table.c.leased_until >= utcnow(),
+            )
+            query = (
+                insert(upload_chunk_table)
+                .from_select(
+                    ["session_id", "chunk_index", "sha1"],
+                    sqlalchemy.select(
+                        sqlalchemy.literal(session.id),
+                        sqlalchemy.literal(index),
+                        sqlalchemy.literal(sha1),
+                    ).where(lease_held, _session_open(session.id)),
+                )
+                .on_conflict_do_update(
+                    index_elements=[
+                        upload_chunk_table.c.session_id,
+                        upload_chunk_table.c.chunk_index,
+                    ],
+                    set_={"sha1": sha1},
+                )
+                .returning(upload_chunk_table.c.chunk_index)
+            )
+            logger.debug(query)
+            if await database.fetch_val(query) is None:
+                raise UploadSessionConflictError(
+                    f"Chunk {index} took too long to upload, send it again"
+                )
+            if file_url:
+                # The lease keeps other requests from replacing it meanwhile
+                replaced_url = await database.fetch_val(
+                    sqlalchemy.select(upload_session_table.c.file_url).where(
+                        upload_session_table.c.id == session.id
+                    )
+                )
+                await database.execute(
+                    upload_session_table.update()
+                    .where(upload_session_table.c.id == session.id)
+                    .values(file_url=file_url)
+                )
+    except BaseException:
+        # Not recorded, so nothing refers to the uploaded file
+        if file_url:
+            await _delete_file(file_url, session.file_name)
+        raise
+    finally:
+        await database.execute(
+            upload_chunk_lease_table.delete().where(
+                upload_chunk_lease_table.c.session_id == session.id,
+                upload_chunk_lease_table.c.chunk_index == index,
+                upload_chunk_lease_table.c.token == token,
+            )
+        )
+    if replaced_url:
+        await _delete_file(replaced_url, session.file_name)
+
+
+async def finalize_session(database: Database, session) -> str:
+    """
+    Assemble the chunks of `session` into its B2 file and return the file url.
+    Finalizing a finished session returns the same url.
+    """
+    if session.status == FINISHED:
+        return session.file_url
+
+    # Only one request may finish the B2 large file, and only once no chunk
+    # is being uploaded. Chunks can't be replaced after the claim.
+    active_leases = sqlalchemy.exists().where(
+        upload_chunk_lease_table.c.session_id == session.id,
+        upload_chunk_lease_table.c.leased_until >= utcnow(),
+    )
+    claim = (
+        upload_session_table.update()
+        .where(
+            upload_session_table.c.id == session.id,
+            upload_session_table.c.status == OPEN,
+            ~active_leases,
+        )
+        .values(status=FINISHING, finishing_at=utcnow())
+        .returning(upload_session_table.c.id)
+    )
+    if await database.fetch_val(claim) is None:
+        raise UploadSessionConflictError(
+            "Upload session is being finalized or chunks are still being uploaded"
+        )
+    file_url = session.file_url
+    try:
+        chunks = await received_chunks(database, session.id)
+        missing = missing_chunks(session, set(chunks))
+        if missing:
+            raise UploadSessionConflictError(f"Missing {len(missing)} chunks")
+        if session.b2_file_id:
+            file_url = await storage.finish_large_file(
+                session.b2_file_id, list(chunks.values())
+            )
+        else:
+            file_url = await database.fetch_val(
+                sqlalchemy.select(upload_session_table.c.file_url).where(
+                    upload_session_table.c.id == session.id
+                )
+            )
+    except BaseException:
+        await _set_status(database, session.id, OPEN)
+        raise
+    await database.execute(
+        upload_session_table.update()
+        .where(upload_session_table.c.id == session.id)
+        .values(status=FINISHED, file_url=file_url)
+    )
+    return file_url
+
+
+async def expire_sessions(database: Database) -> int:
+    """
+    Drop sessions not finalized in time and cancel their B2 large files.
+    """
+    now = utcnow()
+    expired_before = now - datetime.timedelta(
+        seconds=config.UPLOAD_SESSION_TTL_SECONDS
+    )
+    # A finalize whose process died leaves its session finishing, those are
+    # dropped too once the B2 call can no longer be running
+    finishing_before = now - datetime.timedelta(
+        seconds=config.UPLOAD_CHUNK_LEASE_SECONDS
+    )
+    # Claim the sessions first so no chunk or finalize can start on them
+    query = (
+        upload_session_table.update()
+        .where(
+            upload_session_table.c.created_at < expired_before,
+            sqlalchemy.or_(
+                upload_session_table.c.status.in_([OPEN, EXPIRED]),
+                sqlalchemy.and_(
+                    upload_session_table.c.status == FINISHING,
+                    upload_session_table.c.finishing_at < finishing_before,
+                ),
+            ),
+        )
+        .values(status=EXPIRED)
+        .returning(
+            upload_session_table.c.id,
+            upload_session_table.c.file_name,
+            upload_session_table.c.b2_file_id,
+            upload_session_table.c.file_url,
+        )
+    )
+    logger.debug(query)
+    sessions = await database.fetch_all(query)
+    for session in sessions:
+        try:
+            if session.b2_file_id:
+                await storage.cancel_large_file(session.b2_file_id)
+            elif session.file_url:
+                # The uploaded chunk of a single chunk session
+                await storage.delete_file(session.file_url, session.file_name)
+        except Exception:
+            # Retried on the next run, the session stays expired
+            logger.exception(f"Could not drop the B2 file of session {session.id}")
+            continue
+        await _delete_session(database, session.id)
+    if sessions:
+        logger.info(f"Expired {len(sessions)} upload sessions")
+    return len(sessions)
+
+
+def _session_open(session_id: str):
+    return sqlalchemy.exists().where(
+        upload_session_table.c.id == session_id,
+        upload_session_table.c.status == OPEN,
+    )
+
+
+async def _lease_chunk(
+    database: Database, session_id: str, index: int, token: str
+) -> bool:
+    """
+    Take chunk `index` for UPLOAD_CHUNK_LEASE_SECONDS if the session is open
+    and no other request holds it.
+    """
+    now = utcnow()
+    leased_until = now + datetime.timedelta(seconds=config.UPLOAD_CHUNK_LEASE_SECONDS)
+    query = (
+        insert(upload_chunk_lease_table)
+        .from_select(
+            ["session_id", "chunk_index", "token", "leased_until"],
+            sqlalchemy.select(
+                sqlalchemy.literal(session_id),
+                sqlalchemy.literal(index),
+                sqlalchemy.literal(token),
+                sqlalchemy.literal(leased_until, sqlalchemy.DateTime),
+            ).where(_session_open(session_id)),
+        )
+        .on_conflict_do_update(
+            index_elements=[
+                upload_chunk_lease_table.c.session_id,
+                upload_chunk_lease_table.c.chunk_index,
+            ],
+            set_={"token": token, "leased_until": leased_until},
+            where=upload_chunk_lease_table.c.leased_until < now,
+        )
+        .returning(upload_chunk_lease_table.c.token)
+    )
+    logger.debug(query)
+    return await database.fetch_val(query) is not None
+
+
+async def _delete_file(file_url: str, file_name: str):
+    try:
+        await storage.delete_file(file_url, file_name)
+    except Exception:
+        # Only leaves an unreferenced file in the bucket
+        logger.exception(f"Could not delete {file_url} from B2")
+
+
+async def _set_status(database: Database, session_id: str, status: str):
+    await database.execute(
+        upload_session_table.update()
+        .where(upload_session_table.c.id == session_id)
+        .values(status=status)
+    )
+
+
+async def _delete_session(database: Database, session_id: str):
+    async with database.transaction():
+        await database.execute(
+            upload_chunk_lease_table.delete().where(
+                upload_chunk_lease_table.c.session_id == session_id
+            )
+        )
+        await database.execute(
+            upload_chunk_table.delete().where(
+                upload_chunk_table.c.session_id == session_id
+            )
+        )
+        await database.execute(
+            upload_session_table.delete().where(
+                upload_session_table.c.id == session_id
+            )
+        )
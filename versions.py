@@ -0,0 +1,62 @@
+import hashlib
+import logging
+from typing import Optional
+
+from fastapi import Response
+from sqlalchemy.dialects.sqlite import insert
+
+from social_media_app.database import database, resource_version_table
+
+logger = logging.getLogger(__name__)
+
+# Resource versions and ETags
+# Each write bumps a counter for what it changed, and GET endpoints derive a
+# strong ETag from that counter plus the request parameters. A matching
+# If-None-Match is answered with 304 after a single primary key lookup,
+# without querying the post, likes or comments tables.
+
+FEED = "feed"
+# Order of the hot feed, bumped by update_hot_scores when rankings change
+HOT_FEED = "feed:hot"
+
+
+def post_key(post_id: int) -> str:
+    return f"post:{post_id}"
+
+
+async def bump_versions(*keys: str):
+    for key in keys:
+        query = (
+            insert(resource_version_table)
+            .values(key=key, version=1)
+            .on_conflict_do_update(
+                index_elements=[resource_version_table.c.key],
+                set_={"version": resource_version_table.c.version + 1},
+            )
+        )
+        await database.execute(query)
+
+
+async def get_version(key: str) -> int:
+    query = resource_version_table.select().where(resource_version_table.c.key == key)
+    row = await database.fetch_one(query)
+    return row.version if row else 0
+
+
+def make_etag(key: str, version: int, *params) -> str:
+    digest = hashlib.sha256(repr((key, version, params)).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag in tags
+
+
+def not_modified_response(etag: str) -> Response:
+    logger.debug(f"Resource not modified, ETag {etag}")
+    return Response(status_code=304, headers={"ETag": etag})